@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
 
 
 class AccountConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "account"
+
+    def ready(self):
+        # 用户变化（包括停用、删除）时失效用户快照缓存
+        from . import snapshot
+        from .models import User
+
+        post_save.connect(snapshot.on_user_changed, sender=User)
+        post_delete.connect(snapshot.on_user_changed, sender=User)
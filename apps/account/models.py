@@ -1,8 +1,33 @@
 from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import UserManager as BaseUserManager
 from django.db import models
+from django.db import transaction
 
 from core.models import BaseModel
 
+# WebSocket 用户快照包含的字段（见 account.snapshot）
+SNAPSHOT_FIELDS = frozenset({"is_active", "username"})
+
+
+class UserQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        """
+        批量更新不发送 post_save 信号：更新快照包含的字段（例如批量停用）时，在事务提交后失效相关用户的快照
+        """
+        if not SNAPSHOT_FIELDS.intersection(kwargs):
+            return super().update(**kwargs)
+
+        from . import snapshot
+
+        user_ids = list(self.values_list("pk", flat=True))
+        rows = super().update(**kwargs)
+        transaction.on_commit(lambda: snapshot.invalidate_many(user_ids), using=self.db)
+        return rows
+
+
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
+    pass
+
 
 class User(AbstractUser, BaseModel):
     """扩展用户模型"""
@@ -10,6 +35,8 @@ class User(AbstractUser, BaseModel):
     mobile = models.CharField(max_length=11, unique=True, null=True, blank=True, verbose_name="手机号")
     avatar = models.TextField(null=True, blank=True, verbose_name="头像")
 
+    objects = UserManager()
+
     class Meta:
         db_table = "user"
         verbose_name = "用户"
@@ -0,0 +1,163 @@
+"""
+用户快照缓存
+
+WebSocket 握手时 JWTAuthMiddleware 只需要用户的 id 与 username，不必加载完整的 User（包括不限长度的 avatar）。
+快照按用户缓存为 Redis 字符串（account:user:{user_id}，JSON），前面再加一层短时的进程内 LRU：
+  - 进程内命中时不访问 Redis 与数据库，断线重连高峰时不会把用户查询压到 PostgreSQL
+  - Redis 未命中时只查询所需字段并回填；用户不存在或已停用时同样缓存（空字符串），避免无效 token 反复查库。
+    回填与失效可能并发（例如握手加载快照时用户被停用）：每次失效递增用户的版本号（account:user:{user_id}:generation），
+    回填前读取版本号，只有版本号未变且快照仍不存在时才写入（Lua 脚本原子判断），避免把停用前读到的快照写回缓存
+  - User 保存（包括停用；只更新 last_login 等快照之外的字段时除外）/删除，以及 User.objects.filter(...).update(...) 更新 is_active、username 后
+    （见 account.models.UserQuerySet），在事务提交后删除 Redis 缓存与本进程的 LRU 条目；
+    其它进程的 LRU 条目在 USER_SNAPSHOT_LOCAL_TTL 秒内自然过期。
+    绕过 ORM 的修改（原生 SQL 等）不会失效快照，需要调用 invalidate_many，否则最长在 USER_SNAPSHOT_CACHE_TTL 秒后生效
+Redis 不可用时直接查询数据库。
+"""
+import json
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from core.db import database_sync_to_async
+from utils.lru import LRUCache
+
+from .models import SNAPSHOT_FIELDS
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+USER_KEY = "account:user:{user_id}"
+GENERATION_KEY = "account:user:{user_id}:generation"
+# 用户不存在或已停用
+_ABSENT = ""
+
+# KEYS[1]: 快照；KEYS[2]: 版本号；ARGV[1]: 读取数据库前的版本号（不存在时为空字符串）；ARGV[2]: 快照；ARGV[3]: 过期时间
+_FILL = """
+if (redis.call("GET", KEYS[2]) or "") ~= ARGV[1] or redis.call("EXISTS", KEYS[1]) == 1 then
+    return 0
+end
+redis.call("SET", KEYS[1], ARGV[2], "EX", ARGV[3])
+return 1
+"""
+
+_local = LRUCache(maxsize=settings.USER_SNAPSHOT_LOCAL_SIZE, ttl=settings.USER_SNAPSHOT_LOCAL_TTL)
+
+
+class UserSnapshot:
+    """
+    已认证用户的精简表示，代替 User 实例放入 WebSocket 连接的 scope["user"]
+    """
+
+    is_authenticated = True
+    is_anonymous = False
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __repr__(self):
+        return f"<UserSnapshot {self.id} {self.username}>"
+
+
+def _key(user_id) -> str:
+    return USER_KEY.format(user_id=user_id)
+
+
+def _generation_key(user_id) -> str:
+    return GENERATION_KEY.format(user_id=user_id)
+
+
+def _load(user_id) -> str:
+    row = User.objects.filter(pk=user_id, is_active=True).values("id", "username").first()
+    return json.dumps(row) if row else _ABSENT
+
+
+def _snapshot(value):
+    return UserSnapshot(**json.loads(value)) if value else None
+
+
+def get(user_id):
+    """
+    用户快照
+    :param user_id: 用户 ID
+    :return: UserSnapshot，用户不存在或已停用时为 None
+    """
+    user_id = str(user_id)
+    cached = _local.get(user_id)
+    if cached is not None:
+        return _snapshot(cached)
+
+    key = _key(user_id)
+    cacheable = True
+    try:
+        redis = get_redis_connection("default")
+        pipe = redis.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.get(_generation_key(user_id))
+        value, generation = pipe.execute()
+        if value is not None:
+            value = value.decode()
+        else:
+            value = _load(user_id)
+            # 回填被放弃时快照可能已过期，同样不写入进程内缓存
+            cacheable = redis.register_script(_FILL)(
+                keys=[key, _generation_key(user_id)],
+                args=[generation or b"", value, settings.USER_SNAPSHOT_CACHE_TTL],
+            )
+    except RedisError as e:
+        logger.warning(f"User snapshot cache unavailable, falling back to database: {e}")
+        value = _load(user_id)
+
+    if cacheable:
+        _local.set(user_id, value)
+    return _snapshot(value)
+
+
+async def aget(user_id):
+    """get 的异步版本：进程内缓存命中时直接在事件循环中返回，不占用线程池"""
+    cached = _local.get(str(user_id))
+    if cached is not None:
+        return _snapshot(cached)
+    return await database_sync_to_async(get)(user_id)
+
+
+def invalidate(user_id):
+    invalidate_many([user_id])
+
+
+def invalidate_many(user_ids):
+    """
+    失效用户快照
+    :param user_ids: 用户 ID 列表
+    :return:
+    """
+    user_ids = [str(user_id) for user_id in user_ids]
+    if not user_ids:
+        return
+    for user_id in user_ids:
+        _local.delete(user_id)
+    try:
+        pipe = get_redis_connection("default").pipeline()
+        for user_id in user_ids:
+            pipe.incr(_generation_key(user_id))
+            pipe.expire(_generation_key(user_id), settings.USER_SNAPSHOT_CACHE_TTL)
+            pipe.delete(_key(user_id))
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Failed to invalidate user snapshots of {user_ids}: {e}")
+
+
+def on_user_changed(sender, instance, update_fields=None, **kwargs):
+    # 只更新快照之外的字段（如登录时的 save(update_fields=["last_login"])）时快照不变，不失效，避免重连时缓存未命中
+    if update_fields is not None and not SNAPSHOT_FIELDS.intersection(update_fields):
+        return
+    # 提交前失效会让其它连接把旧的快照重新读入缓存
+    user_id = instance.pk
+    transaction.on_commit(lambda: invalidate(user_id))
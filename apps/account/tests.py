@@ -0,0 +1,102 @@
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import update_last_login
+from django.test import TestCase
+
+from core.middleware.jwt_auth import JWTAuthMiddleware
+from utils.jwt_handler import jwt_encode_handler
+from utils.jwt_handler import jwt_payload_handler
+
+from . import snapshot
+from .models import User
+
+
+class UserSnapshotTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        snapshot._local.clear()
+
+    def test_snapshot_is_cached_and_invalidated_on_change(self):
+        user = snapshot.get(self.user.id)
+        self.assertEqual((user.id, user.username), (self.user.id, "alice"))
+
+        # 进程内缓存与 Redis 均命中时不查询数据库
+        with self.assertNumQueries(0):
+            self.assertEqual(snapshot.get(self.user.id).username, "alice")
+            snapshot._local.clear()
+            self.assertEqual(snapshot.get(self.user.id).username, "alice")
+
+        # 登录只更新 last_login，不失效快照
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            update_last_login(None, self.user)
+        self.assertEqual(callbacks, [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save(update_fields=["is_active"])
+        self.assertIsNone(snapshot.get(self.user.id))
+
+    def test_fill_racing_with_invalidation_is_discarded(self):
+        load = snapshot._load
+
+        def deactivate_while_loading(user_id):
+            # 读取数据库之后、回填之前用户被停用
+            value = load(user_id)
+            User.objects.filter(pk=user_id).update(is_active=False)
+            snapshot.invalidate(user_id)
+            return value
+
+        with mock.patch.object(snapshot, "_load", side_effect=deactivate_while_loading):
+            self.assertEqual(snapshot.get(self.user.id).username, "alice")
+        self.assertIsNone(snapshot._local.get(str(self.user.id)))
+        self.assertIsNone(snapshot.get(self.user.id))
+
+    def test_queryset_update_invalidates_snapshot(self):
+        snapshot.get(self.user.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.filter(pk=self.user.pk).update(is_active=False)
+        self.assertIsNone(snapshot.get(self.user.id))
+
+    def test_middleware_resolves_snapshot_or_anonymous(self):
+        snapshot.get(self.user.id)
+        expired = jwt_payload_handler(self.user)
+        expired["exp"] = datetime.now(timezone.utc) - timedelta(seconds=60)
+        tokens = {
+            jwt_encode_handler(jwt_payload_handler(self.user)): "alice",
+            jwt_encode_handler(expired): None,
+            "not.a.token": None,
+        }
+
+        for token, username in tokens.items():
+            with self.assertNumQueries(0):
+                user = self.authenticate(query_string=f"token={token}".encode())
+            self.assertEqual(user.username if user.is_authenticated else None, username)
+
+    def test_middleware_reads_token_from_subprotocols(self):
+        snapshot.get(self.user.id)
+        token = jwt_encode_handler(jwt_payload_handler(self.user))
+        offers = {
+            f"im.msgpack, {token}": "alice",
+            # 带点的子协议名不会被当作 token
+            f"a.b.c, {token}": "alice",
+            "im.msgpack, a.b.c": None,
+        }
+
+        for offer, username in offers.items():
+            user = self.authenticate(headers=[(b"sec-websocket-protocol", offer.encode())])
+            self.assertEqual(user.username if user.is_authenticated else None, username, offer)
+
+    @staticmethod
+    def authenticate(query_string=b"", headers=()):
+        scopes = []
+
+        async def inner(scope, receive, send):
+            scopes.append(scope)
+
+        scope = {"type": "websocket", "query_string": query_string, "headers": list(headers)}
+        async_to_sync(JWTAuthMiddleware(inner))(scope, None, None)
+        return scopes[0]["user"]
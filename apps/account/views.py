@@ -136,9 +136,9 @@ class VerificationCodeLoginView(APIView):
         if not user.is_active:
             return StandardResponse(StatCode.USER_IS_DISABLED, "用户被禁用")
 
-        # 更新最后登录时间
+        # 更新最后登录时间：只保存相关字段，不失效 WebSocket 用户快照（见 account.snapshot）
         user.last_login = timezone.now()
-        user.save()
+        user.save(update_fields=["last_login", "updated_at"])
 
         # 生成token
         payload = jwt_payload_handler(user)
@@ -1,5 +1,8 @@
 from django.apps import AppConfig
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
 from django.db.models.signals import post_migrate
+from django.db.models.signals import post_save
 
 
 class ImConfig(AppConfig):
@@ -10,6 +13,17 @@ class ImConfig(AppConfig):
         # 连接信号，确保在数据库迁移完成后执行。规避未迁移生成应用注册表导致的异常
         post_migrate.connect(create_schedule_job, sender=self)
 
+        # 成员变化时失效成员缓存，离开对话时删除该对话的未读数
+        from . import membership
+        from . import unread
+        from .models import Conversation
+        from .models import ConversationMember
+
+        post_save.connect(membership.on_member_saved, sender=ConversationMember)
+        post_delete.connect(membership.on_member_saved, sender=ConversationMember)
+        post_delete.connect(unread.on_member_deleted, sender=ConversationMember)
+        m2m_changed.connect(membership.on_participants_changed, sender=Conversation.participants.through)
+
 
 def create_schedule_job(sender, **kwargs):
     """配置周期性任务"""
@@ -30,3 +44,23 @@ def create_schedule_job(sender, **kwargs):
         task="im.tasks.cleanup_old_messages",
         defaults={"description": "Clean up messages older than the retention period"},
     )
+
+    # 每天为分区表提前创建未来的分区
+    PeriodicTask.objects.get_or_create(
+        interval=schedule,
+        name="Create Message Partitions",
+        task="im.tasks.create_message_partitions",
+        defaults={"description": "Create future partitions of the partitioned message table ahead of time"},
+    )
+
+    # 每小时校准一次 Redis 未读计数器
+    hourly, created = IntervalSchedule.objects.get_or_create(
+        every=1,
+        period=IntervalSchedule.HOURS,
+    )
+    PeriodicTask.objects.get_or_create(
+        interval=hourly,
+        name="Rebuild Unread Counters",
+        task="im.tasks.rebuild_unread_counters",
+        defaults={"description": "Rebuild per-user unread counters in Redis from the database"},
+    )
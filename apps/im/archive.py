@@ -0,0 +1,193 @@
+"""
+过期消息冷归档
+
+保留期清理删除消息前，先将其写入本地磁盘的压缩归档文件（MESSAGE_ARCHIVE_ROOT）：
+
+    <root>/<YYYY-MM-DD>/shard-<NN>.ndjson.gz    每天（UTC）每个对话分片一个文件，每行一条 JSON 消息
+    <root>/<YYYY-MM-DD>/shard-<NN>.index.json   {对话 ID: {"offset", "length", "count"}}
+
+文件中每个对话的消息是一个独立的 gzip member（多个 member 首尾相接仍是合法的 gzip 文件，gunzip 可整体解压），
+按索引中的偏移量只解压目标对话的 member 即可读取其历史，见 read_conversation()。
+
+归档按整天进行：一天的消息通过服务端游标分块读取、边读边压缩写入，内存占用与消息量无关；
+整天写入临时目录后再原子重命名，已存在的日期目录会被跳过，重复执行不会产生重复数据。
+"""
+import gzip
+import json
+import logging
+import os
+import shutil
+import uuid
+import zlib
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from im.models import Message
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("id", "seq", "conversation_id", "sender_id", "content", "timestamp", "created_by", "updated_by")
+_CONVERSATION = FIELDS.index("conversation_id")
+# 服务端游标每次读取的行数
+CHUNK_SIZE = 2000
+
+
+def day_start(moment: datetime) -> datetime:
+    """moment 所在 UTC 自然日的零点"""
+    return datetime.combine(moment.astimezone(dt_timezone.utc).date(), time.min, tzinfo=dt_timezone.utc)
+
+
+def shard_of(conversation_id) -> int:
+    if not isinstance(conversation_id, uuid.UUID):
+        conversation_id = uuid.UUID(str(conversation_id))
+    return conversation_id.int % settings.MESSAGE_ARCHIVE_SHARDS
+
+
+def day_path(day) -> str:
+    return os.path.join(settings.MESSAGE_ARCHIVE_ROOT, f"{day:%Y-%m-%d}")
+
+
+class _ShardWriter:
+    """一个分片文件：每个对话写为一个 gzip member，并记录其在文件中的位置"""
+
+    def __init__(self, directory, shard):
+        self.index_path = os.path.join(directory, f"shard-{shard:02d}.index.json")
+        self.file = open(os.path.join(directory, f"shard-{shard:02d}.ndjson.gz"), "wb")
+        self.index = {}
+
+    def begin(self, conversation_id):
+        self.conversation_id = conversation_id
+        self.offset = self.file.tell()
+        self.count = 0
+        # mtime=0 让相同内容生成相同的归档文件
+        self.member = gzip.GzipFile(fileobj=self.file, mode="wb", mtime=0)
+
+    def write(self, line):
+        self.member.write(line)
+        self.count += 1
+
+    def end(self):
+        # 关闭 member 只写入 gzip 尾部，不会关闭底层文件
+        self.member.close()
+        self.index[str(self.conversation_id)] = {
+            "offset": self.offset,
+            "length": self.file.tell() - self.offset,
+            "count": self.count,
+        }
+
+    def close(self):
+        self.file.close()
+        with open(self.index_path, "w") as f:
+            json.dump(self.index, f)
+
+
+def _encode(row) -> bytes:
+    return json.dumps(dict(zip(FIELDS, row)), cls=DjangoJSONEncoder, ensure_ascii=False).encode() + b"\n"
+
+
+def archive_day(day):
+    """
+    归档 UTC 自然日 day 的全部消息
+    :param day: 当天零点（UTC）
+    :return: 归档的消息条数；该日已归档时返回 0
+    """
+    target = day_path(day)
+    if os.path.isdir(target):
+        return 0
+
+    tmp = f"{target}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    rows = (
+        Message.objects.filter(timestamp__gte=day, timestamp__lt=day + timedelta(days=1))
+        .order_by("conversation_id", "timestamp", "id")
+        .values_list(*FIELDS)
+        # PostgreSQL 上 iterator() 使用服务端游标，每次只取一块
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+
+    writers = {}
+    writer = None
+    current = None
+    total = 0
+
+    # 结果按对话排序，同一时刻只有一个对话的 member 处于写入状态
+    for row in rows:
+        if row[_CONVERSATION] != current:
+            if writer:
+                writer.end()
+            current = row[_CONVERSATION]
+            shard = shard_of(current)
+            if shard not in writers:
+                writers[shard] = _ShardWriter(tmp, shard)
+            writer = writers[shard]
+            writer.begin(current)
+        writer.write(_encode(row))
+        total += 1
+    if writer:
+        writer.end()
+
+    for writer in writers.values():
+        writer.close()
+    os.rename(tmp, target)
+    return total
+
+
+def archive_messages(before, log=logger.info):
+    """
+    归档 before 之前的所有整天（before 需为 UTC 零点）
+    :param before: 归档截止时间
+    :param log: 进度输出函数
+    :return: 归档的消息条数
+    """
+    first = Message.objects.filter(timestamp__lt=before).order_by("timestamp").values_list("timestamp", flat=True)[:1]
+    if not first:
+        return 0
+
+    total = 0
+    day = day_start(first[0])
+    while day < before:
+        archived = archive_day(day)
+        if archived:
+            log(f"Archived {archived} messages of {day:%Y-%m-%d} to {day_path(day)}")
+        total += archived
+        day += timedelta(days=1)
+    return total
+
+
+def read_conversation(day, conversation_id):
+    """
+    读取某个对话某一天的归档消息，只解压该对话所在的 gzip member
+    :param day: 日期（date 或 datetime）
+    :param conversation_id: 对话 ID
+    :return: 消息字典的迭代器
+    """
+    directory = day_path(day)
+    shard = shard_of(conversation_id)
+    try:
+        with open(os.path.join(directory, f"shard-{shard:02d}.index.json")) as f:
+            entry = json.load(f).get(str(conversation_id))
+    except FileNotFoundError:
+        return
+    if not entry:
+        return
+
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    remaining = entry["length"]
+    pending = b""
+    with open(os.path.join(directory, f"shard-{shard:02d}.ndjson.gz"), "rb") as f:
+        f.seek(entry["offset"])
+        while remaining:
+            chunk = f.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            pending += decompressor.decompress(chunk)
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                yield json.loads(line)
@@ -0,0 +1,64 @@
+"""
+在线状态与“正在输入”广播的合并
+
+同一对话在 IM_PRESENCE_WINDOW_MS 毫秒窗口内的上下线、输入事件合并为一次广播：
+窗口内第一个事件启动定时器，窗口结束时以 (conversation_id, online, offline, typing) 调用广播函数。
+同一用户在窗口内多次上下线只保留最后的状态，已下线的用户不再出现在 typing 中。
+合并在进程内进行（每个事件循环一个合并器），多个 worker 各自合并，每个对话每个窗口每个 worker 至多广播一次。
+"""
+import asyncio
+import logging
+import weakref
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Coalescer:
+    def __init__(self, broadcast):
+        """
+        :param broadcast: 协程函数 broadcast(conversation_id, online, offline, typing)，三个列表均为用户 ID
+        """
+        self.broadcast = broadcast
+        self.pending = {}
+        self.tasks = set()
+
+    def presence(self, conversation_id, user_id, online: bool):
+        self._state(conversation_id)["presence"][user_id] = online
+
+    def typing(self, conversation_id, user_id):
+        self._state(conversation_id)["typing"].add(user_id)
+
+    def _state(self, conversation_id):
+        conversation_id = str(conversation_id)
+        state = self.pending.get(conversation_id)
+        if state is None:
+            state = self.pending[conversation_id] = {"presence": {}, "typing": set()}
+            task = asyncio.create_task(self._flush_later(conversation_id))
+            # 持有任务引用，避免执行中被回收
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return state
+
+    async def _flush_later(self, conversation_id):
+        await asyncio.sleep(settings.IM_PRESENCE_WINDOW_MS / 1000)
+        state = self.pending.pop(conversation_id)
+        online = sorted(user_id for user_id, is_online in state["presence"].items() if is_online)
+        offline = sorted(user_id for user_id, is_online in state["presence"].items() if not is_online)
+        typing = sorted(state["typing"].difference(offline))
+        try:
+            await self.broadcast(conversation_id, online, offline, typing)
+        except Exception:
+            logger.exception(f"Failed to broadcast presence of conversation {conversation_id}")
+
+
+# 每个事件循环一个合并器（asyncio 任务与事件循环绑定）
+_coalescers = weakref.WeakKeyDictionary()
+
+
+def get_coalescer(broadcast) -> Coalescer:
+    loop = asyncio.get_running_loop()
+    if loop not in _coalescers:
+        _coalescers[loop] = Coalescer(broadcast)
+    return _coalescers[loop]
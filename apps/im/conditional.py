@@ -0,0 +1,57 @@
+"""
+IM 读接口的条件请求（ETag）
+
+对话有新消息或成员变化时会刷新 Conversation.updated_at，当前用户的已读状态变化体现在 ConversationMember.last_read_at，
+两者即可判断响应是否发生变化。命中 If-None-Match 时由 django 的 condition 装饰器直接返回 304，
+不再执行列表查询与序列化。版本信息每个请求只查询一次。
+不提供 Last-Modified：其精度只到秒，同一秒内的新消息会被 If-Modified-Since 误判为未修改。
+"""
+import hashlib
+
+from django.db.models import Count
+from django.db.models import Max
+
+from .models import ConversationMember
+
+
+def _make_etag(*parts) -> str:
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def _list_version(request):
+    if not hasattr(request, "_im_list_version"):
+        request._im_list_version = ConversationMember.objects.filter(user=request.user).aggregate(
+            count=Count("id"), updated_at=Max("conversation__updated_at"), read_at=Max("last_read_at")
+        )
+    return request._im_list_version
+
+
+def _conversation_version(request, conversation_id):
+    if not hasattr(request, "_im_conversation_version"):
+        request._im_conversation_version = (
+            ConversationMember.objects.filter(conversation_id=conversation_id, user=request.user)
+            .values_list("conversation__updated_at", "last_read_at")
+            .first()
+        )
+    return request._im_conversation_version
+
+
+def conversation_list_etag(request):
+    version = _list_version(request)
+    return _make_etag(request.user.pk, version["count"], version["updated_at"], version["read_at"])
+
+
+def conversation_etag(request, conversation_id):
+    version = _conversation_version(request, conversation_id)
+    # 非参与者不返回版本，交由视图返回 404
+    if version is None:
+        return None
+    return _make_etag(request.user.pk, conversation_id, *version)
+
+
+def message_history_etag(request, conversation_id):
+    version = _conversation_version(request, conversation_id)
+    if version is None:
+        return None
+    # 不同游标、分页参数对应不同的响应
+    return _make_etag(request.user.pk, conversation_id, request.GET.urlencode(), *version)
@@ -1,69 +1,497 @@
-import json
+import asyncio
 import logging
+import uuid
+from urllib.parse import parse_qs
 
-from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 
+from core.db import database_sync_to_async
+
+from . import coalesce
+from . import flowcontrol
+from . import membership
+from . import presence
+from . import protocol
+from . import receipts
+from . import unread
+from . import writebehind
 from .models import Conversation
+from .models import ConversationMember
 from .models import Message
 
 logger = logging.getLogger(__name__)
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+def group_name(conversation_id) -> str:
+    return f"chat_{conversation_id}"
+
+
+def message_event(conversation_id, message: dict) -> dict:
+    """
+    构造 chat_message 群组事件，携带两种连接、两种编码各自可直接发送的帧
+    消息在发送端只编码一次，群组内每个接收者不再解码、重新编码消息
+    :param conversation_id: 对话 ID
+    :param message: 消息（timestamp 为 datetime）
+    :return:
+    """
+    encoded = protocol.encode_json(message)
+    return {
+        "type": "chat_message",
+        # ChatConsumer（ws/chat/<conversation_id>/）
+        "text": f'{{"message": {encoded}}}',
+        "bytes": protocol.encode_msgpack({"message": message}),
+        # MultiplexChatConsumer（ws/chat/）
+        "multiplex_text": f'{{"type": "message", "conversation_id": "{conversation_id}", "message": {encoded}}}',
+        "multiplex_bytes": protocol.encode_msgpack(
+            {"type": "message", "conversation_id": str(conversation_id), "message": message}
+        ),
+    }
+
+
+async def broadcast_presence(conversation_id, online, offline, typing):
+    """发送合并后的在线状态与输入事件，见 im.coalesce"""
+    await get_channel_layer().group_send(
+        group_name(conversation_id),
+        {
+            "type": "chat_presence",
+            "conversation_id": conversation_id,
+            "online": online,
+            "offline": offline,
+            "typing": typing,
+        },
+    )
+
+
+async def broadcast_read(conversation_id, cursors):
+    """发送合并后的已读游标变化，见 im.receipts"""
+    await get_channel_layer().group_send(
+        group_name(conversation_id), {"type": "chat_read", "conversation_id": conversation_id, "cursors": cursors}
+    )
+
+
+def parse_message_id(value):
+    """read 帧中的消息 ID，格式错误时返回 None"""
+    if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+        return value
+    return None
+
+
+class ChatMixin:
+    """ChatConsumer 与 MultiplexChatConsumer 共用的消息保存、广播与流量控制（见 im.flowcontrol）"""
+
+    async def websocket_connect(self, message):
+        # 握手完成后发往客户端的帧都经过发送队列
+        self.raw_send, self.base_send = self.base_send, self.enqueue
+        self.outbox = None
+        self.writer = None
+        self.overflowed = False
+        self.bucket = flowcontrol.connection_bucket()
+        self.late_replays = set()
+        await super().websocket_connect(message)
+
+    async def websocket_disconnect(self, message):
+        if getattr(self, "writer", None):
+            self.writer.cancel()
+        for task in getattr(self, "late_replays", ()):
+            task.cancel()
+        await super().websocket_disconnect(message)
+
+    async def enqueue(self, message):
+        if self.outbox is None:
+            # 握手阶段（accept 或拒绝连接的 close）直接发送
+            await self.raw_send(message)
+            if message["type"] == "websocket.accept":
+                self.outbox = asyncio.Queue()
+                self.writer = asyncio.create_task(self.drain())
+            return
+        if self.overflowed:
+            return
+        if self.outbox.qsize() >= settings.IM_OUTBOX_HIGH_WATER:
+            # 客户端读取过慢：关闭连接，不再缓冲
+            self.overflowed = True
+            self.writer.cancel()
+            flowcontrol.record(flowcontrol.SLOW_CONSUMERS)
+            logger.warning(f"Closing slow consumer {self.channel_name} of user {self.user.id}")
+            await self.raw_send({"type": "websocket.close", "code": flowcontrol.SLOW_CONSUMER_CLOSE_CODE})
+            return
+        self.outbox.put_nowait(message)
+
+    async def drain(self):
+        while True:
+            await self.raw_send(await self.outbox.get())
+
+    async def allow_frame(self) -> bool:
+        """客户端帧是否在限流范围内，超出时返回 rate_limited 错误"""
+        if flowcontrol.allow(self.bucket, self.user.id):
+            return True
+        await self.send_frame(self.error_frame("rate_limited", None))
+        return False
+
+    async def publish(self, conversation_id, content):
+        """
+        保存消息并广播到对话的群组
+        :param conversation_id: 对话 ID
+        :param content: 消息内容
+        :return:
+        """
+        if settings.IM_WRITE_BEHIND:
+            # 写后模式：分配 ID 后立即广播，消息由缓冲批量写入数据库
+            message_obj = await writebehind.get_buffer().add(conversation_id, self.user.id, content, self.channel_name)
+        else:
+            # 保存消息到数据库
+            message_obj = await self.save_message(conversation_id, self.user.id, content)
+
+        # 发送消息到群组：帧在发送端编码一次，接收端直接转发
+        await self.channel_layer.group_send(
+            group_name(conversation_id),
+            message_event(
+                conversation_id,
+                {
+                    "id": message_obj.id,
+                    "seq": message_obj.seq,
+                    "sender": {"id": self.user.id, "username": self.user.username},
+                    "content": message_obj.content,
+                    "timestamp": message_obj.timestamp,
+                    "is_read": False,
+                },
+            ),
+        )
+
+    async def resume(self, conversation_id, last_seq):
+        """
+        补发客户端序号 last_seq 之后的消息。在加入群组之后调用，补发与实时广播可能重复，客户端按 seq 去重；
+        缺口超过 IM_RESUME_MAX_MESSAGES 条时不补发，返回 resume_gap_too_large 错误，客户端改为通过 REST 接口拉取历史。
+        写后模式下序号已分配的消息可能尚未写入（且已在加入群组前广播），IM_WRITE_BEHIND_SETTLE_MS 毫秒后再补发一次缺少的序号，
+        届时仍不存在的序号视为写入失败留下的空洞
+        :param conversation_id: 对话 ID
+        :param last_seq: 客户端已收到的最大序号
+        :return:
+        """
+        messages, latest_seq = await self.missed_messages(conversation_id, self.user.id, last_seq)
+        if messages is None:
+            await self.send_frame(self.error_frame("resume_gap_too_large", conversation_id, last_seq=latest_seq))
+            return
+        for message in messages:
+            await self.send_frame(self.message_frame(conversation_id, message))
+
+        if settings.IM_WRITE_BEHIND:
+            missing = set(range(last_seq + 1, latest_seq + 1)) - {message["seq"] for message in messages}
+            if missing:
+                task = asyncio.create_task(self.replay_late(conversation_id, missing))
+                self.late_replays.add(task)
+                task.add_done_callback(self.late_replays.discard)
+
+    async def replay_late(self, conversation_id, seqs):
+        await asyncio.sleep(settings.IM_WRITE_BEHIND_SETTLE_MS / 1000)
+        messages, _ = await self.missed_messages(conversation_id, self.user.id, min(seqs) - 1, seqs=seqs)
+        for message in messages:
+            await self.send_frame(self.message_frame(conversation_id, message))
+
+    @database_sync_to_async
+    def missed_messages(self, conversation_id, user_id, last_seq, seqs=None):
+        """
+        :param seqs: 只查询其中的序号
+        :return: (按序号排列的消息, 对话已分配的最新序号)；缺口过大时消息为 None
+        """
+        latest_seq = Conversation.objects.filter(id=conversation_id).values_list("last_seq", flat=True).first() or 0
+        if seqs is None and latest_seq - last_seq > settings.IM_RESUME_MAX_MESSAGES:
+            return None, latest_seq
+
+        queryset = Message.objects.filter(conversation_id=conversation_id, seq__gt=last_seq)
+        if seqs is not None:
+            queryset = queryset.filter(seq__in=seqs)
+        rows = list(
+            queryset.order_by("seq").values("id", "seq", "sender_id", "sender__username", "content", "timestamp")
+        )
+
+        read_cursor = (
+            ConversationMember.objects.filter(conversation_id=conversation_id, user_id=user_id)
+            .values_list("last_read_message_id", flat=True)
+            .first()
+        )
+        messages = [
+            {
+                "id": row["id"],
+                "seq": row["seq"],
+                "sender": {"id": row["sender_id"], "username": row["sender__username"]},
+                "content": row["content"],
+                "timestamp": row["timestamp"],
+                "is_read": read_cursor is not None and row["id"] <= read_cursor,
+            }
+            for row in rows
+        ]
+        return messages, latest_seq
+
+    async def presence_connect(self):
+        self.present = True
+        if await database_sync_to_async(presence.connect)(self.user.id):
+            await self.announce_presence(True)
+
+    async def presence_heartbeat(self):
+        if await database_sync_to_async(presence.heartbeat)(self.user.id):
+            await self.announce_presence(True)
+
+    async def presence_disconnect(self):
+        if getattr(self, "present", False) and await database_sync_to_async(presence.disconnect)(self.user.id):
+            await self.announce_presence(False)
+
+    async def announce_presence(self, online: bool):
+        """
+        用户上线/下线时通知其所在的全部对话（见 membership.conversation_ids，缓存命中时不查询数据库），
+        同一对话窗口内的变化合并为一次广播
+        """
+        coalescer = coalesce.get_coalescer(broadcast_presence)
+        for conversation_id in await membership.aconversation_ids(self.user.id):
+            coalescer.presence(conversation_id, self.user.id, online)
+
+    def typing(self, conversation_id):
+        coalesce.get_coalescer(broadcast_presence).typing(conversation_id, self.user.id)
+
+    def read(self, conversation_id, message_id):
+        receipts.get_buffer(broadcast_read).add(conversation_id, self.user.id, message_id)
+
+    async def chat_read(self, event):
+        await self.send_frame(self.read_frame(event))
+
+    async def chat_presence(self, event):
+        await self.send_frame(self.presence_frame(event))
+
+    async def send_frame(self, frame):
+        """按连接协商的子协议编码并发送"""
+        data = protocol.encode(self.subprotocol, frame)
+        if isinstance(data, bytes):
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
+
+    async def forward(self, text, data):
+        """转发 message_event 中预编码的帧"""
+        if self.subprotocol == protocol.MSGPACK:
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=text)
+
+    async def chat_error(self, event):
+        """写后模式下消息写入数据库失败，通知发送者"""
+        await self.send_frame(self.error_frame(event["error"], None, message_ids=event["message_ids"]))
+
+    @database_sync_to_async
+    def save_message(self, conversation_id: str, user_id: int, content: str):
+        timestamp = timezone.now()
+        with transaction.atomic():
+            # 分配对话内序号，同时刷新对话版本，供 REST 读接口的条件请求判断
+            seq = Conversation.objects.allocate_seq(conversation_id, updated_at=timestamp)
+            message = Message.objects.create(
+                conversation_id=conversation_id, sender_id=user_id, content=content, timestamp=timestamp, seq=seq
+            )
+        unread.increment(conversation_id)
+        return message
+
+
+class ChatConsumer(ChatMixin, AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope["user"]
         if self.user.is_anonymous:
             await self.close()
             return
 
+        self.subprotocol = protocol.negotiate(self.scope.get("subprotocols"))
         self.conversation_id = self.scope["url_route"]["kwargs"]["conversation_id"]
-        self.room_group_name = f"chat_{self.conversation_id}"
+        self.room_group_name = group_name(self.conversation_id)
 
-        # 验证用户是否属于该对话
-        # 异步调用时传入 primitive types，避免跨线程传 model 实例
-        if await self.is_participant(self.conversation_id, self.user.id):
+        # 验证用户是否属于该对话（成员缓存命中时不查询数据库）
+        if await membership.ais_member(self.conversation_id, self.user.id):
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-            await self.accept()
+            await self.accept(subprotocol=self.subprotocol)
         else:
             await self.close()
+            return
+        await self.presence_connect()
+
+        # 重连时通过 ?last_seq=<已收到的最大序号> 补发缺失的消息
+        last_seq = parse_qs(self.scope.get("query_string", b"").decode()).get("last_seq")
+        if last_seq and last_seq[0].isdigit():
+            await self.resume(self.conversation_id, int(last_seq[0]))
 
     async def disconnect(self, close_code):
         if hasattr(self, "room_group_name"):
             await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await self.presence_disconnect()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not await self.allow_frame():
+            return
+        # 连接期间被移出对话的用户不能继续发送
+        if not await membership.ais_member(self.conversation_id, self.user.id):
+            await self.close()
+            return
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json["message"]
+        try:
+            frame = protocol.decode(text_data, bytes_data)
+        except ValueError:
+            await self.send_frame(self.error_frame("invalid_frame", self.conversation_id))
+            return
+        # {"type": "heartbeat"} 刷新在线状态，{"type": "typing"} 正在输入，
+        # {"type": "read", "message_id": ...} 已读到该消息，其余为消息 {"message": "..."}
+        frame_type = frame.get("type")
+        if frame_type == "heartbeat":
+            await self.presence_heartbeat()
+        elif frame_type == "typing":
+            self.typing(self.conversation_id)
+        elif frame_type == "read":
+            message_id = parse_message_id(frame.get("message_id"))
+            if message_id is None:
+                await self.send_frame(self.error_frame("invalid_frame", self.conversation_id))
+            else:
+                self.read(self.conversation_id, message_id)
+        elif isinstance(frame.get("message"), str):
+            await self.publish(self.conversation_id, frame["message"])
+        else:
+            await self.send_frame(self.error_frame("invalid_frame", self.conversation_id))
 
-        # 保存消息到数据库
-        message_obj = await self.save_message(self.conversation_id, self.user.id, message)
+    def message_frame(self, conversation_id, message):
+        return {"message": message}
 
-        # 发送消息到群组
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "chat_message",
-                "message": {
-                    "id": message_obj.id,
-                    "sender": {"id": self.user.id, "username": self.user.username},
-                    "content": message_obj.content,
-                    "timestamp": message_obj.timestamp.isoformat(),
-                    "is_read": False,
-                },
-            },
-        )
+    def error_frame(self, code, conversation_id, **extra):
+        return {"error": {"code": code, **extra}}
+
+    def presence_frame(self, event):
+        return {"presence": {"online": event["online"], "offline": event["offline"], "typing": event["typing"]}}
+
+    def read_frame(self, event):
+        return {"read": event["cursors"]}
 
     async def chat_message(self, event):
-        message = event["message"]
-        await self.send(text_data=json.dumps({"message": message}))
+        await self.forward(event["text"], event["bytes"])
 
-    @database_sync_to_async
-    def is_participant(self, conversation_id: str, user_id: int):
-        return Conversation.objects.filter(id=conversation_id, participants__id=user_id).exists()
 
-    @database_sync_to_async
-    def save_message(self, conversation_id: str, user_id: int, content: str):
-        conversation = Conversation.objects.select_related().get(id=conversation_id)
-        message = Message.objects.create(conversation=conversation, sender_id=user_id, content=content)
-        return message
+class MultiplexChatConsumer(ChatMixin, AsyncWebsocketConsumer):
+    """
+    每个用户一个连接，在连接内订阅多个对话。帧的编码见 im.protocol，客户端帧：
+      {"type": "subscribe", "conversation_id": "...", "last_seq": 0}（last_seq 可选，补发该序号之后的消息）
+      {"type": "unsubscribe", "conversation_id": "..."}
+      {"type": "message", "conversation_id": "...", "message": "..."}
+      {"type": "typing", "conversation_id": "..."}
+      {"type": "read", "conversation_id": "...", "message_id": 0}（已读到该消息）
+      {"type": "heartbeat"}（间隔应小于 IM_PRESENCE_TTL 秒）
+    服务端帧：
+      {"type": "subscribed" | "unsubscribed", "conversation_id": "..."}
+      {"type": "message", "conversation_id": "...", "message": {...}}
+      {"type": "presence", "conversation_id": "...", "online": [...], "offline": [...], "typing": [...]}
+      {"type": "read", "conversation_id": "...", "cursors": [{"user_id": 0, "message_id": 0}]}
+      {"type": "error", "code": "...", "conversation_id": "...", ...}
+    """
+
+    async def connect(self):
+        self.user = self.scope["user"]
+        if self.user.is_anonymous:
+            await self.close()
+            return
+        self.subprotocol = protocol.negotiate(self.scope.get("subprotocols"))
+        self.subscriptions = set()
+        await self.accept(subprotocol=self.subprotocol)
+        await self.presence_connect()
+
+    async def disconnect(self, close_code):
+        for conversation_id in getattr(self, "subscriptions", ()):
+            await self.channel_layer.group_discard(group_name(conversation_id), self.channel_name)
+        await self.presence_disconnect()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if not await self.allow_frame():
+            return
+        try:
+            frame = protocol.decode(text_data, bytes_data)
+            frame_type = frame["type"]
+            if frame_type == "heartbeat":
+                conversation_id = None
+            else:
+                conversation_id = str(uuid.UUID(str(frame["conversation_id"])))
+        except (ValueError, KeyError, TypeError):
+            await self.send_error("invalid_frame")
+            return
+
+        if frame_type == "heartbeat":
+            await self.presence_heartbeat()
+        elif frame_type == "typing":
+            if conversation_id in self.subscriptions:
+                self.typing(conversation_id)
+            else:
+                await self.send_error("not_subscribed", conversation_id)
+        elif frame_type == "read":
+            message_id = parse_message_id(frame.get("message_id"))
+            if conversation_id not in self.subscriptions:
+                await self.send_error("not_subscribed", conversation_id)
+            elif message_id is None:
+                await self.send_error("invalid_frame", conversation_id)
+            else:
+                self.read(conversation_id, message_id)
+        elif frame_type == "subscribe":
+            last_seq = frame.get("last_seq")
+            if last_seq is not None and (not isinstance(last_seq, int) or isinstance(last_seq, bool) or last_seq < 0):
+                await self.send_error("invalid_frame", conversation_id)
+                return
+            await self.subscribe(conversation_id, last_seq)
+        elif frame_type == "unsubscribe":
+            await self.unsubscribe(conversation_id)
+        elif frame_type == "message":
+            if conversation_id not in self.subscriptions:
+                await self.send_error("not_subscribed", conversation_id)
+            elif not await membership.ais_member(conversation_id, self.user.id):
+                # 订阅期间被移出对话
+                await self.unsubscribe(conversation_id)
+                await self.send_error("forbidden", conversation_id)
+            elif not isinstance(frame.get("message"), str):
+                await self.send_error("invalid_frame", conversation_id)
+            else:
+                await self.publish(conversation_id, frame["message"])
+        else:
+            await self.send_error("invalid_frame", conversation_id)
+
+    async def subscribe(self, conversation_id, last_seq=None):
+        if conversation_id not in self.subscriptions:
+            if len(self.subscriptions) >= settings.IM_MAX_SUBSCRIPTIONS:
+                await self.send_error("too_many_subscriptions", conversation_id)
+                return
+            if not await membership.ais_member(conversation_id, self.user.id):
+                await self.send_error("forbidden", conversation_id)
+                return
+            await self.channel_layer.group_add(group_name(conversation_id), self.channel_name)
+            self.subscriptions.add(conversation_id)
+        await self.send_frame({"type": "subscribed", "conversation_id": conversation_id})
+        if last_seq is not None:
+            await self.resume(conversation_id, last_seq)
+
+    async def unsubscribe(self, conversation_id):
+        if conversation_id in self.subscriptions:
+            self.subscriptions.discard(conversation_id)
+            await self.channel_layer.group_discard(group_name(conversation_id), self.channel_name)
+        await self.send_frame({"type": "unsubscribed", "conversation_id": conversation_id})
+
+    async def send_error(self, code, conversation_id=None):
+        await self.send_frame(self.error_frame(code, conversation_id))
+
+    def message_frame(self, conversation_id, message):
+        return {"type": "message", "conversation_id": str(conversation_id), "message": message}
+
+    def error_frame(self, code, conversation_id, **extra):
+        return {"type": "error", "code": code, "conversation_id": conversation_id, **extra}
+
+    def presence_frame(self, event):
+        return {
+            "type": "presence",
+            "conversation_id": event["conversation_id"],
+            "online": event["online"],
+            "offline": event["offline"],
+            "typing": event["typing"],
+        }
+
+    def read_frame(self, event):
+        return {"type": "read", "conversation_id": event["conversation_id"], "cursors": event["cursors"]}
+
+    async def chat_message(self, event):
+        await self.forward(event["multiplex_text"], event["multiplex_bytes"])
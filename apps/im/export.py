@@ -0,0 +1,60 @@
+"""
+对话历史的流式 NDJSON 导出
+
+消息按 (timestamp, id) 顺序通过数据库服务端游标分块读取，每块编码为若干行 JSON 后立即输出，
+内存占用只与块大小有关。ASGI 下 StreamingHttpResponse 需要异步迭代器，否则会先把同步迭代器整体读入内存再发送，
+因此同时提供同步与异步两个版本。
+"""
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+FIELDS = ("id", "seq", "conversation_id", "sender_id", "sender__username", "content", "timestamp")
+
+
+def _encode(row) -> bytes:
+    message = {
+        "id": row["id"],
+        "seq": row["seq"],
+        "conversation": row["conversation_id"],
+        "sender": {"id": row["sender_id"], "username": row["sender__username"]},
+        "content": row["content"],
+        "timestamp": row["timestamp"],
+    }
+    return json.dumps(message, cls=DjangoJSONEncoder, ensure_ascii=False).encode() + b"\n"
+
+
+def _rows(queryset):
+    # values() 而非 values_list()：后者的 aiterator() 会在事件循环中同步执行查询
+    return queryset.order_by("timestamp", "id").values(*FIELDS)
+
+
+def iter_ndjson(queryset, chunk_size=None):
+    """
+    :param queryset: 待导出的消息
+    :param chunk_size: 每次从游标读取并输出的条数，默认 MESSAGE_EXPORT_CHUNK_SIZE
+    :return: 字节块的迭代器，每块包含若干行
+    """
+    chunk_size = chunk_size or settings.MESSAGE_EXPORT_CHUNK_SIZE
+    lines = []
+    for row in _rows(queryset).iterator(chunk_size=chunk_size):
+        lines.append(_encode(row))
+        if len(lines) >= chunk_size:
+            yield b"".join(lines)
+            lines.clear()
+    if lines:
+        yield b"".join(lines)
+
+
+async def aiter_ndjson(queryset, chunk_size=None):
+    """iter_ndjson 的异步版本，供 ASGI 下的 StreamingHttpResponse 使用"""
+    chunk_size = chunk_size or settings.MESSAGE_EXPORT_CHUNK_SIZE
+    lines = []
+    async for row in _rows(queryset).aiterator(chunk_size=chunk_size):
+        lines.append(_encode(row))
+        if len(lines) >= chunk_size:
+            yield b"".join(lines)
+            lines.clear()
+    if lines:
+        yield b"".join(lines)
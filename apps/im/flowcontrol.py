@@ -0,0 +1,104 @@
+"""
+WebSocket 流量控制
+
+  - 限流：每个连接、每个用户（进程内）各一个令牌桶，客户端帧同时消耗两者的令牌，任一不足时丢弃该帧并返回 rate_limited 错误
+  - 背压：发往客户端的帧先进入连接的发送队列，由单独的任务写出；客户端读取过慢、队列积压超过 IM_OUTBOX_HIGH_WATER 帧时
+    关闭连接（关闭码 1013，客户端稍后重连并按 last_seq 补发），而不是无限缓冲
+  - 计数：限流丢弃的帧数与因读取过慢被关闭的连接数，先在进程内累计，每秒至多一次 HINCRBY 到 Redis，由 staff 接口查询
+"""
+import asyncio
+import logging
+from collections import Counter
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from core.db import database_sync_to_async
+from utils.lru import LRUCache
+from utils.token_bucket import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+COUNTERS_KEY = "im:flowcontrol:counters"
+THROTTLED_FRAMES = "throttled_frames"
+SLOW_CONSUMERS = "slow_consumers"
+
+# 1013 Try Again Later
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+# 计数写入 Redis 的最短间隔（秒）
+FLUSH_INTERVAL = 1
+
+# 用户的令牌桶：长时间不活跃的用户被淘汰后令牌桶重新装满
+_user_buckets = LRUCache(maxsize=10000, ttl=300)
+
+_pending = Counter()
+_flush_task = None
+
+
+def connection_bucket():
+    """新连接的令牌桶，IM_RATE_LIMIT_RATE 为 0 时不限流"""
+    if not settings.IM_RATE_LIMIT_RATE:
+        return None
+    return TokenBucket(settings.IM_RATE_LIMIT_RATE, settings.IM_RATE_LIMIT_BURST)
+
+
+def _user_bucket(user_id):
+    bucket = _user_buckets.get(user_id)
+    if bucket is None:
+        bucket = TokenBucket(settings.IM_USER_RATE_LIMIT_RATE, settings.IM_USER_RATE_LIMIT_BURST)
+        _user_buckets.set(user_id, bucket)
+    return bucket
+
+
+def allow(bucket, user_id) -> bool:
+    """
+    客户端帧是否允许处理
+    :param bucket: 连接的令牌桶（connection_bucket 的返回值）
+    :param user_id: 用户 ID
+    :return:
+    """
+    if bucket is not None and not bucket.consume():
+        record(THROTTLED_FRAMES)
+        return False
+    if settings.IM_USER_RATE_LIMIT_RATE and not _user_bucket(user_id).consume():
+        record(THROTTLED_FRAMES)
+        return False
+    return True
+
+
+def record(name, amount=1):
+    """在事件循环中累计计数，稍后批量写入 Redis"""
+    global _flush_task
+    _pending[name] += amount
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_later())
+
+
+def _write(counts):
+    pipe = get_redis_connection("default").pipeline(transaction=False)
+    for name, count in counts.items():
+        pipe.hincrby(COUNTERS_KEY, name, count)
+    pipe.execute()
+
+
+async def _flush_later():
+    await asyncio.sleep(FLUSH_INTERVAL)
+    counts = dict(_pending)
+    _pending.clear()
+    try:
+        await database_sync_to_async(_write)(counts)
+    except RedisError as e:
+        logger.warning(f"Failed to write flow control counters {counts}: {e}")
+
+
+def get_counters() -> dict:
+    try:
+        counters = get_redis_connection("default").hgetall(COUNTERS_KEY)
+    except RedisError as e:
+        logger.warning(f"Failed to read flow control counters: {e}")
+        counters = {}
+    result = {THROTTLED_FRAMES: 0, SLOW_CONSUMERS: 0}
+    result.update({name.decode(): int(count) for name, count in counters.items()})
+    return result
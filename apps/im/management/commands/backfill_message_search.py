@@ -0,0 +1,46 @@
+import time
+
+from django.contrib.postgres.search import SearchVector
+from django.core.management.base import BaseCommand
+from im.models import SEARCH_CONFIG
+from im.models import Message
+
+
+class Command(BaseCommand):
+    help = "Backfill full-text search vectors of existing messages in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="每批回填的消息条数")
+        parser.add_argument("--sleep", type=float, default=0.0, help="每批之间暂停的秒数，降低对线上库的压力")
+
+    def handle(self, *args, **options):
+        """
+        按主键顺序分批回填 search_vector。
+        每批是一个独立的短事务，只锁定本批的行，不会长时间锁表；中断后重新执行即可继续
+        :param args:
+        :param options:
+        :return:
+        """
+        batch_size = options["batch_size"]
+        last_id = 0
+        total = 0
+
+        while True:
+            ids = list(
+                Message.objects.filter(id__gt=last_id, search_vector__isnull=True)
+                .order_by("id")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+
+            total += Message.objects.filter(id__in=ids).update(
+                search_vector=SearchVector("content", config=SEARCH_CONFIG)
+            )
+            last_id = ids[-1]
+            self.stdout.write(f"Backfilled {total} messages (last id {last_id})")
+
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+
+        self.stdout.write(self.style.SUCCESS(f"Successfully backfilled search vectors of {total} messages"))
@@ -0,0 +1,69 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+from im.models import Message
+
+# 本批消息在各自对话内按 ID 编号，起点为该对话中本批之前最后一条消息的序号（之前的消息已按 ID 顺序回填）
+BACKFILL_BATCH_SQL = """
+WITH batch AS (
+    SELECT id, conversation_id, ROW_NUMBER() OVER (PARTITION BY conversation_id ORDER BY id) AS position
+    FROM {table}
+    WHERE id = ANY(%s)
+), base AS (
+    SELECT first.conversation_id, COALESCE((
+        SELECT earlier.seq FROM {table} AS earlier
+        WHERE earlier.conversation_id = first.conversation_id AND earlier.id < first.id
+        ORDER BY earlier.id DESC
+        LIMIT 1
+    ), 0) AS seq
+    FROM (SELECT conversation_id, MIN(id) AS id FROM batch GROUP BY conversation_id) AS first
+)
+UPDATE {table} AS message
+SET seq = base.seq + batch.position
+FROM batch JOIN base ON base.conversation_id = batch.conversation_id
+WHERE message.id = batch.id
+"""
+
+
+class Command(BaseCommand):
+    help = "Backfill per-conversation sequence numbers of existing messages in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="每批回填的消息条数")
+        parser.add_argument("--sleep", type=float, default=0.0, help="每批之间暂停的秒数，降低对线上库的压力")
+
+    def handle(self, *args, **options):
+        """
+        按主键顺序分批回填迁移 0012 之前写入的消息的 seq，与迁移中设置的 Conversation.last_seq（已有消息数）衔接。
+        每批是一个独立的短事务，只锁定本批的行；已回填的消息不会重复处理，中断后重新执行即可继续。
+        应在停止旧版本写入之后执行：旧版本写入的消息没有 seq，且不计入 last_seq
+        :param args:
+        :param options:
+        :return:
+        """
+        batch_size = options["batch_size"]
+        sql = BACKFILL_BATCH_SQL.format(table=connection.ops.quote_name(Message._meta.db_table))
+        last_id = 0
+        total = 0
+
+        while True:
+            ids = list(
+                Message.objects.filter(id__gt=last_id, seq__isnull=True)
+                .order_by("id")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(sql, [ids])
+                total += cursor.rowcount
+            last_id = ids[-1]
+            self.stdout.write(f"Backfilled {total} messages (last id {last_id})")
+
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+
+        self.stdout.write(self.style.SUCCESS(f"Successfully backfilled sequence numbers of {total} messages"))
@@ -0,0 +1,99 @@
+import asyncio
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.backends.signals import connection_created
+from im.models import Conversation
+from im.models import ConversationMember
+from im.models import Message
+
+
+class Command(BaseCommand):
+    help = "Compare messages/sec of the database paths available to async WebSocket consumers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=100, help="并发连接数")
+        parser.add_argument("--messages", type=int, default=2000, help="每种方式写入的消息总数")
+        parser.add_argument("--threads", type=int, default=settings.ASYNC_DB_THREADS, help="数据库线程池大小")
+        parser.add_argument(
+            "--latency-ms",
+            type=float,
+            default=0,
+            help="每次查询额外等待的毫秒数，模拟与数据库之间的网络往返（释放 GIL）",
+        )
+
+    def handle(self, *args, **options):
+        """
+        在一个事件循环中模拟 connections 个连接并发发送消息，每条消息执行一次成员校验与一次写入，对比：
+          - database_sync_to_async：channels 默认，thread_sensitive=True，所有调用在同一个线程中执行
+          - async ORM：aexists / acreate，Django 内部同样是 sync_to_async(thread_sensitive=True)
+          - thread pool：core.db.database_sync_to_async，固定 threads 个线程
+        数据库在本机时查询几乎不等待 I/O，差异主要来自 CPU 核数；--latency-ms 模拟远程数据库的网络往返。
+        使用临时的用户与对话，结束后删除
+        :param args:
+        :param options:
+        :return:
+        """
+        user = get_user_model().objects.create_user(username=f"benchmark-{uuid.uuid4().hex[:8]}")
+        conversation = Conversation.objects.create(name="benchmark")
+        conversation.participants.add(user)
+        try:
+            executor = ThreadPoolExecutor(max_workers=options["threads"])
+            latency = options["latency_ms"] / 1000
+
+            def execute(execute, sql, params, many, context):
+                time.sleep(latency)
+                return execute(sql, params, many, context)
+
+            def add_latency(sender, connection, **kwargs):
+                # 各执行线程使用各自的数据库连接，在连接创建时加入模拟延迟
+                connection.execute_wrappers.append(execute)
+
+            def work(conversation_id, user_id, content):
+                if ConversationMember.objects.filter(conversation_id=conversation_id, user_id=user_id).exists():
+                    Message.objects.create(conversation_id=conversation_id, sender_id=user_id, content=content)
+
+            async def async_orm(conversation_id, user_id, content):
+                if await ConversationMember.objects.filter(conversation_id=conversation_id, user_id=user_id).aexists():
+                    await Message.objects.acreate(conversation_id=conversation_id, sender_id=user_id, content=content)
+
+            paths = {
+                "database_sync_to_async": DatabaseSyncToAsync(work),
+                "async ORM": async_orm,
+                f"thread pool ({options['threads']} threads)": DatabaseSyncToAsync(
+                    work, thread_sensitive=False, executor=executor
+                ),
+            }
+            if latency:
+                connection_created.connect(add_latency)
+            try:
+                for name, path in paths.items():
+                    rate = asyncio.run(
+                        self.run(path, conversation.id, user.id, options["connections"], options["messages"])
+                    )
+                    self.stdout.write(f"{name}: {rate:.0f} messages/sec")
+            finally:
+                connection_created.disconnect(add_latency)
+                executor.shutdown()
+                connections.close_all()
+        finally:
+            conversation.delete()
+            user.delete()
+
+    @staticmethod
+    async def run(path, conversation_id, user_id, connections, messages):
+        per_connection = max(messages // connections, 1)
+
+        async def connection(index):
+            for i in range(per_connection):
+                await path(conversation_id, user_id, f"{index}-{i}")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(connection(index) for index in range(connections)))
+        return per_connection * connections / (time.perf_counter() - started)
@@ -0,0 +1,65 @@
+import json
+import time
+import uuid
+
+from channels_redis.serializers import registry
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from im.consumers import message_event
+
+
+class Command(BaseCommand):
+    help = "Measure the CPU cost of fanning out one chat message to a group"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, default=1000, help="群组成员数（接收消息的连接数）")
+        parser.add_argument("--rounds", type=int, default=20, help="重复次数，取平均值")
+        parser.add_argument("--size", type=int, default=200, help="消息内容长度（字符）")
+
+    def handle(self, *args, **options):
+        """
+        在进程内模拟 channels_redis 的群组广播：每个接收者一次 msgpack 编码（发送端）与一次解码（接收端），
+        对比接收端重新 json.dumps 消息（旧）与直接转发预编码帧（新）的 CPU 耗时，不连接 Redis
+        :param args:
+        :param options:
+        :return:
+        """
+        serializer = registry.get_serializer("msgpack")
+        members, rounds = options["members"], options["rounds"]
+        conversation_id = str(uuid.uuid4())
+        message = {
+            "id": 1,
+            "sender": {"id": 1, "username": "alice"},
+            "content": "x" * options["size"],
+            "timestamp": timezone.now(),
+            "is_read": False,
+        }
+
+        def per_receiver_encode():
+            legacy = {**message, "timestamp": message["timestamp"].isoformat()}
+            event = {"type": "chat_message", "conversation_id": conversation_id, "message": legacy}
+            for _ in range(members):
+                received = serializer.deserialize(serializer.serialize(event))
+                json.dumps({"message": received["message"]})
+
+        def pre_encoded():
+            event = message_event(conversation_id, message)
+            for _ in range(members):
+                received = serializer.deserialize(serializer.serialize(event))
+                received["text"]
+
+        results = {}
+        for name, fanout in (("per-receiver json.dumps", per_receiver_encode), ("pre-encoded frames", pre_encoded)):
+            started = time.process_time()
+            for _ in range(rounds):
+                fanout()
+            results[name] = (time.process_time() - started) / rounds
+            self.stdout.write(f"{name}: {results[name] * 1000:.2f} ms CPU per fan-out to {members} members")
+
+        before, after = results.values()
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Saved {(before - after) * 1000:.2f} ms CPU per fan-out "
+                f"({(before - after) / before:.0%}, {(before - after) / members * 1e6:.2f} µs per member)"
+            )
+        )
@@ -1,22 +1,46 @@
+from datetime import timedelta
+
 from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from im.models import Message
+from im import retention
 
 
 class Command(BaseCommand):
     help = "Clean up messages older than the retention period"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=None, help="保留天数，默认 MESSAGE_RETENTION_DAYS")
+        parser.add_argument(
+            "--batch-size", type=int, default=None, help="每批删除的条数，默认 MESSAGE_RETENTION_BATCH_SIZE"
+        )
+        parser.add_argument(
+            "--rows-per-second",
+            type=int,
+            default=None,
+            help="每秒最多删除的条数，0 为不限速，默认 MESSAGE_RETENTION_ROWS_PER_SECOND",
+        )
+        parser.add_argument("--dry-run", action="store_true", help="只统计将被删除的分区与消息条数，不执行删除")
+        parser.add_argument("--no-archive", action="store_true", help="删除前不写入冷归档")
+        parser.add_argument("--no-resume", action="store_true", help="忽略上次中断保存的进度，从头开始")
+
     def handle(self, *args, **options):
         """
-        这里只是演示Django创建一个自定义管理命令
+        与定时任务 cleanup_old_messages 共用 im.retention 的清理逻辑
         :param args:
         :param options:
         :return:
         """
-        retention_days = settings.MESSAGE_RETENTION_DAYS
-        cutoff_date = timezone.now() - timezone.timedelta(days=retention_days)
-
-        deleted_count, _ = Message.objects.filter(timestamp__lt=cutoff_date).delete()
+        days = settings.MESSAGE_RETENTION_DAYS if options["days"] is None else options["days"]
+        result = retention.purge_expired_messages(
+            cutoff=timezone.now() - timedelta(days=days),
+            batch_size=options["batch_size"],
+            rows_per_second=options["rows_per_second"],
+            dry_run=options["dry_run"],
+            resume=not options["no_resume"],
+            archive=False if options["no_archive"] else None,
+            log=self.stdout.write,
+        )
 
-        self.stdout.write(self.style.SUCCESS(f"Successfully deleted {deleted_count} old messages"))
+        verb = "Would delete" if options["dry_run"] else "Successfully deleted"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {result['deleted']} old messages"))
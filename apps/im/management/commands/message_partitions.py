@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.utils import timezone
+from im import partitions
+
+
+class Command(BaseCommand):
+    help = "Manage time-based range partitions of the message table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "action",
+            choices=["convert", "create", "drop-expired", "list"],
+            help="convert: 将 im_message 转换为分区表；create: 提前创建未来的分区；"
+            "drop-expired: 删除超出保留期的分区；list: 列出分区",
+        )
+        parser.add_argument("--ahead", type=int, default=None, help="提前创建的周期数，默认 MESSAGE_PARTITION_PREMAKE")
+        parser.add_argument("--dry-run", action="store_true", help="drop-expired 时只列出将被删除的分区")
+
+    def handle(self, *args, **options):
+        action = options["action"]
+
+        if action == "convert":
+            if partitions.is_partitioned():
+                raise CommandError("The message table is already partitioned")
+            boundary = partitions.convert_table()
+            self.stdout.write(
+                self.style.SUCCESS(f"Converted to a partitioned table, legacy partition ends at {boundary}")
+            )
+            return
+
+        if not partitions.is_partitioned():
+            raise CommandError("The message table is not partitioned, run `message_partitions convert` first")
+
+        if action == "create":
+            created = partitions.create_partitions(ahead=options["ahead"])
+            self.stdout.write(self.style.SUCCESS(f"Created {len(created)} partitions: {', '.join(created)}"))
+        elif action == "drop-expired":
+            cutoff = timezone.now() - timedelta(days=settings.MESSAGE_RETENTION_DAYS)
+            dropped = partitions.drop_expired_partitions(cutoff, dry_run=options["dry_run"])
+            verb = "Would drop" if options["dry_run"] else "Dropped"
+            self.stdout.write(self.style.SUCCESS(f"{verb} {len(dropped)} partitions: {', '.join(dropped)}"))
+        else:
+            for name, upper, detach_pending in partitions.list_partitions():
+                suffix = " (detach pending)" if detach_pending else ""
+                self.stdout.write(f"{name}\tupper={upper}{suffix}")
@@ -0,0 +1,236 @@
+"""
+对话成员缓存
+
+成员关系按对话缓存为 Redis set（im:members:{conversation_id}），前面再加一层短时的进程内 LRU：
+  - 进程内命中时不访问 Redis 与数据库，WebSocket 断线重连高峰时不会把成员查询压到 PostgreSQL
+  - Redis 未命中时从数据库加载整个对话的成员并回填。回填与失效可能并发：每次失效递增对话的版本号
+    （im:members:{conversation_id}:generation），回填前读取版本号，只有版本号未变且 set 仍不存在时才写入（Lua 脚本原子判断），
+    避免把失效前读到的成员写回缓存、或与其它回填合并
+  - 成员变化（ConversationMember 保存/删除、participants 的 add/remove/clear）在事务提交后删除 Redis 缓存与本进程的 LRU 条目；
+    其它进程的 LRU 条目在 IM_MEMBERSHIP_LOCAL_TTL 秒内自然过期
+用户所在的对话 ID（im:members:user:{user_id}，上下线时据此通知各对话）以相同的方式缓存、回填与失效。
+成员变化同时刷新 Conversation.updated_at，使对话列表与详情的 ETag 失效（见 im.conditional）。
+Redis 不可用时直接查询数据库。
+"""
+import logging
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from core.db import database_sync_to_async
+from utils.lru import LRUCache
+
+from .models import Conversation
+from .models import ConversationMember
+
+logger = logging.getLogger(__name__)
+
+MEMBERS_KEY = "im:members:{conversation_id}"
+GENERATION_KEY = "im:members:{conversation_id}:generation"
+USER_CONVERSATIONS_KEY = "im:members:user:{user_id}"
+USER_GENERATION_KEY = "im:members:user:{user_id}:generation"
+# set 中的占位成员：区分“已缓存但没有成员”与“未缓存”
+_PLACEHOLDER = "-"
+
+# KEYS[1]: 成员 set；KEYS[2]: 版本号；ARGV[1]: 读取数据库前的版本号（不存在时为空字符串）；ARGV[2]: 过期时间；
+# ARGV[3...]: 成员（含占位成员）
+_FILL = """
+if (redis.call("GET", KEYS[2]) or "") ~= ARGV[1] or redis.call("EXISTS", KEYS[1]) == 1 then
+    return 0
+end
+for i = 3, #ARGV, 1000 do
+    redis.call("SADD", KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call("EXPIRE", KEYS[1], ARGV[2])
+return 1
+"""
+
+_local = LRUCache(maxsize=settings.IM_MEMBERSHIP_LOCAL_SIZE, ttl=settings.IM_MEMBERSHIP_LOCAL_TTL)
+_user_local = LRUCache(maxsize=settings.IM_MEMBERSHIP_LOCAL_SIZE, ttl=settings.IM_MEMBERSHIP_LOCAL_TTL)
+
+
+def _key(conversation_id) -> str:
+    return MEMBERS_KEY.format(conversation_id=conversation_id)
+
+
+def _generation_key(conversation_id) -> str:
+    return GENERATION_KEY.format(conversation_id=conversation_id)
+
+
+def _user_key(user_id) -> str:
+    return USER_CONVERSATIONS_KEY.format(user_id=user_id)
+
+
+def _user_generation_key(user_id) -> str:
+    return USER_GENERATION_KEY.format(user_id=user_id)
+
+
+def _load(conversation_id) -> frozenset:
+    return frozenset(
+        ConversationMember.objects.filter(conversation_id=conversation_id).values_list("user_id", flat=True)
+    )
+
+
+def _load_conversation_ids(user_id) -> frozenset:
+    return frozenset(
+        str(conversation_id)
+        for conversation_id in ConversationMember.objects.filter(user_id=user_id).values_list(
+            "conversation_id", flat=True
+        )
+    )
+
+
+def _cached(local, local_key, key, generation_key, load, parse) -> frozenset:
+    """
+    读取缓存的集合：进程内缓存 → Redis → 数据库（带版本号校验的回填）
+    :param local: 进程内缓存
+    :param local_key: 进程内缓存的键
+    :param key: Redis set 的键
+    :param generation_key: 版本号的键
+    :param load: 从数据库加载集合
+    :param parse: 将 set 中的成员转换为集合元素
+    :return:
+    """
+    cached = local.get(local_key)
+    if cached is not None:
+        return cached
+
+    cacheable = True
+    try:
+        redis = get_redis_connection("default")
+        pipe = redis.pipeline(transaction=False)
+        pipe.smembers(key)
+        pipe.get(generation_key)
+        values, generation = pipe.execute()
+        if values:
+            result = frozenset(parse(value) for value in values if value != _PLACEHOLDER.encode())
+        else:
+            result = load()
+            # 回填被放弃时结果可能已过期，同样不写入进程内缓存
+            cacheable = redis.register_script(_FILL)(
+                keys=[key, generation_key],
+                args=[generation or b"", settings.IM_MEMBERSHIP_CACHE_TTL, _PLACEHOLDER, *result],
+            )
+    except RedisError as e:
+        logger.warning(f"Membership cache unavailable, falling back to database: {e}")
+        result = load()
+
+    if cacheable:
+        local.set(local_key, result)
+    return result
+
+
+def members(conversation_id) -> frozenset:
+    """
+    对话的成员 ID 集合
+    :param conversation_id: 对话 ID
+    :return:
+    """
+    conversation_id = str(conversation_id)
+    return _cached(
+        _local,
+        conversation_id,
+        _key(conversation_id),
+        _generation_key(conversation_id),
+        lambda: _load(conversation_id),
+        int,
+    )
+
+
+def conversation_ids(user_id) -> frozenset:
+    """
+    用户所在的对话 ID（字符串）集合
+    :param user_id: 用户 ID
+    :return:
+    """
+    user_id = str(user_id)
+    return _cached(
+        _user_local,
+        user_id,
+        _user_key(user_id),
+        _user_generation_key(user_id),
+        lambda: _load_conversation_ids(user_id),
+        bytes.decode,
+    )
+
+
+async def aconversation_ids(user_id) -> frozenset:
+    """conversation_ids 的异步版本：进程内缓存命中时直接在事件循环中返回，不占用线程池"""
+    cached = _user_local.get(str(user_id))
+    if cached is not None:
+        return cached
+    return await database_sync_to_async(conversation_ids)(user_id)
+
+
+def is_member(conversation_id, user_id) -> bool:
+    return user_id in members(conversation_id)
+
+
+async def ais_member(conversation_id, user_id) -> bool:
+    """is_member 的异步版本：进程内缓存命中时直接在事件循环中返回，不占用线程池"""
+    cached = _local.get(str(conversation_id))
+    if cached is not None:
+        return user_id in cached
+    return await database_sync_to_async(is_member)(conversation_id, user_id)
+
+
+def _invalidate(pipe, key, generation_key):
+    pipe.incr(generation_key)
+    pipe.expire(generation_key, settings.IM_MEMBERSHIP_CACHE_TTL)
+    pipe.delete(key)
+
+
+def invalidate(conversation_id, user_ids=()):
+    """
+    失效对话的成员缓存，以及成员变化涉及的用户的对话 ID 缓存
+    :param conversation_id: 对话 ID
+    :param user_ids: 加入或离开对话的用户 ID
+    :return:
+    """
+    conversation_id = str(conversation_id)
+    _local.delete(conversation_id)
+    user_ids = [str(user_id) for user_id in user_ids]
+    for user_id in user_ids:
+        _user_local.delete(user_id)
+    try:
+        pipe = get_redis_connection("default").pipeline()
+        _invalidate(pipe, _key(conversation_id), _generation_key(conversation_id))
+        for user_id in user_ids:
+            _invalidate(pipe, _user_key(user_id), _user_generation_key(user_id))
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Failed to invalidate membership cache of {conversation_id}: {e}")
+
+
+def _member_changed(conversation_id, user_ids):
+    user_ids = list(user_ids)
+    Conversation.objects.filter(pk=conversation_id).update(updated_at=timezone.now())
+    # 提交前失效会让其它请求把旧的成员关系重新读入缓存
+    transaction.on_commit(lambda: invalidate(conversation_id, user_ids))
+
+
+def on_member_saved(sender, instance, **kwargs):
+    _member_changed(instance.conversation_id, [instance.user_id])
+
+
+def on_participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # conversation.participants.add(...) / remove(...) / clear()
+        if action in ("post_add", "post_remove"):
+            _member_changed(instance.pk, pk_set)
+        elif action == "pre_clear":
+            # 清空后无法再得知涉及的用户，清空前记录
+            _member_changed(instance.pk, _load(instance.pk))
+    elif action == "pre_clear":
+        # user.conversations.clear()：清空后无法再得知涉及的对话，清空前记录
+        for conversation_id in ConversationMember.objects.filter(user=instance).values_list(
+            "conversation_id", flat=True
+        ):
+            _member_changed(conversation_id, [instance.pk])
+    elif action in ("post_add", "post_remove"):
+        # user.conversations.add(...) / remove(...)
+        for conversation_id in pk_set:
+            _member_changed(conversation_id, [instance.pk])
@@ -0,0 +1,88 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:34
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations
+from django.db import models
+
+# 审计字段随 core.models.BaseModel 改名：create_uid/update_uid → created_by/updated_by；
+# 先改字段名再改列名，保留已有的审计数据
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("im", "0001_initial"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name="conversation",
+            old_name="create_uid",
+            new_name="created_by",
+        ),
+        migrations.AlterField(
+            model_name="conversation",
+            name="created_by",
+            field=models.ForeignKey(
+                blank=True,
+                db_column="created_by",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="%(class)s_created_by",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.RenameField(
+            model_name="conversation",
+            old_name="update_uid",
+            new_name="updated_by",
+        ),
+        migrations.AlterField(
+            model_name="conversation",
+            name="updated_by",
+            field=models.ForeignKey(
+                blank=True,
+                db_column="updated_by",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="%(class)s_updated_by",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.RenameField(
+            model_name="message",
+            old_name="create_uid",
+            new_name="created_by",
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="created_by",
+            field=models.ForeignKey(
+                blank=True,
+                db_column="created_by",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="%(class)s_created_by",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.RenameField(
+            model_name="message",
+            old_name="update_uid",
+            new_name="updated_by",
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="updated_by",
+            field=models.ForeignKey(
+                blank=True,
+                db_column="updated_by",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="%(class)s_updated_by",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+    ]
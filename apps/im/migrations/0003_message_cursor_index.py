@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:34
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY 不能在事务中执行，避免建索引期间锁住 im_message 的写入
+    atomic = False
+
+    dependencies = [
+        ("im", "0002_audit_fields"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="message",
+            index=models.Index(fields=["conversation", "timestamp", "id"], name="im_message_conv_ts_id_idx"),
+        ),
+    ]
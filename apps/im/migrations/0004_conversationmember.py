@@ -0,0 +1,86 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("im", "0003_message_cursor_index"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # 复用 participants 自动生成的中间表 im_conversation_participants，只变更模型状态
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name="ConversationMember",
+                    fields=[
+                        (
+                            "id",
+                            models.BigAutoField(
+                                auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                            ),
+                        ),
+                        (
+                            "conversation",
+                            models.ForeignKey(
+                                on_delete=django.db.models.deletion.CASCADE,
+                                related_name="members",
+                                to="im.conversation",
+                                verbose_name="对话",
+                            ),
+                        ),
+                        (
+                            "user",
+                            models.ForeignKey(
+                                on_delete=django.db.models.deletion.CASCADE,
+                                related_name="conversation_memberships",
+                                to=settings.AUTH_USER_MODEL,
+                                verbose_name="用户",
+                            ),
+                        ),
+                    ],
+                    options={
+                        "verbose_name": "对话参与者",
+                        "verbose_name_plural": "对话参与者",
+                        "db_table": "im_conversation_participants",
+                        "unique_together": {("conversation", "user")},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name="conversation",
+                    name="participants",
+                    field=models.ManyToManyField(
+                        related_name="conversations",
+                        through="im.ConversationMember",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="参与者",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="conversationmember",
+            name="last_read_at",
+            field=models.DateTimeField(blank=True, null=True, verbose_name="最后已读时间"),
+        ),
+        migrations.AddField(
+            model_name="conversationmember",
+            name="last_read_message",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="+",
+                to="im.message",
+                verbose_name="最后已读消息",
+            ),
+        ),
+    ]
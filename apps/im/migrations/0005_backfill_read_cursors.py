@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:10
+
+from django.db import migrations
+
+# 以每个参与者在对话中已读的最大消息 ID 作为已读游标
+BACKFILL_READ_CURSORS = """
+UPDATE im_conversation_participants AS member
+SET last_read_message_id = read_state.max_message_id, last_read_at = NOW()
+FROM (
+    SELECT message.conversation_id, read_by.user_id, MAX(message.id) AS max_message_id
+    FROM im_message_read_by AS read_by
+    JOIN im_message AS message ON message.id = read_by.message_id
+    GROUP BY message.conversation_id, read_by.user_id
+) AS read_state
+WHERE member.conversation_id = read_state.conversation_id AND member.user_id = read_state.user_id;
+"""
+
+# 回滚时按游标重新展开逐条已读记录
+RESTORE_READ_BY = """
+INSERT INTO im_message_read_by (message_id, user_id)
+SELECT message.id, member.user_id
+FROM im_conversation_participants AS member
+JOIN im_message AS message
+    ON message.conversation_id = member.conversation_id AND message.id <= member.last_read_message_id;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("im", "0004_conversationmember"),
+    ]
+
+    operations = [
+        migrations.RunSQL(BACKFILL_READ_CURSORS, reverse_sql=RESTORE_READ_BY),
+        migrations.RemoveField(
+            model_name="message",
+            name="read_by",
+        ),
+    ]
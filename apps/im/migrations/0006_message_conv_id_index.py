@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:10
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+from django.db import models
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("im", "0005_backfill_read_cursors"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="message",
+            index=models.Index(fields=["conversation", "id"], name="im_message_conv_id_idx"),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:02
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+# 写入/更新消息时由触发器维护检索向量（bulk_create 等绕过模型 save 的写入同样生效）
+CREATE_TRIGGER = """
+CREATE TRIGGER im_message_search_vector_update
+BEFORE INSERT OR UPDATE OF content ON im_message
+FOR EACH ROW EXECUTE FUNCTION tsvector_update_trigger(search_vector, 'pg_catalog.simple', content);
+"""
+
+DROP_TRIGGER = "DROP TRIGGER IF EXISTS im_message_search_vector_update ON im_message;"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("im", "0006_message_conv_id_index"),
+    ]
+
+    operations = [
+        # 可空列，添加时不重写表；存量数据由 backfill_message_search 命令分批回填
+        migrations.AddField(
+            model_name="message",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(
+                editable=False, null=True, verbose_name="全文检索向量"
+            ),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, reverse_sql=DROP_TRIGGER),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 05:02
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("im", "0007_message_search_vector"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="message",
+            index=django.contrib.postgres.indexes.GinIndex(fields=["search_vector"], name="im_message_search_gin"),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:05
+
+from django.db import migrations
+from django.db import models
+from im.operations import AddPartitionedIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("im", "0008_message_search_gin"),
+    ]
+
+    operations = [
+        AddPartitionedIndexConcurrently(
+            model_name="message",
+            index=models.Index(fields=["timestamp", "id"], name="im_message_ts_id_idx"),
+        ),
+    ]
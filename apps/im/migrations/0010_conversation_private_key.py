@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:10
+
+from django.db import migrations
+from django.db import models
+
+# 已有的两人私聊回填 private_key；同一对用户存在多个私聊时只有最早创建的一个获得标识，其余保持为空
+BACKFILL_PRIVATE_KEYS = """
+UPDATE im_conversation AS conversation
+SET private_key = ranked.private_key
+FROM (
+    SELECT pair.id, pair.low || ':' || pair.high AS private_key,
+        ROW_NUMBER() OVER (PARTITION BY pair.low, pair.high ORDER BY pair.created_at, pair.id) AS position
+    FROM (
+        SELECT c.id, c.created_at, MIN(p.user_id) AS low, MAX(p.user_id) AS high
+        FROM im_conversation AS c
+        JOIN im_conversation_participants AS p ON p.conversation_id = c.id
+        WHERE NOT c.is_group
+        GROUP BY c.id, c.created_at
+        HAVING COUNT(*) = 2
+    ) AS pair
+) AS ranked
+WHERE conversation.id = ranked.id AND ranked.position = 1;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("im", "0009_message_ts_id_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversation",
+            name="private_key",
+            field=models.CharField(
+                blank=True, editable=False, max_length=64, null=True, unique=True, verbose_name="私聊标识"
+            ),
+        ),
+        migrations.RunSQL(BACKFILL_PRIVATE_KEYS, reverse_sql=migrations.RunSQL.noop),
+    ]
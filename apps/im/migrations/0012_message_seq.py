@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:01
+
+from django.db import migrations
+from django.db import models
+
+# 对话的 last_seq 设为已有消息数，之后写入的消息从其后继续编号；
+# 已有消息的 seq 由 backfill_message_seq 命令按 ID 顺序分批回填（1..消息数），不在迁移中重写整张消息表
+SET_LAST_SEQ = """
+UPDATE im_conversation AS conversation
+SET last_seq = counted.count
+FROM (SELECT conversation_id, COUNT(*) AS count FROM im_message GROUP BY conversation_id) AS counted
+WHERE conversation.id = counted.conversation_id;
+"""
+
+
+class Migration(migrations.Migration):
+    # 添加字段后立即提交，统计消息数时不持有消息表的 ACCESS EXCLUSIVE 锁
+    atomic = False
+
+    dependencies = [
+        ("im", "0011_message_timestamp_default"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="conversation",
+            name="last_seq",
+            field=models.BigIntegerField(default=0, editable=False, verbose_name="最后消息序号"),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="seq",
+            field=models.BigIntegerField(editable=False, null=True, verbose_name="对话内序号"),
+        ),
+        migrations.RunSQL(SET_LAST_SEQ, reverse_sql=migrations.RunSQL.noop),
+    ]
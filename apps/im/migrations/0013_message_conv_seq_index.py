@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:02
+
+from django.db import migrations
+from django.db import models
+from im.operations import AddPartitionedIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ("im", "0012_message_seq"),
+    ]
+
+    operations = [
+        AddPartitionedIndexConcurrently(
+            model_name="message",
+            index=models.Index(fields=["conversation", "seq"], name="im_message_conv_seq_idx"),
+        ),
+    ]
@@ -1,18 +1,118 @@
 import uuid
 
 from django.contrib.auth import get_user_model
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery
+from django.contrib.postgres.search import SearchRank
+from django.contrib.postgres.search import SearchVectorField
+from django.db import connection
 from django.db import models
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import OuterRef
+from django.db.models import Q
+from django.db.models import Subquery
+from django.db.models import Value
+from django.db.models import Window
+from django.db.models.functions import Cast
+from django.db.models.functions import Coalesce
+from django.db.models.functions import Greatest
+from django.db.models.functions import RowNumber
+from django.utils import timezone
 
 from core.models import BaseModel
 
 User = get_user_model()
 
+# 全文检索使用的 PostgreSQL 文本搜索配置，需与迁移 0007 中触发器使用的配置一致
+SEARCH_CONFIG = "simple"
+
+
+class ConversationQuerySet(models.QuerySet):
+    def with_summary(self, user):
+        """
+        以子查询注解最后一条消息 ID、当前用户的已读游标与未读数，并预取参与者。
+        查询次数与对话数量无关，供对话列表/详情序列化使用
+        :param user: 当前用户
+        :return:
+        """
+        latest_message = Message.objects.filter(conversation=OuterRef("pk")).order_by("-timestamp", "-id")
+        read_cursor = ConversationMember.objects.filter(conversation=OuterRef("pk"), user=user)
+        unread_count = (
+            Message.objects.filter(conversation=OuterRef("pk"), id__gt=Coalesce(OuterRef("read_cursor"), Value(0)))
+            .order_by()
+            .values("conversation")
+            .annotate(count=Count("id"))
+            .values("count")
+        )
+        return (
+            self.annotate(
+                latest_message_id=Subquery(latest_message.values("id")[:1]),
+                read_cursor=Subquery(read_cursor.values("last_read_message_id")[:1]),
+            )
+            .annotate(unread_count=Coalesce(Subquery(unread_count), 0))
+            .prefetch_related("participants")
+        )
+
+    def get_or_create_private(self, user, other, name=""):
+        """
+        查找或创建两个用户之间的私聊：按 private_key 唯一索引查找，并发创建时由唯一约束保证只有一个成功
+        :param user: 用户
+        :param other: 另一个用户
+        :param name: 新建时使用的名称
+        :return: (conversation, created)
+        """
+        with transaction.atomic():
+            conversation, created = self.get_or_create(
+                private_key=Conversation.make_private_key(user.pk, other.pk),
+                defaults={"name": name, "is_group": False},
+            )
+            if created:
+                conversation.participants.add(user, other)
+        return conversation, created
+
+    def allocate_seq(self, conversation_id, count=1, updated_at=None):
+        """
+        为对话分配 count 个连续的消息序号：一条 UPDATE ... RETURNING 递增 last_seq。
+        行锁持有到事务结束，同一对话的并发写入按序号顺序串行；事务回滚时序号随之回退，序号保持连续
+        :param conversation_id: 对话 ID
+        :param count: 分配的个数
+        :param updated_at: 同时刷新的对话版本（updated_at），为 None 时不修改
+        :return: 分配的最后一个序号，分配的序号为 (返回值 - count, 返回值]
+        """
+        table = self.model._meta.db_table
+        if updated_at is None:
+            sql, params = f"UPDATE {table} SET last_seq = last_seq + %s WHERE id = %s RETURNING last_seq", [
+                count,
+                conversation_id,
+            ]
+        else:
+            sql = f"UPDATE {table} SET last_seq = last_seq + %s, updated_at = %s WHERE id = %s RETURNING last_seq"
+            params = [count, updated_at, conversation_id]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        if row is None:
+            raise self.model.DoesNotExist(f"Conversation {conversation_id} does not exist")
+        return row[0]
+
 
 class Conversation(BaseModel):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False, unique=True, db_index=True)
     name = models.CharField(max_length=255, verbose_name="名称")
-    participants = models.ManyToManyField(User, related_name="conversations", verbose_name="参与者")
+    participants = models.ManyToManyField(
+        User, through="ConversationMember", related_name="conversations", verbose_name="参与者"
+    )
     is_group = models.BooleanField(default=False, verbose_name="是否为群聊")
+    # 私聊的参与者标识 "<较小用户 ID>:<较大用户 ID>"，群聊为空；唯一索引保证两人之间只有一个私聊
+    private_key = models.CharField(
+        max_length=64, null=True, blank=True, unique=True, editable=False, verbose_name="私聊标识"
+    )
+    # 最后分配的消息序号，见 ConversationQuerySet.allocate_seq
+    last_seq = models.BigIntegerField(default=0, editable=False, verbose_name="最后消息序号")
+
+    objects = ConversationQuerySet.as_manager()
 
     class Meta:
         verbose_name = "对话"
@@ -21,6 +121,189 @@ class Conversation(BaseModel):
     def __str__(self):
         return self.name
 
+    @staticmethod
+    def make_private_key(user_id, other_id):
+        return f"{min(user_id, other_id)}:{max(user_id, other_id)}"
+
+
+class ConversationMemberQuerySet(models.QuerySet):
+    def with_unread_count(self):
+        """
+        注解每个成员在其对话中的未读数（ID 大于已读游标的消息数）
+        :return:
+        """
+        unread_count = (
+            Message.objects.filter(
+                conversation=OuterRef("conversation"), id__gt=Coalesce(OuterRef("last_read_message_id"), Value(0))
+            )
+            .order_by()
+            .values("conversation")
+            .annotate(count=Count("id"))
+            .values("count")
+        )
+        return self.annotate(unread_count=Coalesce(Subquery(unread_count), 0))
+
+    def advance_read_cursor(self, conversation_id, user_id, message_id):
+        """
+        将用户在对话中的已读游标推进到 message_id（游标只前进不后退）
+        :param conversation_id: 对话 ID
+        :param user_id: 用户 ID
+        :param message_id: 已读到的消息 ID
+        :return: 游标是否发生了推进
+        """
+        return bool(
+            self.filter(conversation_id=conversation_id, user_id=user_id)
+            .filter(Q(last_read_message__isnull=True) | Q(last_read_message_id__lt=message_id))
+            .update(last_read_message_id=message_id, last_read_at=timezone.now())
+        )
+
+    def mark_read(self, conversation_id, user_id, message_ids=None, up_to=None):
+        """
+        批量标记已读：一条 UPDATE 完成成员校验与游标推进。
+        游标推进到给定消息（或 up_to 之前，或整个对话）中属于该对话的最大消息 ID，只前进不后退
+        :param conversation_id: 对话 ID
+        :param user_id: 用户 ID
+        :param message_ids: 已读的消息 ID 列表
+        :param up_to: 已读到的消息 ID（包含）
+        :return: 用户是否为对话参与者
+        """
+        target = Message.objects.filter(conversation_id=conversation_id)
+        if message_ids is not None:
+            target = target.filter(id__in=message_ids)
+        if up_to is not None:
+            target = target.filter(id__lte=up_to)
+        target = target.order_by("-id").values("id")[:1]
+
+        # PostgreSQL 的 GREATEST 忽略 NULL：目标不存在时保持原游标
+        return bool(
+            self.filter(conversation_id=conversation_id, user_id=user_id).update(
+                last_read_message_id=Greatest(F("last_read_message_id"), Subquery(target)),
+                last_read_at=timezone.now(),
+            )
+        )
+
+    def advance_read_cursors(self, receipts, read_at=None):
+        """
+        批量推进已读游标，一条 UPDATE ... FROM (VALUES ...) 完成。
+        与 mark_read(up_to=...) 相同：游标推进到对话中不大于给定 ID 的最大消息 ID，只前进不后退
+        :param receipts: {(对话 ID, 用户 ID): 已读到的消息 ID}
+        :param read_at: 已读时间，默认当前时间
+        :return: 实际推进了的 [(对话 ID, 用户 ID, 新的游标)]
+        """
+        if not receipts:
+            return []
+        rows = ", ".join(["(%s::uuid, %s::bigint, %s::bigint)"] * len(receipts))
+        params = [read_at or timezone.now()]
+        for (conversation_id, user_id), message_id in receipts.items():
+            params.extend([str(conversation_id), user_id, message_id])
+        member_table = self.model._meta.db_table
+        message_table = Message._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                UPDATE {member_table} AS member
+                SET last_read_message_id = target.message_id, last_read_at = %s
+                FROM (
+                    SELECT receipt.conversation_id, receipt.user_id, (
+                        SELECT MAX(message.id) FROM {message_table} AS message
+                        WHERE message.conversation_id = receipt.conversation_id AND message.id <= receipt.up_to
+                    ) AS message_id
+                    FROM (VALUES {rows}) AS receipt (conversation_id, user_id, up_to)
+                ) AS target
+                WHERE member.conversation_id = target.conversation_id
+                    AND member.user_id = target.user_id
+                    AND target.message_id IS NOT NULL
+                    AND (member.last_read_message_id IS NULL OR member.last_read_message_id < target.message_id)
+                RETURNING member.conversation_id, member.user_id, member.last_read_message_id
+                """,
+                params,
+            )
+            return cursor.fetchall()
+
+
+class ConversationMember(models.Model):
+    """
+    对话参与者（participants 的中间表）。
+    每个参与者保存一个已读游标：ID 不大于 last_read_message_id 的消息视为已读
+    """
+
+    conversation = models.ForeignKey(
+        Conversation, related_name="members", on_delete=models.CASCADE, verbose_name="对话"
+    )
+    user = models.ForeignKey(
+        User, related_name="conversation_memberships", on_delete=models.CASCADE, verbose_name="用户"
+    )
+    # 不建外键约束：过期消息被清理后游标仍需保留
+    last_read_message = models.ForeignKey(
+        "Message",
+        related_name="+",
+        on_delete=models.DO_NOTHING,
+        null=True,
+        blank=True,
+        db_constraint=False,
+        db_index=False,
+        verbose_name="最后已读消息",
+    )
+    last_read_at = models.DateTimeField(null=True, blank=True, verbose_name="最后已读时间")
+
+    objects = ConversationMemberQuerySet.as_manager()
+
+    class Meta:
+        db_table = "im_conversation_participants"
+        unique_together = [("conversation", "user")]
+        verbose_name = "对话参与者"
+        verbose_name_plural = "对话参与者"
+
+    def __str__(self):
+        return f"{self.conversation_id}: {self.user_id}"
+
+
+class MessageQuerySet(models.QuerySet):
+    def unread_by(self, user):
+        """
+        用户未读的消息：所在对话中 ID 大于该用户已读游标的消息
+        :param user:
+        :return:
+        """
+        return self.filter(
+            conversation__members__user=user,
+            id__gt=Coalesce(F("conversation__members__last_read_message_id"), Value(0)),
+        )
+
+    def search(self, text):
+        """
+        全文检索，按相关度注解 rank
+        :param text: 检索词，支持 websearch 语法（"短语"、OR、-排除）
+        :return:
+        """
+        query = SearchQuery(text, config=SEARCH_CONFIG, search_type="websearch")
+        # ts_rank 返回 real，转为 double precision 后游标中的 rank 才能无损往返
+        rank = Cast(SearchRank(F("search_vector"), query), output_field=models.FloatField())
+        return self.filter(search_vector=query).annotate(rank=rank)
+
+    def after_cursors(self, cursors, limit):
+        """
+        按对话取游标之后最新的 limit 条消息，一条 SQL 覆盖所有对话
+        :param cursors: {对话 ID: 已见过的最大消息 ID}，值为 None 表示该对话没有游标
+        :param limit: 每个对话最多返回的条数
+        :return:
+        """
+        if not cursors:
+            return self.none()
+
+        condition = Q()
+        for conversation_id, last_seen_id in cursors.items():
+            if last_seen_id is None:
+                condition |= Q(conversation_id=conversation_id)
+            else:
+                condition |= Q(conversation_id=conversation_id, id__gt=last_seen_id)
+
+        return (
+            self.filter(condition)
+            .annotate(row_number=Window(RowNumber(), partition_by=F("conversation_id"), order_by=F("id").desc()))
+            .filter(row_number__lte=limit)
+        )
+
 
 class Message(BaseModel):
     conversation = models.ForeignKey(
@@ -28,21 +311,38 @@ class Message(BaseModel):
     )
     sender = models.ForeignKey(User, related_name="sent_messages", on_delete=models.CASCADE, verbose_name="发送者")
     content = models.TextField(verbose_name="内容")
-    timestamp = models.DateTimeField(auto_now_add=True, verbose_name="时间戳")
-    read_by = models.ManyToManyField(User, related_name="read_messages", blank=True, verbose_name="已读用户")
+    # 由服务端在接收消息时赋值（写后模式下早于写入数据库的时间）
+    timestamp = models.DateTimeField(default=timezone.now, editable=False, verbose_name="时间戳")
+    # 对话内连续递增的序号，客户端据此发现漏收的广播并在重连时补齐
+    seq = models.BigIntegerField(null=True, editable=False, verbose_name="对话内序号")
+    # 由数据库触发器在写入时维护，见迁移 0007_message_search_vector
+    search_vector = SearchVectorField(null=True, editable=False, verbose_name="全文检索向量")
+
+    objects = MessageQuerySet.as_manager()
 
     class Meta:
         verbose_name = "消息"
         verbose_name_plural = "消息"
+        indexes = [
+            # 历史消息游标分页按 (conversation, timestamp, id) 做范围扫描
+            models.Index(fields=["conversation", "timestamp", "id"], name="im_message_conv_ts_id_idx"),
+            # 未读数按 (conversation, id > 已读游标) 做范围计数
+            models.Index(fields=["conversation", "id"], name="im_message_conv_id_idx"),
+            GinIndex(fields=["search_vector"], name="im_message_search_gin"),
+            # 保留期清理按 (timestamp, id) 键集分批删除
+            models.Index(fields=["timestamp", "id"], name="im_message_ts_id_idx"),
+            # 重连补发按 (conversation, seq > 客户端序号) 做范围扫描；
+            # 不建唯一约束：分区表上的唯一约束必须包含分区键 timestamp，序号唯一由 allocate_seq 的行锁保证
+            models.Index(fields=["conversation", "seq"], name="im_message_conv_seq_idx"),
+        ]
 
     def __str__(self):
         return f"{self.sender.username}: {self.content[:20]}"
 
     def is_read_by(self, user):
-        return self.read_by.filter(id=user.id).exists()
+        return ConversationMember.objects.filter(
+            conversation_id=self.conversation_id, user_id=user.id, last_read_message_id__gte=self.id
+        ).exists()
 
     def mark_as_read(self, user):
-        if not self.is_read_by(user):
-            self.read_by.add(user)
-            return True
-        return False
+        return ConversationMember.objects.advance_read_cursor(self.conversation_id, user.id, self.id)
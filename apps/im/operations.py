@@ -0,0 +1,76 @@
+"""
+im 迁移使用的自定义迁移操作
+"""
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import NotSupportedError
+from django.db import models
+
+
+def _partitions(connection, table):
+    """
+    分区表的各个分区名称；table 不是分区表时返回 None
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [table])
+        if cursor.fetchone() is None:
+            return None
+        cursor.execute(
+            """
+            SELECT child.relname
+            FROM pg_inherits JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = to_regclass(%s)
+            ORDER BY child.relname
+            """,
+            [table],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class AddPartitionedIndexConcurrently(AddIndexConcurrently):
+    """
+    兼容分区表的 AddIndexConcurrently（im_message 可能已由 message_partitions convert 转换为分区表）。
+    分区父表不支持 CREATE INDEX CONCURRENTLY：先在父表上 CREATE INDEX ON ONLY（只建父索引，不扫描数据），
+    再逐个分区并发建索引并挂载到父索引，全部分区挂载后父索引生效，之后新建的分区自动建索引。
+    普通表上与 AddIndexConcurrently 相同。分区表上只支持按字段的普通 B-tree 索引
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        table = model._meta.db_table
+        partitions = _partitions(schema_editor.connection, table)
+        if partitions is None:
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+        index = self.index
+        if type(index) is not models.Index or index.contains_expressions or index.condition or index.include:
+            raise NotSupportedError(f"{index.name}: only plain field indexes are supported on partitioned tables")
+
+        quote = schema_editor.quote_name
+        columns = ", ".join(
+            quote(model._meta.get_field(field.lstrip("-")).column) + (" DESC" if field.startswith("-") else "")
+            for field in index.fields
+        )
+        schema_editor.execute(f"CREATE INDEX IF NOT EXISTS {quote(index.name)} ON ONLY {quote(table)} ({columns})")
+        for partition in partitions:
+            name = f"{partition}_{index.name}"[:63]
+            with schema_editor.connection.cursor() as cursor:
+                cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", [name])
+                row = cursor.fetchone()
+            if row is not None and not row[0]:
+                # 上次中断的并发建索引留下的无效索引
+                schema_editor.execute(f"DROP INDEX CONCURRENTLY {quote(name)}")
+            schema_editor.execute(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {quote(name)} ON {quote(partition)} ({columns})"
+            )
+            schema_editor.execute(f"ALTER INDEX {quote(index.name)} ATTACH PARTITION {quote(name)}")
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        if _partitions(schema_editor.connection, model._meta.db_table) is None:
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        # 分区索引不支持 DROP INDEX CONCURRENTLY，删除父索引时一并删除各分区的索引
+        schema_editor.execute(f"DROP INDEX IF EXISTS {schema_editor.quote_name(self.index.name)}")
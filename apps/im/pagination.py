@@ -0,0 +1,174 @@
+import base64
+import binascii
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.pagination import BasePagination
+
+
+def _encode(*parts) -> str:
+    raw = "|".join(str(part) for part in parts).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode(cursor: str) -> list:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    return base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+
+
+def encode_cursor(timestamp: datetime, pk: int) -> str:
+    """
+    将 (timestamp, id) 编码为不透明的游标字符串
+    :param timestamp: 消息时间戳
+    :param pk: 消息 ID
+    :return:
+    """
+    return _encode(timestamp.isoformat(), pk)
+
+
+def decode_cursor(cursor: str):
+    """
+    解析游标字符串
+    :param cursor: encode_cursor 生成的游标
+    :return: (timestamp, id)
+    :raises: ValidationError 游标格式不正确时抛出
+    """
+    try:
+        timestamp, pk = _decode(cursor)
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise exceptions.ValidationError({"cursor": _("Invalid cursor.")})
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    消息历史的游标（keyset）分页
+
+    按 (timestamp, id) 定位，配合 im.Message 上 (conversation, timestamp, id) 的联合索引，
+    每一页都是一次索引范围扫描，与翻页深度无关。
+      - 不带游标：返回最新的一页
+      - ?before=<cursor>：返回游标之前（更早）的一页
+      - ?after=<cursor>：返回游标之后（更新）的一页
+      - ?limit=<n>：每页条数，不超过 MESSAGE_HISTORY_MAX_PAGE_SIZE
+    每页内的消息均按时间正序返回。
+    """
+
+    before_query_param = "before"
+    after_query_param = "after"
+    limit_query_param = "limit"
+
+    def get_limit(self, request):
+        limit = request.query_params.get(self.limit_query_param)
+        if limit is None:
+            return settings.MESSAGE_HISTORY_PAGE_SIZE
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise exceptions.ValidationError({self.limit_query_param: _("A valid integer is required.")})
+        if limit < 1:
+            raise exceptions.ValidationError({self.limit_query_param: _("Ensure this value is greater than 0.")})
+        return min(limit, settings.MESSAGE_HISTORY_MAX_PAGE_SIZE)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        before = request.query_params.get(self.before_query_param)
+        after = request.query_params.get(self.after_query_param)
+        if before and after:
+            raise exceptions.ValidationError(_("`before` and `after` cannot be used together."))
+
+        self.limit = self.get_limit(request)
+        self.is_forward = bool(after)
+
+        if after:
+            timestamp, pk = decode_cursor(after)
+            # timestamp__gte 为索引提供范围下界，OR 条件只用于同一时间戳内按 id 去重
+            queryset = queryset.filter(Q(timestamp__gt=timestamp) | Q(id__gt=pk), timestamp__gte=timestamp)
+            queryset = queryset.order_by("timestamp", "id")
+        else:
+            if before:
+                timestamp, pk = decode_cursor(before)
+                queryset = queryset.filter(Q(timestamp__lt=timestamp) | Q(id__lt=pk), timestamp__lte=timestamp)
+            queryset = queryset.order_by("-timestamp", "-id")
+
+        # 多取一条用于判断是否还有下一页
+        page = list(queryset[: self.limit + 1])
+        self.has_more = len(page) > self.limit
+        page = page[: self.limit]
+        if not self.is_forward:
+            page.reverse()
+
+        self.page = page
+        self.cursor = before or after
+        return page
+
+    def get_paginated_data(self, data):
+        """
+        组装分页结果。before/after 可直接作为下一次请求的查询参数
+        :param data: 序列化后的当前页数据
+        :return:
+        """
+        first = self.page[0] if self.page else None
+        last = self.page[-1] if self.page else None
+
+        if self.is_forward:
+            before = encode_cursor(first.timestamp, first.id) if first else self.cursor
+            after = encode_cursor(last.timestamp, last.id) if last else self.cursor
+        else:
+            before = encode_cursor(first.timestamp, first.id) if first and self.has_more else None
+            # 向前翻页时，最新一页的 after 游标用于增量拉取新消息
+            after = encode_cursor(last.timestamp, last.id) if last else self.cursor
+
+        return {"results": data, "before": before, "after": after, "has_more": self.has_more}
+
+
+class MessageSearchPagination(BasePagination):
+    """
+    全文检索结果的游标分页
+
+    结果按 (rank, id) 倒序排列，游标记录上一页最后一条的 (rank, id)，翻页不使用 OFFSET。
+      - ?cursor=<cursor>：返回该游标之后的一页
+      - ?limit=<n>：每页条数，不超过 MESSAGE_HISTORY_MAX_PAGE_SIZE
+    """
+
+    cursor_query_param = "cursor"
+    limit_query_param = "limit"
+
+    def get_limit(self, request):
+        limit = request.query_params.get(self.limit_query_param)
+        if limit is None:
+            return settings.MESSAGE_SEARCH_PAGE_SIZE
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise exceptions.ValidationError({self.limit_query_param: _("A valid integer is required.")})
+        if limit < 1:
+            raise exceptions.ValidationError({self.limit_query_param: _("Ensure this value is greater than 0.")})
+        return min(limit, settings.MESSAGE_HISTORY_MAX_PAGE_SIZE)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        """
+        :param queryset: 已注解 rank 的检索结果
+        """
+        self.limit = self.get_limit(request)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            try:
+                rank, pk = _decode(cursor)
+                rank, pk = float(rank), int(pk)
+            except (binascii.Error, UnicodeDecodeError, ValueError):
+                raise exceptions.ValidationError({self.cursor_query_param: _("Invalid cursor.")})
+            queryset = queryset.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=pk))
+
+        page = list(queryset.order_by("-rank", "-id")[: self.limit + 1])
+        self.has_more = len(page) > self.limit
+        self.page = page[: self.limit]
+        return self.page
+
+    def get_paginated_data(self, data):
+        last = self.page[-1] if self.page else None
+        # repr 保证浮点数往返无损，下一页的比较才能精确命中
+        next_cursor = _encode(repr(last.rank), last.id) if last and self.has_more else None
+        return {"results": data, "next": next_cursor}
@@ -0,0 +1,286 @@
+"""
+im_message 按 timestamp 的范围分区（PostgreSQL 声明式分区）
+
+分区按天或按周划分（MESSAGE_PARTITION_INTERVAL），边界按 UTC 对齐，分区命名为 im_message_pYYYYMMDD（分区起始日期）。
+  - convert_table()：把现有的普通表一次性转换为分区表，原表整体挂载为覆盖历史数据的分区
+  - create_partitions()：提前创建未来的分区（MESSAGE_PARTITION_PREMAKE 个周期）
+  - drop_expired_partitions()：分离并删除上界早于保留期截止时间的整个分区，清理过期数据只是元数据操作
+
+未转换为分区表时以上操作（convert_table 除外）均为空操作，保留期清理退回逐批删除。
+转换后需注意：分区父表不支持 CREATE INDEX CONCURRENTLY，迁移中使用 im.operations.AddPartitionedIndexConcurrently；唯一约束必须包含 timestamp。
+"""
+import logging
+from datetime import datetime
+from datetime import time
+from datetime import timedelta
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+from django.utils import timezone
+from im.models import Message
+
+logger = logging.getLogger(__name__)
+
+INTERVALS = {"day": timedelta(days=1), "week": timedelta(weeks=1)}
+
+# 转换时原表改名后作为历史分区保留，直到其上界超出保留期后被整体删除
+LEGACY_SUFFIX = "_legacy"
+# 转换时先建好 (id, timestamp) 唯一索引与边界检查约束，挂载分区时无需在锁内建索引、扫描全表
+CONVERT_INDEX_SUFFIX = "_id_ts_uniq"
+CONVERT_CHECK_SUFFIX = "_partition_check"
+
+SEARCH_TRIGGER = "im_message_search_vector_update"
+
+
+def _table():
+    return Message._meta.db_table
+
+
+def _quote(name):
+    return connection.ops.quote_name(name)
+
+
+def get_interval() -> timedelta:
+    try:
+        return INTERVALS[settings.MESSAGE_PARTITION_INTERVAL]
+    except KeyError:
+        raise ValueError(f"MESSAGE_PARTITION_INTERVAL must be one of {', '.join(INTERVALS)}")
+
+
+def period_start(moment: datetime) -> datetime:
+    """
+    moment 所在分区周期的起始时间（UTC 零点；按周分区时为周一零点）
+    :param moment: 带时区的时间
+    :return:
+    """
+    day = moment.astimezone(dt_timezone.utc).date()
+    if settings.MESSAGE_PARTITION_INTERVAL == "week":
+        day -= timedelta(days=day.weekday())
+    return datetime.combine(day, time.min, tzinfo=dt_timezone.utc)
+
+
+def partition_name(start: datetime) -> str:
+    return f"{_table()}_p{start:%Y%m%d}"
+
+
+def is_partitioned() -> bool:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)",
+            [_table()],
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions():
+    """
+    :return: [(分区名, 上界, 是否处于分离中)]，按上界排序；DEFAULT 分区的上界为 None
+    """
+    with connection.cursor() as cursor:
+        # 上界由数据库转换为 timestamptz：边界表达式形如 '2026-10-20 00:00:00+00'，
+        # Python 3.10 的 datetime.fromisoformat 不接受 +00 形式的时区偏移；DEFAULT/MAXVALUE 上界为 NULL
+        cursor.execute(
+            r"""
+            SELECT c.relname,
+                   (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''([^'']+)''\)'))[1]::timestamptz,
+                   i.inhdetachpending
+            FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+            """,
+            [_table()],
+        )
+        rows = cursor.fetchall()
+
+    return sorted(rows, key=lambda row: row[1] or datetime.max.replace(tzinfo=dt_timezone.utc))
+
+
+def create_partitions(ahead=None, now=None):
+    """
+    从已有分区的上界（或当前周期）开始，创建覆盖到 now + ahead 个周期的分区
+    :param ahead: 提前创建的周期数，默认 MESSAGE_PARTITION_PREMAKE
+    :param now: 当前时间，默认 timezone.now()
+    :return: 新建的分区名列表
+    """
+    if not is_partitioned():
+        return []
+
+    interval = get_interval()
+    ahead = settings.MESSAGE_PARTITION_PREMAKE if ahead is None else ahead
+    now = now or timezone.now()
+    until = period_start(now) + interval * (ahead + 1)
+
+    uppers = [upper for _, upper, _ in list_partitions() if upper is not None]
+    start = max(uppers + [period_start(now)])
+
+    created = []
+    while start < until:
+        # 起点可能未与周期对齐（如切换过分区粒度），首个分区只补齐到下一个周期边界
+        end = period_start(start) + interval
+        name = partition_name(start)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TABLE IF NOT EXISTS {_quote(name)} PARTITION OF {_quote(_table())} "
+                "FOR VALUES FROM (%s) TO (%s)",
+                [start, end],
+            )
+        created.append(name)
+        start = end
+
+    if created:
+        logger.info(f"Created message partitions: {', '.join(created)}")
+    return created
+
+
+def drop_expired_partitions(cutoff, dry_run=False):
+    """
+    分离并删除上界不晚于 cutoff 的分区（分区内全部消息均已过期）
+    :param cutoff: 保留期截止时间
+    :param dry_run: 只返回将被删除的分区，不执行
+    :return: 删除（或将删除）的分区名列表
+    """
+    if not is_partitioned():
+        return []
+
+    partitions = list_partitions()
+    expired = [name for name, upper, _ in partitions if upper is not None and upper <= cutoff]
+    if dry_run:
+        return expired
+
+    table = _quote(_table())
+    # CONCURRENTLY 只对父表加 SHARE UPDATE EXCLUSIVE 锁，不阻塞读写；但不能在事务块中执行，也不能有 DEFAULT 分区
+    concurrently = not connection.in_atomic_block and all(upper is not None for _, upper, _ in partitions)
+    pending = {name for name, _, detach_pending in partitions if detach_pending}
+
+    for name in expired:
+        with connection.cursor() as cursor:
+            if name in pending:
+                # 上次 CONCURRENTLY 分离被中断，先完成分离
+                cursor.execute(f"ALTER TABLE {table} DETACH PARTITION {_quote(name)} FINALIZE")
+            else:
+                cursor.execute(
+                    f"ALTER TABLE {table} DETACH PARTITION {_quote(name)}{' CONCURRENTLY' if concurrently else ''}"
+                )
+            cursor.execute(f"DROP TABLE {_quote(name)}")
+        logger.info(f"Dropped expired message partition {name}")
+
+    return expired
+
+
+def convert_table(now=None):
+    """
+    将普通表 im_message 转换为分区表，需在维护窗口内执行一次。
+
+    1. 在线阶段（不阻塞读写）：并发创建 (id, timestamp) 唯一索引；添加 timestamp < 边界 的检查约束并校验
+    2. 一个短事务内（持有 ACCESS EXCLUSIVE 锁）：原表改名为 im_message_legacy，新建同结构的分区父表，
+       原表整体挂载为 [MINVALUE, 边界) 的分区，主键序列、外键、索引名与检索触发器迁移到父表。
+       借助第一步的索引与约束，挂载时不需要建索引或扫描全表
+    3. 从边界开始创建未来的分区
+    :param now: 当前时间，默认 timezone.now()
+    :return: 历史分区的上界
+    """
+    if is_partitioned():
+        raise RuntimeError(f"{_table()} is already partitioned")
+
+    table = _table()
+    legacy = f"{table}{LEGACY_SUFFIX}"
+    unique_index = f"{table}{CONVERT_INDEX_SUFFIX}"
+    check = f"{table}{CONVERT_CHECK_SUFFIX}"
+    # 留出一个完整周期的余量，确保转换完成前写入的消息都落在历史分区内
+    boundary = period_start(now or timezone.now()) + get_interval() * 2
+
+    with connection.cursor() as cursor:
+        # 上次中断留下的无效索引需要重建
+        cursor.execute(
+            "SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+            [unique_index],
+        )
+        row = cursor.fetchone()
+        if row and not row[0]:
+            cursor.execute(f"DROP INDEX CONCURRENTLY {_quote(unique_index)}")
+        cursor.execute(
+            f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {_quote(unique_index)} "
+            f'ON {_quote(table)} (id, "timestamp")'
+        )
+        cursor.execute(f"ALTER TABLE {_quote(table)} DROP CONSTRAINT IF EXISTS {_quote(check)}")
+        cursor.execute(
+            f'ALTER TABLE {_quote(table)} ADD CONSTRAINT {_quote(check)} CHECK ("timestamp" < %s) NOT VALID',
+            [boundary],
+        )
+        cursor.execute(f"ALTER TABLE {_quote(table)} VALIDATE CONSTRAINT {_quote(check)}")
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {_quote(table)} IN ACCESS EXCLUSIVE MODE")
+
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [table])
+        (sequence,) = cursor.fetchone()
+        cursor.execute(f"SELECT GREATEST((SELECT MAX(id) FROM {_quote(table)}), (SELECT last_value FROM {sequence}))")
+        (last_id,) = cursor.fetchone()
+
+        cursor.execute(
+            """
+            SELECT c.relname, pg_get_indexdef(i.indexrelid), i.indisprimary
+            FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE i.indrelid = to_regclass(%s) AND c.relname <> %s
+            """,
+            [table, unique_index],
+        )
+        indexes = cursor.fetchall()
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'f'",
+            [table],
+        )
+        foreign_keys = cursor.fetchall()
+        cursor.execute(
+            "SELECT pg_get_triggerdef(oid) FROM pg_trigger WHERE tgrelid = to_regclass(%s) AND tgname = %s",
+            [table, SEARCH_TRIGGER],
+        )
+        trigger = cursor.fetchone()
+
+        # 原表：主键改为包含分区键的 (id, timestamp)，释放索引名与触发器，交给父表使用
+        cursor.execute(f"ALTER TABLE {_quote(table)} RENAME TO {_quote(legacy)}")
+        cursor.execute(f"ALTER TABLE {_quote(legacy)} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+        for name, _, primary in indexes:
+            if primary:
+                cursor.execute(f"ALTER TABLE {_quote(legacy)} DROP CONSTRAINT {_quote(name)}")
+            else:
+                cursor.execute(f"ALTER INDEX {_quote(name)} RENAME TO {_quote(name[:55] + LEGACY_SUFFIX)}")
+        cursor.execute(
+            f"ALTER TABLE {_quote(legacy)} ADD CONSTRAINT {_quote(legacy + '_pkey')} "
+            f"PRIMARY KEY USING INDEX {_quote(unique_index)}"
+        )
+        if trigger:
+            cursor.execute(f"DROP TRIGGER {_quote(SEARCH_TRIGGER)} ON {_quote(legacy)}")
+
+        # 分区父表：同结构，主键序列接续原表
+        cursor.execute(
+            f"CREATE TABLE {_quote(table)} (LIKE {_quote(legacy)} INCLUDING DEFAULTS INCLUDING STORAGE) "
+            'PARTITION BY RANGE ("timestamp")'
+        )
+        sequence = f"{table}_id_seq"
+        cursor.execute(f"CREATE SEQUENCE {_quote(sequence)} OWNED BY {_quote(table)}.id")
+        cursor.execute("SELECT setval(%s, %s)", [sequence, max(last_id or 0, 1)])
+        cursor.execute(f"ALTER TABLE {_quote(table)} ALTER COLUMN id SET DEFAULT nextval(%s::regclass)", [sequence])
+        cursor.execute(
+            f'ALTER TABLE {_quote(table)} ADD CONSTRAINT {_quote(table + "_pkey")} PRIMARY KEY (id, "timestamp")'
+        )
+        for name, definition, primary in indexes:
+            if not primary:
+                # 父表为空，建索引是瞬时的；挂载时原表上定义相同的索引自动关联，不会重建
+                cursor.execute(definition)
+        for name, definition in foreign_keys:
+            cursor.execute(f"ALTER TABLE {_quote(table)} ADD CONSTRAINT {_quote(name)} {definition}")
+
+        cursor.execute(
+            f"ALTER TABLE {_quote(table)} ATTACH PARTITION {_quote(legacy)} FOR VALUES FROM (MINVALUE) TO (%s)",
+            [boundary],
+        )
+        cursor.execute(f"ALTER TABLE {_quote(legacy)} DROP CONSTRAINT {_quote(check)}")
+        if trigger:
+            # 分区表上的行级触发器会自动克隆到所有分区
+            cursor.execute(trigger[0])
+
+    create_partitions(now=now)
+    logger.info(f"Converted {table} to a partitioned table, legacy partition {legacy} ends at {boundary}")
+    return boundary
@@ -0,0 +1,110 @@
+"""
+在线状态
+
+每个在线用户在 Redis 中有一个短 TTL 的计数键 im:presence:{user_id}，值为该用户的 WebSocket 连接数：
+  - 连接时 INCR 并设置过期时间，断开时 DECR，减到 0 时删除
+  - 连接期间客户端定时发送心跳帧刷新过期时间（间隔应小于 IM_PRESENCE_TTL）
+  - 进程崩溃未执行断开逻辑时，计数键在最后一次心跳后 IM_PRESENCE_TTL 秒内过期
+批量查询在线状态只需一次 MGET。
+Redis 不可用时在线状态不可用：连接与心跳不受影响，查询结果为全部离线。
+"""
+import logging
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_KEY = "im:presence:{user_id}"
+
+# KEYS[1]: 用户的计数键；ARGV[1]: 过期时间（秒）
+_CONNECT = """
+local count = redis.call("INCR", KEYS[1])
+redis.call("EXPIRE", KEYS[1], ARGV[1])
+return count
+"""
+
+# KEYS[1]: 用户的计数键
+_DISCONNECT = """
+local count = redis.call("DECR", KEYS[1])
+if count <= 0 then
+    redis.call("DEL", KEYS[1])
+end
+return count
+"""
+
+# KEYS[1]: 用户的计数键；ARGV[1]: 过期时间（秒）
+# 计数键已过期（如网络中断超过 TTL 后恢复）时重新计为一个连接
+_HEARTBEAT = """
+if redis.call("EXPIRE", KEYS[1], ARGV[1]) == 0 then
+    redis.call("SET", KEYS[1], 1, "EX", ARGV[1])
+    return 1
+end
+return 0
+"""
+
+
+def _key(user_id) -> str:
+    return PRESENCE_KEY.format(user_id=user_id)
+
+
+def _run(script, user_id, *args):
+    redis = get_redis_connection("default")
+    return redis.register_script(script)(keys=[_key(user_id)], args=list(args))
+
+
+def connect(user_id) -> bool:
+    """
+    记录用户的一个新连接
+    :param user_id: 用户 ID
+    :return: 用户是否由离线变为在线
+    """
+    try:
+        return _run(_CONNECT, user_id, settings.IM_PRESENCE_TTL) == 1
+    except RedisError as e:
+        logger.warning(f"Failed to record presence of user {user_id}: {e}")
+        return False
+
+
+def heartbeat(user_id) -> bool:
+    """
+    刷新用户在线状态的过期时间
+    :param user_id: 用户 ID
+    :return: 用户是否由离线（计数键已过期）变为在线
+    """
+    try:
+        return _run(_HEARTBEAT, user_id, settings.IM_PRESENCE_TTL) == 1
+    except RedisError as e:
+        logger.warning(f"Failed to refresh presence of user {user_id}: {e}")
+        return False
+
+
+def disconnect(user_id) -> bool:
+    """
+    记录用户的一个连接断开
+    :param user_id: 用户 ID
+    :return: 用户是否由在线变为离线
+    """
+    try:
+        return _run(_DISCONNECT, user_id) <= 0
+    except RedisError as e:
+        logger.warning(f"Failed to clear presence of user {user_id}: {e}")
+        return False
+
+
+def online(user_ids) -> set:
+    """
+    批量查询在线状态
+    :param user_ids: 用户 ID 列表
+    :return: 其中在线的用户 ID
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return set()
+    try:
+        values = get_redis_connection("default").mget([_key(user_id) for user_id in user_ids])
+    except RedisError as e:
+        logger.warning(f"Presence unavailable: {e}")
+        return set()
+    return {user_id for user_id, value in zip(user_ids, values) if value is not None}
@@ -0,0 +1,119 @@
+"""
+WebSocket 帧编码
+
+客户端通过 Sec-WebSocket-Protocol 协商编码，未协商时使用 JSON：
+  - im.json：JSON 文本帧
+  - im.msgpack：msgpack 二进制帧，字段名替换为 KEYS 中的整数键，时间戳为毫秒级 Unix 时间戳
+JWT 可以与子协议一起放在 Sec-WebSocket-Protocol 中，如 "im.msgpack, <token>"。
+接收时按帧类型解码（文本帧为 JSON，二进制帧为 msgpack），发送时使用协商的编码。
+"""
+import json
+from datetime import datetime
+
+import msgpack
+
+JSON = "im.json"
+MSGPACK = "im.msgpack"
+SUBPROTOCOLS = (JSON, MSGPACK)
+
+# msgpack 帧的整数键，只能追加，不能修改已有的值
+KEYS = {
+    "type": 0,
+    "conversation_id": 1,
+    "message": 2,
+    "code": 3,
+    "message_ids": 4,
+    "error": 5,
+    "id": 6,
+    "sender": 7,
+    "username": 8,
+    "content": 9,
+    "timestamp": 10,
+    "is_read": 11,
+    "seq": 12,
+    "last_seq": 13,
+    "presence": 14,
+    "online": 15,
+    "offline": 16,
+    "typing": 17,
+    "read": 18,
+    "cursors": 19,
+    "user_id": 20,
+    "message_id": 21,
+}
+_NAMES = {value: key for key, value in KEYS.items()}
+
+
+def negotiate(subprotocols):
+    """
+    选择客户端提供的第一个支持的子协议
+    :param subprotocols: 客户端提供的子协议列表
+    :return: 子协议名称，没有支持的子协议时为 None（使用 JSON，握手响应中不带子协议）
+    """
+    for subprotocol in subprotocols or ():
+        if subprotocol in SUBPROTOCOLS:
+            return subprotocol
+    return None
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _compact(value):
+    if isinstance(value, dict):
+        return {KEYS.get(key, key): _compact(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_compact(item) for item in value]
+    if isinstance(value, datetime):
+        return int(value.timestamp() * 1000)
+    return value
+
+
+def _expand(value):
+    if isinstance(value, dict):
+        return {_NAMES.get(key, key): _expand(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_expand(item) for item in value]
+    return value
+
+
+def encode_json(frame) -> str:
+    return json.dumps(frame, default=_json_default)
+
+
+def encode_msgpack(frame) -> bytes:
+    return msgpack.packb(_compact(frame))
+
+
+def encode(subprotocol, frame):
+    """
+    按协商的子协议编码帧
+    :param subprotocol: negotiate 的返回值
+    :param frame: 帧（字符串键，时间戳为 datetime）
+    :return: msgpack 为 bytes，否则为 str
+    """
+    if subprotocol == MSGPACK:
+        return encode_msgpack(frame)
+    return encode_json(frame)
+
+
+def decode(text_data=None, bytes_data=None) -> dict:
+    """
+    解码客户端帧，格式错误时抛出 ValueError
+    :param text_data: JSON 文本帧
+    :param bytes_data: msgpack 二进制帧
+    :return: 帧（字符串键）
+    """
+    try:
+        if bytes_data is not None:
+            frame = _expand(msgpack.unpackb(bytes_data, strict_map_key=False))
+        else:
+            frame = json.loads(text_data)
+    except (ValueError, TypeError, msgpack.UnpackException) as e:
+        raise ValueError(f"Malformed frame: {e}") from e
+    if not isinstance(frame, dict):
+        raise ValueError("Frame must be a map")
+    return frame
@@ -0,0 +1,102 @@
+"""
+WebSocket 已读回执的合并写入
+
+客户端通过 read 帧上报已读到的消息 ID。回执在内存中按 (对话, 用户) 合并，只保留最大的 ID，
+每隔 IM_READ_RECEIPT_INTERVAL_MS 毫秒用一条 UPDATE 批量推进已读游标（ConversationMemberQuerySet.advance_read_cursors），
+随后用一次查询批量刷新未读计数，并按对话向群组广播一次 chat_read 事件（各用户已读到的消息 ID）。
+滚动浏览时连续上报的回执在一个窗口内只产生一次写入；worker 关闭时（ASGI lifespan.shutdown）写入剩余的回执。
+回执写入失败时丢弃，客户端下次上报（或通过 REST 接口标记已读）时补齐。
+"""
+import asyncio
+import logging
+import weakref
+from collections import defaultdict
+
+from django.conf import settings
+
+from core import lifespan
+from core.db import database_sync_to_async
+
+from . import unread
+from .models import ConversationMember
+
+logger = logging.getLogger(__name__)
+
+
+def _persist(receipts):
+    advanced = ConversationMember.objects.advance_read_cursors(receipts)
+    unread.refresh_many([(user_id, conversation_id) for conversation_id, user_id, _ in advanced])
+    return advanced
+
+
+class ReceiptBuffer:
+    def __init__(self, broadcast):
+        """
+        :param broadcast: 协程函数 broadcast(conversation_id, cursors)，cursors 为 [{"user_id", "message_id"}]
+        """
+        self.broadcast = broadcast
+        self.pending = {}
+        self.lock = asyncio.Lock()
+        self.timer = None
+
+    def add(self, conversation_id, user_id, message_id):
+        """
+        记录用户在对话中已读到 message_id
+        :param conversation_id: 对话 ID
+        :param user_id: 用户 ID
+        :param message_id: 已读到的消息 ID（包含）
+        :return:
+        """
+        key = (str(conversation_id), user_id)
+        if message_id > self.pending.get(key, 0):
+            self.pending[key] = message_id
+        if self.timer is None:
+            self.timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(settings.IM_READ_RECEIPT_INTERVAL_MS / 1000)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending:
+                return
+            receipts, self.pending = self.pending, {}
+            try:
+                advanced = await database_sync_to_async(_persist)(receipts)
+            except Exception:
+                logger.exception(f"Failed to persist {len(receipts)} read receipts")
+                return
+
+        cursors = defaultdict(list)
+        for conversation_id, user_id, message_id in advanced:
+            cursors[str(conversation_id)].append({"user_id": user_id, "message_id": message_id})
+        for conversation_id, items in cursors.items():
+            try:
+                await self.broadcast(conversation_id, items)
+            except Exception:
+                logger.exception(f"Failed to broadcast read receipts of conversation {conversation_id}")
+
+
+# 每个事件循环一个缓冲（asyncio 原语与事件循环绑定）
+_buffers = weakref.WeakKeyDictionary()
+
+
+def get_buffer(broadcast) -> ReceiptBuffer:
+    loop = asyncio.get_running_loop()
+    if loop not in _buffers:
+        _buffers[loop] = ReceiptBuffer(broadcast)
+    return _buffers[loop]
+
+
+@lifespan.on_shutdown
+async def flush_all():
+    """worker 关闭前写入当前事件循环中缓冲的回执"""
+    buffer = _buffers.get(asyncio.get_running_loop())
+    if buffer is None:
+        return
+    if buffer.timer:
+        buffer.timer.cancel()
+        buffer.timer = None
+    await buffer.flush()
@@ -0,0 +1,144 @@
+"""
+消息保留期清理
+
+cleanup_old_messages 定时任务与同名管理命令共用的清理逻辑：
+  0. 开启归档（MESSAGE_ARCHIVE_ENABLED，默认关闭，须同时配置 MESSAGE_ARCHIVE_ROOT）时，截止时间向下取整到 UTC 零点，先将截止时间之前的整天写入冷归档（见 im.archive）
+  1. 分区表先整体分离并删除已全部过期的分区（见 im.partitions）
+  2. 剩余的过期消息按 (timestamp, id) 键集分批删除：每批一条 DELETE ... USING 语句，从上一批的位置继续，
+     不会重复扫描已删除的死元组，也不经过 Django 的级联收集器（im_message 没有被数据库外键引用）
+
+进度（上一批的 (timestamp, id)）保存在缓存中，中断后重新执行会从该位置继续；全部完成后清除。
+"""
+import logging
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.utils import timezone
+from im import partitions
+from im.archive import archive_messages
+from im.archive import day_start
+from im.models import Message
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_CACHE_KEY = "im:retention:progress"
+# 键集遍历的起点
+_START = (datetime.min.replace(tzinfo=dt_timezone.utc), 0)
+
+_DELETE_BATCH_SQL = """
+WITH batch AS (
+    SELECT id, "timestamp" FROM {table}
+    WHERE "timestamp" < %(cutoff)s AND ("timestamp", id) > (%(timestamp)s, %(id)s)
+    ORDER BY "timestamp", id
+    LIMIT %(limit)s
+), deleted AS (
+    DELETE FROM {table} m USING batch b WHERE m.id = b.id AND m."timestamp" = b."timestamp"
+    RETURNING 1
+)
+SELECT b."timestamp", b.id, (SELECT COUNT(*) FROM deleted)
+FROM batch b
+ORDER BY b."timestamp" DESC, b.id DESC
+LIMIT 1
+"""
+
+
+def _load_progress():
+    progress = cache.get(PROGRESS_CACHE_KEY)
+    if not progress:
+        return _START
+    return datetime.fromisoformat(progress["timestamp"]), progress["id"]
+
+
+def _save_progress(position):
+    timestamp, pk = position
+    cache.set(PROGRESS_CACHE_KEY, {"timestamp": timestamp.isoformat(), "id": pk}, timeout=None)
+
+
+def purge_expired_messages(
+    cutoff=None, batch_size=None, rows_per_second=None, dry_run=False, resume=True, archive=None, log=logger.info
+):
+    """
+    删除 timestamp 早于 cutoff 的消息
+    :param cutoff: 截止时间，默认当前时间减去 MESSAGE_RETENTION_DAYS
+    :param batch_size: 每批删除的条数，默认 MESSAGE_RETENTION_BATCH_SIZE
+    :param rows_per_second: 每秒最多删除的条数，0 或 None 表示不限速（默认 MESSAGE_RETENTION_ROWS_PER_SECOND）
+    :param dry_run: 只统计将被删除的分区与消息条数，不执行删除
+    :param resume: 是否从上次中断的位置继续
+    :param archive: 删除前是否先归档，默认 MESSAGE_ARCHIVE_ENABLED
+    :param log: 进度输出函数
+    :return: {"deleted": 删除（或将删除）的消息条数, "dropped_partitions": 删除的分区, "seconds": 耗时}
+    """
+    cutoff = cutoff or timezone.now() - timedelta(days=settings.MESSAGE_RETENTION_DAYS)
+    batch_size = batch_size or settings.MESSAGE_RETENTION_BATCH_SIZE
+    if rows_per_second is None:
+        rows_per_second = settings.MESSAGE_RETENTION_ROWS_PER_SECOND
+    if archive is None:
+        archive = settings.MESSAGE_ARCHIVE_ENABLED
+    if archive and not settings.MESSAGE_ARCHIVE_ROOT:
+        raise ImproperlyConfigured("MESSAGE_ARCHIVE_ROOT must be set to archive expired messages")
+    started = time.monotonic()
+
+    if archive:
+        # 归档以整天为单位，只删除已完整归档的日期
+        cutoff = day_start(cutoff)
+        if not dry_run:
+            archive_messages(before=cutoff, log=log)
+
+    dropped = partitions.drop_expired_partitions(cutoff, dry_run=dry_run)
+    if dropped:
+        log(f"{'Would drop' if dry_run else 'Dropped'} expired partitions: {', '.join(dropped)}")
+
+    if dry_run:
+        deleted = _count_remaining(cutoff, dropped)
+        log(f"Would delete {deleted} messages older than {cutoff.isoformat()}")
+        return {"deleted": deleted, "dropped_partitions": dropped, "seconds": time.monotonic() - started}
+
+    position = _load_progress() if resume else _START
+    sql = _DELETE_BATCH_SQL.format(table=connection.ops.quote_name(Message._meta.db_table))
+    deleted = 0
+
+    while True:
+        batch_started = time.monotonic()
+        # 自动提交模式下每批是一个独立的短事务，只锁定本批的行
+        with connection.cursor() as cursor:
+            cursor.execute(sql, {"cutoff": cutoff, "timestamp": position[0], "id": position[1], "limit": batch_size})
+            row = cursor.fetchone()
+        if row is None:
+            break
+
+        position = (row[0], row[1])
+        deleted += row[2]
+        _save_progress(position)
+
+        elapsed = time.monotonic() - started
+        log(
+            f"Deleted {deleted} messages ({deleted / elapsed:.0f} rows/s), position {position[0].isoformat()} #{position[1]}"
+        )
+
+        if rows_per_second:
+            # 限速：本批删除 n 条时至少占用 n / rows_per_second 秒
+            pause = row[2] / rows_per_second - (time.monotonic() - batch_started)
+            if pause > 0:
+                time.sleep(pause)
+
+    cache.delete(PROGRESS_CACHE_KEY)
+    seconds = time.monotonic() - started
+    log(f"Deleted {deleted} messages older than {cutoff.isoformat()} in {seconds:.1f}s")
+    return {"deleted": deleted, "dropped_partitions": dropped, "seconds": seconds}
+
+
+def _count_remaining(cutoff, partition_names):
+    """统计逐批删除阶段将删除的条数（dry-run 时将被整体删除的分区仍然存在，需排除）"""
+    table = connection.ops.quote_name(Message._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT COUNT(*) FROM {table} WHERE "timestamp" < %s AND tableoid::regclass::text <> ALL(%s)',
+            [cutoff, partition_names],
+        )
+        return cursor.fetchone()[0]
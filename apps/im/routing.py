@@ -3,5 +3,6 @@ from django.urls import path
 from . import consumers
 
 websocket_urlpatterns = [
+    path("ws/chat/", consumers.MultiplexChatConsumer.as_asgi()),
     path("ws/chat/<uuid:conversation_id>/", consumers.ChatConsumer.as_asgi()),
 ]
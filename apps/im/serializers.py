@@ -1,8 +1,14 @@
+import uuid
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import models
 from django.db import transaction
+from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 
 from .models import Conversation
+from .models import ConversationMember
 from .models import Message
 
 User = get_user_model()
@@ -14,22 +20,105 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ["id", "username", "first_name", "last_name"]
 
 
+class MessageListSerializer(serializers.ListSerializer):
+    """
+    消息列表序列化。
+    序列化前一次性查出当前用户在相关对话中的已读游标并放入 context，
+    is_read 只需与游标比较，避免逐条消息查询
+    """
+
+    def to_representation(self, data):
+        messages = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+
+        request = self.context.get("request")
+        if request and request.user.is_authenticated:
+            read_cursors = self.context.setdefault("read_cursors", {})
+            missing = {message.conversation_id for message in messages} - read_cursors.keys()
+            if missing:
+                # 非参与者没有游标，视为全部未读
+                read_cursors.update(dict.fromkeys(missing))
+                read_cursors.update(
+                    ConversationMember.objects.filter(user=request.user, conversation_id__in=missing).values_list(
+                        "conversation_id", "last_read_message_id"
+                    )
+                )
+
+        return super().to_representation(messages)
+
+
 class MessageSerializer(serializers.ModelSerializer):
     sender = UserSerializer(read_only=True)
     is_read = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
-        fields = ["id", "conversation", "sender", "content", "timestamp", "is_read"]
-        read_only_fields = ["id", "sender", "timestamp"]
+        fields = ["id", "seq", "conversation", "sender", "content", "timestamp", "is_read"]
+        read_only_fields = ["id", "seq", "sender", "timestamp"]
+        list_serializer_class = MessageListSerializer
 
     def get_is_read(self, obj):
         request = self.context.get("request")
         if request and request.user.is_authenticated:
+            # 批量模式：上层已一次性查出当前用户在各对话中的已读游标
+            read_cursors = self.context.get("read_cursors")
+            if read_cursors is not None:
+                read_cursor = read_cursors.get(obj.conversation_id)
+                return read_cursor is not None and obj.id <= read_cursor
             return obj.is_read_by(request.user)
         return False
 
 
+class ReadReceiptSerializer(serializers.Serializer):
+    message_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        required=False,
+        allow_empty=False,
+        max_length=10000,
+        help_text="已读的消息 ID 列表",
+    )
+    up_to = serializers.IntegerField(min_value=1, required=False, help_text="已读到的消息 ID（包含）")
+
+    def validate(self, attrs):
+        if ("message_ids" in attrs) == ("up_to" in attrs):
+            raise serializers.ValidationError(_("Provide exactly one of `message_ids` and `up_to`."))
+        return attrs
+
+
+class SyncSerializer(serializers.Serializer):
+    cursors = serializers.DictField(
+        child=serializers.IntegerField(min_value=0, allow_null=True),
+        required=False,
+        default=dict,
+        help_text="{对话 ID: 已收到的最大消息 ID}",
+    )
+    since = serializers.DateTimeField(required=False, help_text="上次同步返回的 server_time，用于获取已读状态变化")
+    limit = serializers.IntegerField(
+        min_value=1,
+        max_value=settings.MESSAGE_HISTORY_MAX_PAGE_SIZE,
+        default=settings.MESSAGE_HISTORY_PAGE_SIZE,
+        help_text="每个对话最多返回的消息条数",
+    )
+
+    def validate_cursors(self, value):
+        # 统一对话 ID 的格式（大小写、是否带连字符），否则与数据库中的 ID 比较时会被当作未知对话
+        cursors = {}
+        for key, cursor in value.items():
+            try:
+                cursors[uuid.UUID(key)] = cursor
+            except ValueError:
+                raise serializers.ValidationError(_("“%(value)s” is not a valid UUID.") % {"value": key})
+        return cursors
+
+
+class PresenceQuerySerializer(serializers.Serializer):
+    user_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.IM_PRESENCE_QUERY_MAX_USERS,
+        help_text="要查询在线状态的用户 ID 列表",
+    )
+
+
 class ConversationCreateSerializer(serializers.Serializer):
     name = serializers.CharField(max_length=255, required=False, allow_blank=True)
     participants = serializers.PrimaryKeyRelatedField(
@@ -50,13 +139,22 @@ class ConversationCreateSerializer(serializers.Serializer):
     @transaction.atomic
     def create(self, validated_data):
         user = self.context["view"].request.user
+        participants = validated_data.get("participants", [])
+
+        # 私聊：已存在的会话直接返回
+        others = [u for u in participants if u.pk != user.pk]
+        if not validated_data.get("is_group", False) and len(others) == 1:
+            conversation, created = Conversation.objects.get_or_create_private(
+                user, others[0], name=validated_data.get("name", "")
+            )
+            return conversation
+
         conversation = Conversation.objects.create(
             name=validated_data.get("name", ""),
             is_group=validated_data.get("is_group", False),
         )
 
         # participants 是 User 实例列表（可能为空）
-        participants = validated_data.get("participants", [])
         # 确保创建者在 participants 中
         if user not in participants:
             # add accepts model instances or ids; 使用实例更明确
@@ -72,6 +170,26 @@ class ConversationCreateSerializer(serializers.Serializer):
         return conversation
 
 
+class ConversationListSerializer(serializers.ListSerializer):
+    """
+    对话列表序列化。
+    配合 ConversationQuerySet.with_summary 使用：一次性加载所有对话的最后一条消息，
+    已读状态直接与注解的已读游标比较，避免逐个对话查询
+    """
+
+    def to_representation(self, data):
+        conversations = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+
+        latest_ids = [c.latest_message_id for c in conversations if getattr(c, "latest_message_id", None)]
+        if latest_ids:
+            latest_messages = Message.objects.select_related("sender").in_bulk(latest_ids)
+            for conversation in conversations:
+                conversation.latest_message = latest_messages.get(conversation.latest_message_id)
+            self.context["read_cursors"] = {c.id: c.read_cursor for c in conversations}
+
+        return super().to_representation(conversations)
+
+
 class ConversationSerializer(serializers.ModelSerializer):
     participants = UserSerializer(many=True, read_only=True)
     last_message = serializers.SerializerMethodField()
@@ -80,15 +198,22 @@ class ConversationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Conversation
         fields = ["id", "name", "participants", "is_group", "created_at", "last_message", "unread_count"]
+        list_serializer_class = ConversationListSerializer
 
     def get_last_message(self, obj):
-        last_message = obj.messages.last()
+        if hasattr(obj, "latest_message"):
+            last_message = obj.latest_message
+        else:
+            last_message = obj.messages.last()
         if last_message:
             return MessageSerializer(last_message, context=self.context).data
         return None
 
     def get_unread_count(self, obj):
+        # 优先使用 with_summary 注解的未读数
+        if hasattr(obj, "unread_count"):
+            return obj.unread_count
         request = self.context.get("request")
         if request and request.user.is_authenticated:
-            return obj.messages.exclude(read_by=request.user).count()
+            return obj.messages.unread_by(request.user).count()
         return 0
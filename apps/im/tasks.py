@@ -1,9 +1,11 @@
 import logging
+from itertools import groupby
 
 from celery import shared_task
-from django.conf import settings
-from django.utils import timezone
-from im.models import Message
+from im import partitions
+from im import retention
+from im import unread
+from im.models import ConversationMember
 
 logger = logging.getLogger(__name__)
 
@@ -12,30 +14,40 @@ logger = logging.getLogger(__name__)
 def cleanup_old_messages():
     """清理超过保留期限的消息"""
     try:
-        retention_days = settings.MESSAGE_RETENTION_DAYS
-        cutoff_date = timezone.now() - timezone.timedelta(days=retention_days)
-
-        # 使用分块删除避免内存问题
-        queryset = Message.objects.filter(timestamp__lt=cutoff_date)
-        deleted_count = 0
-
-        # 分块处理，每次处理1000条记录
-        while True:
-            # 获取一批要删除的ID
-            ids = queryset.values_list("id", flat=True)[:1000]
-            if not ids:
-                break
-
-            # 批量删除
-            _, deleted = Message.objects.filter(id__in=ids).delete()
-            deleted_count += deleted.get("im.Message", 0)
-
-            logger.info(f"Deleted {deleted_count} messages so far...")
-
-        logger.info(f"Successfully deleted {deleted_count} old messages")
-        return deleted_count
-
+        result = retention.purge_expired_messages()
     except Exception as e:
         logger.error(f"Error cleaning up old messages: {str(e)}")
         # 重新抛出异常让Celery知道任务失败
         raise
+    # 删除的消息中可能有未读消息，校准未读计数器
+    if result["deleted"] or result["dropped_partitions"]:
+        rebuild_unread_counters()
+    return result["deleted"]
+
+
+@shared_task
+def create_message_partitions():
+    """为分区表提前创建未来的分区（未转换为分区表时不做任何操作）"""
+    return partitions.create_partitions()
+
+
+@shared_task
+def rebuild_unread_counters():
+    """
+    按数据库重建所有用户的 Redis 未读计数器，校准增量更新、消息清理产生的偏差；
+    已没有任何对话的用户的计数器直接删除
+    """
+    members = (
+        ConversationMember.objects.with_unread_count()
+        .order_by("user_id")
+        .values_list("user_id", "conversation_id", "unread_count")
+    )
+
+    rebuilt = set()
+    for user_id, rows in groupby(members.iterator(chunk_size=2000), key=lambda row: row[0]):
+        unread.rebuild(user_id, {str(conversation_id): count for _, conversation_id, count in rows})
+        rebuilt.add(user_id)
+    discarded = unread.discard_except(rebuilt)
+
+    logger.info(f"Rebuilt unread counters for {len(rebuilt)} users, discarded {discarded}")
+    return len(rebuilt)
@@ -0,0 +1,1186 @@
+import asyncio
+import io
+import json
+import shutil
+import tempfile
+import threading
+import uuid
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone as dt_timezone
+from unittest import mock
+from zoneinfo import ZoneInfo
+
+from account.models import User
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.db import connections
+from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django_redis import get_redis_connection
+from rest_framework.test import APIClient
+
+from core.db import database_sync_to_async
+
+from . import archive
+from . import coalesce
+from . import consumers
+from . import membership
+from . import partitions
+from . import presence
+from . import protocol
+from . import receipts
+from . import retention
+from . import routing
+from . import tasks
+from . import unread
+from . import writebehind
+from .models import Conversation
+from .models import ConversationMember
+from .models import Message
+
+
+class ConversationListViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.other = User.objects.create_user(username="bob", mobile="13800000001")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create_conversations(self, count):
+        for i in range(count):
+            conversation = Conversation.objects.create(name=f"chat-{i}")
+            conversation.participants.add(self.user, self.other)
+            first = Message.objects.create(conversation=conversation, sender=self.other, content="hi")
+            Message.objects.create(conversation=conversation, sender=self.other, content="there")
+            first.mark_as_read(self.user)
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("conversation-list"))
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.json()["data"]
+
+    def test_query_count_is_independent_of_conversation_count(self):
+        self.create_conversations(2)
+        baseline, _ = self.count_queries()
+
+        self.create_conversations(20)
+        queries, data = self.count_queries()
+
+        self.assertEqual(len(data), 22)
+        self.assertEqual(queries, baseline)
+        self.assertLessEqual(queries, 4)
+
+    def test_summary_fields(self):
+        self.create_conversations(1)
+        _, data = self.count_queries()
+
+        conversation = data[0]
+        self.assertEqual(conversation["unread_count"], 1)
+        self.assertEqual(conversation["last_message"]["content"], "there")
+        self.assertFalse(conversation["last_message"]["is_read"])
+        self.assertEqual({p["username"] for p in conversation["participants"]}, {"alice", "bob"})
+
+
+class ReadCursorTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.other = User.objects.create_user(username="bob", mobile="13800000001")
+        self.conversation = Conversation.objects.create(name="chat")
+        self.conversation.participants.add(self.user, self.other)
+        self.messages = [
+            Message.objects.create(conversation=self.conversation, sender=self.other, content=str(i)) for i in range(3)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def unread_count(self, conversation_id=None):
+        if conversation_id:
+            url = reverse("unread-count-conversation", args=[conversation_id])
+        else:
+            url = reverse("unread-count")
+        return self.client.get(url).json()["data"]["unread_count"]
+
+    def test_mark_as_read_advances_cursor(self):
+        self.assertTrue(self.messages[1].mark_as_read(self.user))
+        self.assertFalse(self.messages[0].mark_as_read(self.user))
+
+        self.assertTrue(self.messages[0].is_read_by(self.user))
+        self.assertFalse(self.messages[2].is_read_by(self.user))
+        self.assertFalse(self.messages[0].is_read_by(self.other))
+        self.assertEqual(self.unread_count(self.conversation.id), 1)
+
+    def test_mark_conversation_as_read(self):
+        other_conversation = Conversation.objects.create(name="other")
+        other_conversation.participants.add(self.user, self.other)
+        Message.objects.create(conversation=other_conversation, sender=self.other, content="x")
+        self.assertEqual(self.unread_count(), 4)
+
+        response = self.client.post(reverse("mark-conversation-as-read", args=[self.conversation.id]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.unread_count(self.conversation.id), 0)
+        self.assertEqual(self.unread_count(), 1)
+
+    def test_bulk_mark_as_read(self):
+        url = reverse("bulk-mark-as-read", args=[self.conversation.id])
+
+        response = self.client.post(url, {"message_ids": [self.messages[0].id, self.messages[1].id]}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.unread_count(self.conversation.id), 1)
+
+        response = self.client.post(url, {"up_to": self.messages[-1].id}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.unread_count(self.conversation.id), 0)
+
+        response = self.client.post(url, {"message_ids": [1], "up_to": 1}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_mark_as_read_requires_participant(self):
+        outsider = User.objects.create_user(username="carol", mobile="13800000002")
+        self.client.force_authenticate(outsider)
+
+        response = self.client.post(
+            reverse("bulk-mark-as-read", args=[self.conversation.id]), {"up_to": self.messages[-1].id}, format="json"
+        )
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(ConversationMember.objects.filter(user=outsider).exists())
+
+    def test_mark_single_message_as_read(self):
+        response = self.client.post(reverse("mark-as-read", args=[self.messages[1].id]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.unread_count(self.conversation.id), 1)
+
+    def test_advance_read_cursors_in_one_statement(self):
+        other = Conversation.objects.create(name="other")
+        other.participants.add(self.user)
+        foreign = Message.objects.create(conversation=other, sender=self.user, content="x")
+        receipts = {
+            # 其他对话的消息 ID 被截断到本对话中不大于它的最大消息
+            (self.conversation.id, self.user.id): foreign.id,
+            (other.id, self.user.id): foreign.id,
+        }
+
+        with self.assertNumQueries(1):
+            advanced = ConversationMember.objects.advance_read_cursors(receipts)
+
+        self.assertEqual(
+            sorted(advanced, key=lambda row: row[2]),
+            [(self.conversation.id, self.user.id, self.messages[-1].id), (other.id, self.user.id, foreign.id)],
+        )
+        # 游标只前进不后退
+        self.assertEqual(
+            ConversationMember.objects.advance_read_cursors(
+                {(self.conversation.id, self.user.id): self.messages[0].id}
+            ),
+            [],
+        )
+
+    def test_persisted_receipts_refresh_unread_in_one_query(self):
+        for user in (self.user, self.other):
+            unread.get_counts(user.id)
+        pending = {
+            (self.conversation.id, self.user.id): self.messages[1].id,
+            (self.conversation.id, self.other.id): self.messages[-1].id,
+        }
+
+        # 推进游标一条 UPDATE，刷新未读数一条查询
+        with self.assertNumQueries(2):
+            receipts._persist(pending)
+
+        self.assertEqual(unread.get_counts(self.user.id), {str(self.conversation.id): 1})
+        self.assertEqual(unread.get_counts(self.other.id), {str(self.conversation.id): 0})
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.other = User.objects.create_user(username="bob", mobile="13800000001")
+        self.conversation = Conversation.objects.create(name="chat")
+        self.conversation.participants.add(self.user, self.other)
+        self.message = self.send("hi")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.urls = [
+            reverse("conversation-list"),
+            reverse("conversation-detail", args=[self.conversation.id]),
+            reverse("message-history", args=[self.conversation.id]),
+        ]
+
+    def send(self, content):
+        # 与 ChatConsumer.save_message 相同：分配 seq 时刷新对话版本
+        seq = Conversation.objects.allocate_seq(self.conversation.id, updated_at=timezone.now())
+        return Message.objects.create(conversation=self.conversation, sender=self.other, content=content, seq=seq)
+
+    def etags(self):
+        return {url: self.client.get(url)["ETag"] for url in self.urls}
+
+    def assert_changed(self, change, urls):
+        etags = self.etags()
+        change()
+        for url in urls:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[url])
+            self.assertEqual(response.status_code, 200, url)
+
+    def test_matching_etag_returns_304(self):
+        for url, etag in self.etags().items():
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304, url)
+            self.assertNotIn("Last-Modified", response)
+
+    def test_new_message_returns_200(self):
+        self.assert_changed(lambda: self.send("there"), self.urls)
+
+    def test_read_cursor_move_returns_200(self):
+        self.assert_changed(lambda: self.message.mark_as_read(self.user), self.urls)
+
+    def test_participant_change_returns_200(self):
+        carol = User.objects.create_user(username="carol", mobile="13800000002")
+        self.assert_changed(lambda: self.conversation.participants.add(carol), self.urls[:2])
+        self.assert_changed(lambda: self.conversation.participants.remove(carol), self.urls[:2])
+
+
+class SyncTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.other = User.objects.create_user(username="bob", mobile="13800000001")
+        self.conversation = Conversation.objects.create(name="chat")
+        self.conversation.participants.add(self.user, self.other)
+        self.messages = [
+            Message.objects.create(conversation=self.conversation, sender=self.other, content=str(i)) for i in range(3)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def sync(self, **data):
+        response = self.client.post(reverse("sync"), data, format="json")
+        self.assertEqual(response.status_code, 200)
+        return response.json()["data"]
+
+    def test_gap_is_reported_with_has_more(self):
+        data = self.sync(cursors={str(self.conversation.id): self.messages[0].id - 1}, limit=2)
+
+        (conversation,) = data["conversations"]
+        self.assertTrue(conversation["has_more"])
+        self.assertEqual([m["id"] for m in conversation["messages"]], [m.id for m in self.messages[1:]])
+        self.assertEqual(conversation["cursor"], self.messages[-1].id)
+
+        data = self.sync(cursors={str(self.conversation.id): self.messages[0].id}, limit=2)
+        self.assertFalse(data["conversations"][0]["has_more"])
+
+    def test_cursor_keys_are_normalised(self):
+        for key in [str(self.conversation.id).upper(), self.conversation.id.hex]:
+            data = self.sync(cursors={key: self.messages[-1].id})
+            self.assertEqual(data["conversations"], [])
+            self.assertEqual(data["removed"], [])
+
+        response = self.client.post(reverse("sync"), {"cursors": {"not-a-uuid": 1}}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_read_changes_since_last_sync(self):
+        since = self.sync()["server_time"]
+        self.messages[1].mark_as_read(self.other)
+
+        data = self.sync(cursors={str(self.conversation.id): self.messages[-1].id}, since=since)
+
+        (conversation,) = data["conversations"]
+        self.assertEqual(conversation["messages"], [])
+        self.assertEqual(conversation["read_cursors"], {str(self.other.id): self.messages[1].id})
+
+    def test_left_conversations_are_removed(self):
+        left = Conversation.objects.create(name="left")
+
+        data = self.sync(cursors={str(self.conversation.id): self.messages[-1].id, str(left.id): 0})
+
+        self.assertEqual(data["removed"], [str(left.id)])
+
+
+class MessageHistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.conversation = Conversation.objects.create(name="chat")
+        self.conversation.participants.add(self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # 第 2、3 条时间戳相同，按 id 区分先后
+        base = timezone.now() - timedelta(minutes=10)
+        offsets = [0, 1, 1, 2, 3]
+        self.messages = [
+            Message.objects.create(
+                conversation=self.conversation,
+                sender=self.user,
+                content=str(i),
+                timestamp=base + timedelta(seconds=offset),
+            )
+            for i, offset in enumerate(offsets)
+        ]
+
+    def history(self, status_code=200, **params):
+        response = self.client.get(reverse("message-history", args=[self.conversation.id]), params)
+        self.assertEqual(response.status_code, status_code)
+        return response.json()["data"] if status_code == 200 else None
+
+    def ids(self, *indexes):
+        return [self.messages[i].id for i in indexes]
+
+    def test_pages_backwards_with_before(self):
+        pages = []
+        params = {"limit": 2}
+        while True:
+            data = self.history(**params)
+            pages.append(([m["id"] for m in data["results"]], data["has_more"]))
+            if not data["before"]:
+                break
+            params["before"] = data["before"]
+
+        self.assertEqual(pages, [(self.ids(3, 4), True), (self.ids(1, 2), True), (self.ids(0), False)])
+
+    def test_query_count_is_fixed_across_pages(self):
+        senders = [User.objects.create_user(username=f"user{i}", mobile=f"1390000000{i}") for i in range(4)]
+        self.conversation.participants.add(*senders)
+        base = timezone.now() - timedelta(minutes=5)
+        for i, sender in enumerate(senders * 2):
+            Message.objects.create(
+                conversation=self.conversation, sender=sender, content="hi", timestamp=base + timedelta(seconds=i)
+            )
+        self.messages[2].mark_as_read(self.user)
+
+        results = []
+        params = {"limit": 4}
+        while True:
+            # ETag、对话、当前页消息（含发送者）、当前用户的已读游标；与页大小、发送者数无关
+            with self.assertNumQueries(4):
+                data = self.history(**params)
+            results = data["results"] + results
+            if not data["before"]:
+                break
+            params["before"] = data["before"]
+
+        self.assertEqual(len(results), 13)
+        self.assertEqual({m["sender"]["username"] for m in results}, {"alice", *(s.username for s in senders)})
+        self.assertEqual([m["is_read"] for m in results], [True] * 3 + [False] * 10)
+
+    def test_pages_forwards_with_after(self):
+        first = self.history(limit=2, before=self.history(limit=3)["before"])
+        self.assertEqual([m["id"] for m in first["results"]], self.ids(0, 1))
+
+        data = self.history(limit=2, after=first["after"])
+        self.assertEqual(([m["id"] for m in data["results"]], data["has_more"]), (self.ids(2, 3), True))
+        data = self.history(limit=2, after=data["after"])
+        self.assertEqual(([m["id"] for m in data["results"]], data["has_more"]), (self.ids(4), False))
+        # 没有新消息时保留原游标，供下一次增量拉取
+        empty = self.history(limit=2, after=data["after"])
+        self.assertEqual((empty["results"], empty["has_more"], empty["after"]), ([], False, data["after"]))
+
+    def test_has_more_is_false_on_exactly_full_last_page(self):
+        data = self.history(limit=5)
+        self.assertEqual(([m["id"] for m in data["results"]], data["has_more"]), (self.ids(0, 1, 2, 3, 4), False))
+        self.assertIsNone(data["before"])
+
+        data = self.history(limit=4)
+        self.assertTrue(data["has_more"])
+        data = self.history(limit=1, before=data["before"])
+        self.assertEqual(([m["id"] for m in data["results"]], data["has_more"]), (self.ids(0), False))
+
+    @override_settings(MESSAGE_HISTORY_MAX_PAGE_SIZE=3)
+    def test_limit_is_clamped_and_validated(self):
+        self.assertEqual(len(self.history(limit=100)["results"]), 3)
+        self.history(400, limit=0)
+        self.history(400, limit="ten")
+
+    def test_invalid_cursors_are_rejected(self):
+        self.history(400, before="not a cursor")
+        self.history(400, after="bm90LWEtZGF0ZXwx")
+        cursor = self.history(limit=2)["before"]
+        self.history(400, before=cursor, after=cursor)
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.other = User.objects.create_user(username="bob", mobile="13800000001")
+        self.conversation = Conversation.objects.create(name="chat")
+        self.conversation.participants.add(self.user, self.other)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def send(self, content, conversation=None):
+        return Message.objects.create(
+            conversation=conversation or self.conversation, sender=self.other, content=content
+        )
+
+    def search(self, **params):
+        response = self.client.get(reverse("message-search"), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()["data"]
+
+    def test_results_are_ranked(self):
+        weak = self.send("apple pie")
+        strong = self.send("apple apple apple")
+        self.send("banana")
+
+        data = self.search(q="apple")
+
+        self.assertEqual([m["id"] for m in data["results"]], [strong.id, weak.id])
+
+    def test_only_participating_conversations(self):
+        other = Conversation.objects.create(name="other")
+        other.participants.add(self.user, self.other)
+        foreign = Conversation.objects.create(name="foreign")
+        mine = self.send("apple")
+        theirs = self.send("apple", other)
+        self.send("apple", foreign)
+
+        self.assertEqual({m["id"] for m in self.search(q="apple")["results"]}, {mine.id, theirs.id})
+        data = self.search(q="apple", conversation_id=str(other.id).upper())
+        self.assertEqual([m["id"] for m in data["results"]], [theirs.id])
+
+        response = self.client.get(reverse("message-search"), {"q": "apple", "conversation_id": "not-a-uuid"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_cursor_paging(self):
+        expected = {self.send(f"apple {i}").id for i in range(5)}
+
+        seen = []
+        params = {"q": "apple", "limit": 2}
+        while True:
+            data = self.search(**params)
+            seen.extend(m["id"] for m in data["results"])
+            if not data["next"]:
+                break
+            params["cursor"] = data["next"]
+
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(set(seen), expected)
+
+
+class UnreadCounterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.other = User.objects.create_user(username="bob", mobile="13800000001")
+        self.conversation = Conversation.objects.create(name="chat")
+        self.conversation.participants.add(self.user, self.other)
+        self.redis = get_redis_connection("default")
+        self.redis.delete(unread._key(self.user.id), unread._key(self.other.id))
+
+    def test_counters_follow_messages_and_reads(self):
+        cid = str(self.conversation.id)
+        self.assertEqual(unread.get_counts(self.user.id), {cid: 0})
+
+        messages = [
+            Message.objects.create(conversation=self.conversation, sender=self.other, content=str(i)) for i in range(2)
+        ]
+        unread.increment(self.conversation.id, 2)
+        self.assertEqual(unread.get_counts(self.user.id), {cid: 2})
+        # 未缓存的 hash 不做增量更新，避免生成不完整的 hash
+        self.assertFalse(self.redis.exists(unread._key(self.other.id)))
+
+        messages[0].mark_as_read(self.user)
+        unread.refresh(self.user.id, self.conversation.id)
+        self.assertEqual(unread.get_total(self.user.id), 1)
+        unread.refresh(self.other.id, self.conversation.id)
+        self.assertFalse(self.redis.exists(unread._key(self.other.id)))
+
+    def test_rebuild_corrects_drifted_counter(self):
+        unread.get_counts(self.user.id)
+        self.redis.hset(unread._key(self.user.id), str(self.conversation.id), 99)
+
+        unread.rebuild(self.user.id)
+
+        self.assertEqual(unread.get_counts(self.user.id), {str(self.conversation.id): 0})
+
+    def test_leaving_conversation_removes_counter(self):
+        other = Conversation.objects.create(name="other")
+        other.participants.add(self.user)
+        unread.get_counts(self.user.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conversation.participants.remove(self.user)
+        self.assertEqual(unread.get_counts(self.user.id), {str(other.id): 0})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ConversationMember.objects.filter(user=self.user).delete()
+        self.assertEqual(unread.get_total(self.user.id), 0)
+
+    def test_rebuild_task_discards_users_without_conversations(self):
+        cid = str(self.conversation.id)
+        unread.get_counts(self.user.id)
+        unread.get_counts(self.other.id)
+        # 离开对话时的删除未执行（例如 Redis 短暂不可用），留下过期的 field
+        self.conversation.participants.remove(self.user)
+        self.redis.hset(unread._key(self.user.id), cid, 5)
+        self.redis.hset(unread._key(self.other.id), cid, 5)
+
+        self.assertEqual(tasks.rebuild_unread_counters(), 1)
+
+        self.assertFalse(self.redis.exists(unread._key(self.user.id)))
+        self.assertEqual(unread.get_counts(self.user.id), {})
+        self.assertEqual(unread.get_counts(self.other.id), {cid: 0})
+
+    def test_user_without_conversations_is_cached(self):
+        loner = User.objects.create_user(username="carol", mobile="13800000002")
+        self.assertEqual(unread.get_counts(loner.id), {})
+
+        with self.assertNumQueries(0):
+            self.assertEqual(unread.get_counts(loner.id), {})
+
+
+class PrivateConversationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.other = User.objects.create_user(username="bob", mobile="13800000001")
+
+    def create(self, user, participants, is_group=False):
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post(
+            reverse("conversation-create"), {"participants": participants, "is_group": is_group}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()["data"]["conversation_id"]
+
+    def test_existing_private_conversation_is_returned(self):
+        first = self.create(self.user, [self.other.pk])
+        self.assertEqual(self.create(self.other, [self.user.pk]), first)
+        self.assertEqual(self.create(self.user, [self.user.pk, self.other.pk]), first)
+        self.assertEqual(Conversation.objects.get(id=first).private_key, f"{self.user.pk}:{self.other.pk}")
+
+    def test_group_conversations_are_not_deduplicated(self):
+        first = self.create(self.user, [self.other.pk], is_group=True)
+        self.assertNotEqual(self.create(self.user, [self.other.pk], is_group=True), first)
+
+
+class MembershipCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.conversation = Conversation.objects.create(name="chat")
+
+    def test_membership_is_cached_and_invalidated_on_change(self):
+        self.assertFalse(membership.is_member(self.conversation.id, self.user.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conversation.participants.add(self.user)
+        self.assertTrue(membership.is_member(self.conversation.id, self.user.id))
+
+        # 进程内缓存与 Redis 均命中时不查询数据库
+        with self.assertNumQueries(0):
+            self.assertTrue(membership.is_member(self.conversation.id, self.user.id))
+            membership._local.clear()
+            self.assertTrue(membership.is_member(self.conversation.id, self.user.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.conversations.remove(self.conversation)
+        self.assertFalse(membership.is_member(self.conversation.id, self.user.id))
+
+    def test_conversation_ids_are_cached_and_invalidated_on_change(self):
+        other = Conversation.objects.create(name="other")
+        self.assertEqual(membership.conversation_ids(self.user.id), frozenset())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conversation.participants.add(self.user)
+            ConversationMember.objects.create(conversation=other, user=self.user)
+        expected = {str(self.conversation.id), str(other.id)}
+        self.assertEqual(membership.conversation_ids(self.user.id), expected)
+
+        # 上线通知所需的对话列表在缓存命中时不查询数据库
+        with self.assertNumQueries(0):
+            membership._user_local.clear()
+            self.assertEqual(membership.conversation_ids(self.user.id), expected)
+            self.assertEqual(async_to_sync(membership.aconversation_ids)(self.user.id), expected)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.conversation.participants.clear()
+        self.assertEqual(membership.conversation_ids(self.user.id), {str(other.id)})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ConversationMember.objects.filter(conversation=other).delete()
+        self.assertEqual(membership.conversation_ids(self.user.id), frozenset())
+
+    def test_fill_racing_with_invalidation_is_discarded(self):
+        load = membership._load
+
+        def stale_load(conversation_id):
+            # 读取数据库之后、回填之前成员发生变化并失效
+            result = load(conversation_id)
+            self.conversation.participants.add(self.user)
+            membership.invalidate(conversation_id)
+            return result
+
+        with mock.patch.object(membership, "_load", stale_load):
+            self.assertFalse(membership.is_member(self.conversation.id, self.user.id))
+
+        self.assertFalse(get_redis_connection("default").exists(membership._key(self.conversation.id)))
+        self.assertTrue(membership.is_member(self.conversation.id, self.user.id))
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.addCleanup(presence.disconnect, self.user.id)
+
+    def test_online_until_last_connection_closes(self):
+        self.assertTrue(presence.connect(self.user.id))
+        self.assertFalse(presence.connect(self.user.id))
+        self.assertEqual(presence.online([self.user.id, self.user.id + 1]), {self.user.id})
+
+        self.assertFalse(presence.disconnect(self.user.id))
+        self.assertTrue(presence.disconnect(self.user.id))
+        self.assertEqual(presence.online([self.user.id]), set())
+
+        # 计数键过期后的心跳重新上线
+        self.assertTrue(presence.heartbeat(self.user.id))
+
+    def test_bulk_query_endpoint(self):
+        peer = User.objects.create_user(username="bob", mobile="13800000001")
+        stranger = User.objects.create_user(username="carol", mobile="13800000002")
+        conversation = Conversation.objects.create(name="chat")
+        conversation.participants.add(self.user, peer)
+        for user in (self.user, peer, stranger):
+            presence.connect(user.id)
+            self.addCleanup(presence.disconnect, user.id)
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        user_ids = [stranger.id, peer.id, self.user.id + 100, self.user.id]
+        response = client.post(reverse("presence"), {"user_ids": user_ids}, format="json")
+
+        self.assertEqual(response.status_code, 200)
+        # 没有共同对话的用户视为离线
+        self.assertEqual(response.json()["data"], {"online": [peer.id, self.user.id]})
+
+    @override_settings(IM_PRESENCE_WINDOW_MS=10)
+    def test_events_in_window_are_coalesced(self):
+        broadcasts = []
+
+        async def broadcast(*args):
+            broadcasts.append(args)
+
+        async def run():
+            coalescer = coalesce.Coalescer(broadcast)
+            coalescer.presence("c1", 1, True)
+            coalescer.typing("c1", 2)
+            coalescer.typing("c1", 2)
+            coalescer.typing("c1", 1)
+            coalescer.presence("c1", 1, False)
+            await asyncio.gather(*coalescer.tasks)
+
+        async_to_sync(run)()
+
+        self.assertEqual(broadcasts, [("c1", [], [1], [2])])
+
+
+class MessageExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.conversation = Conversation.objects.create(name="chat")
+        self.conversation.participants.add(self.user)
+        Message.objects.bulk_create(
+            [Message(conversation=self.conversation, sender=self.user, content=str(i), seq=i + 1) for i in range(5)]
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    @override_settings(MESSAGE_EXPORT_CHUNK_SIZE=2)
+    def test_streams_ndjson_in_chunks(self):
+        response = self.client.get(reverse("message-export", args=[self.conversation.id]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        chunks = list(response.streaming_content)
+        self.assertEqual(len(chunks), 3)
+        messages = [json.loads(line) for line in b"".join(chunks).splitlines()]
+        self.assertEqual([message["content"] for message in messages], ["0", "1", "2", "3", "4"])
+        self.assertEqual([message["seq"] for message in messages], [1, 2, 3, 4, 5])
+        self.assertEqual(messages[0]["sender"]["username"], "alice")
+
+    def test_requires_participant(self):
+        self.client.force_authenticate(User.objects.create_user(username="mallory", mobile="13800000009"))
+        response = self.client.get(reverse("message-export", args=[self.conversation.id]))
+        self.assertEqual(response.status_code, 404)
+
+
+class MessageEventTests(TestCase):
+    def test_pre_encoded_frames_match_per_consumer_encoding(self):
+        conversation_id = str(uuid.uuid4())
+        message = {
+            "id": 1,
+            "seq": 1,
+            "sender": {"id": 2, "username": "bob"},
+            "content": '含 "引号" 与换行\n',
+            "timestamp": timezone.now(),
+            "is_read": False,
+        }
+        event = consumers.message_event(conversation_id, message)
+
+        # 预编码的帧与各连接按协商的子协议逐个编码的结果逐字节相同
+        for consumer_class, text, data in (
+            (consumers.ChatConsumer, "text", "bytes"),
+            (consumers.MultiplexChatConsumer, "multiplex_text", "multiplex_bytes"),
+        ):
+            frame = consumer_class().message_frame(conversation_id, message)
+            self.assertEqual(event[text], protocol.encode(None, frame))
+            self.assertEqual(event[data], protocol.encode(protocol.MSGPACK, frame))
+
+
+class WriteBehindTests(TransactionTestCase):
+    @override_settings(IM_WRITE_BEHIND_INTERVAL_MS=60000)
+    def test_buffered_messages_are_flushed_in_one_batch(self):
+        user = User.objects.create_user(username="alice", mobile="13800000000")
+        conversation = Conversation.objects.create(name="chat")
+        conversation.participants.add(user)
+
+        async def send():
+            buffer = writebehind.get_buffer()
+            messages = [await buffer.add(conversation.id, user.id, str(i), "reply-channel") for i in range(3)]
+            # ID 在写入前已分配，写入发生在关闭时的 flush
+            self.assertEqual(await Message.objects.acount(), 0)
+            await writebehind.flush_all()
+            return messages
+
+        messages = async_to_sync(send)()
+
+        saved = list(Message.objects.order_by("id"))
+        self.assertEqual([message.id for message in saved], [message.id for message in messages])
+        self.assertEqual([message.seq for message in saved], [1, 2, 3])
+        self.assertEqual([message.timestamp for message in saved], [message.timestamp for message in messages])
+
+    @override_settings(IM_WRITE_BEHIND=True, IM_WRITE_BEHIND_INTERVAL_MS=60000)
+    def test_sync_cursor_does_not_skip_late_commits(self):
+        user = User.objects.create_user(username="alice", mobile="13800000000")
+        conversation = Conversation.objects.create(name="chat")
+        conversation.participants.add(user)
+        client = APIClient()
+        client.force_authenticate(user)
+
+        def sync(cursor):
+            data = client.post(reverse("sync"), {"cursors": {str(conversation.id): cursor}}, format="json").json()
+            (result,) = data["data"]["conversations"] or [{"messages": [], "cursor": cursor}]
+            return [message["id"] for message in result["messages"]], result["cursor"]
+
+        # 两个 worker 的缓冲：先到达的消息（较小的 ID）后写入
+        first, second = writebehind.MessageBuffer(), writebehind.MessageBuffer()
+        early = async_to_sync(first.add)(conversation.id, user.id, "early", "reply-channel")
+        late = async_to_sync(second.add)(conversation.id, user.id, "late", "reply-channel")
+        self.assertLess(early.id, late.id)
+        async_to_sync(second.flush)()
+
+        ids, cursor = sync(0)
+        self.assertEqual(ids, [late.id])
+        self.assertEqual(cursor, 0)
+
+        async_to_sync(first.flush)()
+        ids, cursor = sync(cursor)
+        self.assertEqual(ids, [early.id, late.id])
+
+        with override_settings(IM_WRITE_BEHIND_SETTLE_MS=0):
+            self.assertEqual(sync(cursor)[1], late.id)
+
+
+class DatabaseThreadPoolTests(TransactionTestCase):
+    def test_concurrent_calls_run_in_parallel_and_release_connections(self):
+        conversation = Conversation.objects.create(name="chat")
+        # 前 3 个调用互相等待：串行执行时会超时
+        barrier = threading.Barrier(3, timeout=5)
+        used = []
+
+        def work(i):
+            if i < 3:
+                barrier.wait()
+            count = Conversation.objects.filter(pk=conversation.pk).count()
+            used.append((threading.current_thread().name, connections["default"]))
+            return count + i
+
+        async def run():
+            return await asyncio.gather(*(database_sync_to_async(work)(i) for i in range(10)))
+
+        self.assertEqual(async_to_sync(run)(), [i + 1 for i in range(10)])
+        self.assertTrue(all(name.startswith("async-db") for name, _ in used))
+        self.assertGreaterEqual(len({name for name, _ in used}), 3)
+        # CONN_MAX_AGE=0：每次调用结束后关闭线程上的连接
+        self.assertTrue(all(conn.connection is None for _, conn in used))
+
+
+# 合并后的在线状态帧不插入到测试期望的帧之间
+@override_settings(IM_PRESENCE_WINDOW_MS=60000)
+class MultiplexConsumerTests(TransactionTestCase):
+    def test_subscribe_and_receive_tagged_messages(self):
+        alice = User.objects.create_user(username="alice", mobile="13800000000")
+        bob = User.objects.create_user(username="bob", mobile="13800000001")
+        shared = Conversation.objects.create(name="shared")
+        shared.participants.add(alice, bob)
+        private = Conversation.objects.create(name="private")
+        private.participants.add(bob)
+
+        async def run():
+            communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), "/ws/chat/")
+            communicator.scope["user"] = alice
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+
+            await communicator.send_json_to({"type": "subscribe", "conversation_id": str(private.id)})
+            self.assertEqual((await communicator.receive_json_from())["code"], "forbidden")
+
+            await communicator.send_json_to({"type": "subscribe", "conversation_id": str(shared.id)})
+            self.assertEqual((await communicator.receive_json_from())["type"], "subscribed")
+            await communicator.send_json_to({"type": "message", "conversation_id": str(shared.id), "message": "hi"})
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        frame = async_to_sync(run)()
+
+        self.assertEqual(frame["type"], "message")
+        self.assertEqual(frame["conversation_id"], str(shared.id))
+        self.assertEqual(frame["message"]["content"], "hi")
+        self.assertTrue(Message.objects.filter(conversation=shared, content="hi").exists())
+
+    def test_resume_replays_missed_messages(self):
+        alice = User.objects.create_user(username="alice", mobile="13800000000")
+        conversation = Conversation.objects.create(name="chat")
+        conversation.participants.add(alice)
+        app = URLRouter(routing.websocket_urlpatterns)
+
+        async def run():
+            sender = WebsocketCommunicator(app, f"/ws/chat/{conversation.id}/")
+            sender.scope["user"] = alice
+            await sender.connect()
+            for content in ("a", "b", "c"):
+                await sender.send_json_to({"message": content})
+                await sender.receive_json_from()
+            await sender.disconnect()
+
+            communicator = WebsocketCommunicator(app, "/ws/chat/")
+            communicator.scope["user"] = alice
+            await communicator.connect()
+            await communicator.send_json_to(
+                {"type": "subscribe", "conversation_id": str(conversation.id), "last_seq": 1}
+            )
+            frames = [await communicator.receive_json_from() for _ in range(3)]
+            await communicator.disconnect()
+            return frames
+
+        subscribed, *replayed = async_to_sync(run)()
+
+        self.assertEqual(subscribed["type"], "subscribed")
+        self.assertEqual([frame["message"]["seq"] for frame in replayed], [2, 3])
+        self.assertEqual([frame["message"]["content"] for frame in replayed], ["b", "c"])
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.last_seq, 3)
+
+    def test_conversation_consumer_rejects_invalid_frames(self):
+        alice = User.objects.create_user(username="alice", mobile="13800000000")
+        conversation = Conversation.objects.create(name="chat")
+        conversation.participants.add(alice)
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), f"/ws/chat/{conversation.id}/"
+            )
+            communicator.scope["user"] = alice
+            await communicator.connect()
+            errors = []
+            for text in ("not json", "[]", "{}", '{"message": {"a": 1}}', '{"message": 1}'):
+                await communicator.send_to(text_data=text)
+                errors.append(await communicator.receive_json_from())
+            # 错误帧之后连接仍然可用
+            await communicator.send_json_to({"message": "hi"})
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return errors, frame
+
+        errors, frame = async_to_sync(run)()
+
+        self.assertEqual(errors, [{"error": {"code": "invalid_frame"}}] * 5)
+        self.assertEqual(frame["message"]["content"], "hi")
+        self.assertEqual(list(Message.objects.values_list("content", flat=True)), ["hi"])
+
+    @override_settings(
+        IM_WRITE_BEHIND=True,
+        IM_WRITE_BEHIND_INTERVAL_MS=60000,
+        IM_WRITE_BEHIND_SETTLE_MS=50,
+        IM_PRESENCE_WINDOW_MS=60000,
+    )
+    def test_resume_replays_late_write_behind_messages(self):
+        alice = User.objects.create_user(username="alice", mobile="13800000000")
+        conversation = Conversation.objects.create(name="chat")
+        conversation.participants.add(alice)
+
+        async def run():
+            # 另一个 worker 已分配序号、尚未写入的消息
+            buffer = writebehind.MessageBuffer()
+            await buffer.add(conversation.id, alice.id, "late", "reply-channel")
+
+            communicator = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), f"/ws/chat/{conversation.id}/?last_seq=0"
+            )
+            communicator.scope["user"] = alice
+            await communicator.connect()
+            self.assertTrue(await communicator.receive_nothing(timeout=0.01))
+            await buffer.flush()
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        frame = async_to_sync(run)()
+
+        self.assertEqual((frame["message"]["seq"], frame["message"]["content"]), (1, "late"))
+
+    @override_settings(IM_READ_RECEIPT_INTERVAL_MS=20)
+    def test_read_frames_are_coalesced(self):
+        alice = User.objects.create_user(username="alice", mobile="13800000000")
+        bob = User.objects.create_user(username="bob", mobile="13800000001")
+        conversation = Conversation.objects.create(name="chat")
+        conversation.participants.add(alice, bob)
+        messages = [Message.objects.create(conversation=conversation, sender=alice, content=str(i)) for i in range(3)]
+        app = URLRouter(routing.websocket_urlpatterns)
+
+        async def run():
+            watcher = WebsocketCommunicator(app, "/ws/chat/")
+            watcher.scope["user"] = alice
+            await watcher.connect()
+            await watcher.send_json_to({"type": "subscribe", "conversation_id": str(conversation.id)})
+            await watcher.receive_json_from()
+
+            reader = WebsocketCommunicator(app, f"/ws/chat/{conversation.id}/")
+            reader.scope["user"] = bob
+            await reader.connect()
+            for message in messages:
+                await reader.send_json_to({"type": "read", "message_id": message.id})
+
+            frames = []
+            while not await watcher.receive_nothing(0.2):
+                frame = await watcher.receive_json_from()
+                if frame["type"] == "read":
+                    frames.append(frame)
+            await reader.disconnect()
+            await watcher.disconnect()
+            return frames
+
+        frames = async_to_sync(run)()
+
+        self.assertEqual(
+            frames,
+            [
+                {
+                    "type": "read",
+                    "conversation_id": str(conversation.id),
+                    "cursors": [{"user_id": bob.id, "message_id": messages[-1].id}],
+                }
+            ],
+        )
+        member = ConversationMember.objects.get(conversation=conversation, user=bob)
+        self.assertEqual(member.last_read_message_id, messages[-1].id)
+
+    @override_settings(IM_RATE_LIMIT_RATE=1, IM_RATE_LIMIT_BURST=2)
+    def test_frames_over_rate_limit_are_rejected(self):
+        alice = User.objects.create_user(username="alice", mobile="13800000000")
+
+        async def run():
+            communicator = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), "/ws/chat/")
+            communicator.scope["user"] = alice
+            await communicator.connect()
+            for _ in range(3):
+                await communicator.send_json_to({"type": "heartbeat"})
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        self.assertEqual(async_to_sync(run)()["code"], "rate_limited")
+
+    def test_msgpack_subprotocol(self):
+        alice = User.objects.create_user(username="alice", mobile="13800000000")
+        conversation = Conversation.objects.create(name="chat")
+        conversation.participants.add(alice)
+
+        async def run():
+            communicator = WebsocketCommunicator(
+                URLRouter(routing.websocket_urlpatterns), "/ws/chat/", subprotocols=[protocol.MSGPACK, "a.b.c"]
+            )
+            communicator.scope["user"] = alice
+            connected, subprotocol = await communicator.connect()
+            self.assertEqual(subprotocol, protocol.MSGPACK)
+
+            await communicator.send_to(
+                bytes_data=protocol.encode_msgpack({"type": "subscribe", "conversation_id": str(conversation.id)})
+            )
+            await communicator.receive_from()
+            await communicator.send_to(
+                bytes_data=protocol.encode_msgpack(
+                    {"type": "message", "conversation_id": str(conversation.id), "message": "hi"}
+                )
+            )
+            data = await communicator.receive_from()
+            await communicator.disconnect()
+            return data
+
+        data = async_to_sync(run)()
+
+        self.assertIsInstance(data, bytes)
+        frame = protocol.decode(bytes_data=data)
+        message = Message.objects.get(conversation=conversation)
+        self.assertEqual(frame["message"]["content"], "hi")
+        self.assertEqual(frame["message"]["timestamp"], int(message.timestamp.timestamp() * 1000))
+
+
+class SeqBackfillTests(TestCase):
+    def test_backfill_numbers_messages_per_conversation_in_id_order(self):
+        user = User.objects.create_user(username="alice", mobile="13800000000")
+        conversations = [Conversation.objects.create(name=f"chat-{i}") for i in range(2)]
+        messages = [
+            Message.objects.create(conversation=conversations[i % 2], sender=user, content=str(i)) for i in range(7)
+        ]
+        # 中断后继续：前两条已回填
+        Message.objects.filter(id__in=[messages[0].id, messages[1].id]).update(seq=1)
+
+        call_command("backfill_message_seq", batch_size=2, stdout=io.StringIO())
+
+        for conversation in conversations:
+            seqs = list(Message.objects.filter(conversation=conversation).order_by("id").values_list("seq", flat=True))
+            self.assertEqual(seqs, list(range(1, len(seqs) + 1)))
+
+
+class PartitionPeriodTests(TestCase):
+    def test_daily_period_is_aligned_to_utc_midnight(self):
+        moment = datetime(2026, 10, 18, 1, 30, tzinfo=ZoneInfo("Asia/Shanghai"))
+        start = partitions.period_start(moment)
+        self.assertEqual(start, datetime(2026, 10, 17, tzinfo=dt_timezone.utc))
+        self.assertEqual(partitions.partition_name(start), "im_message_p20261017")
+
+    @override_settings(MESSAGE_PARTITION_INTERVAL="week")
+    def test_weekly_period_starts_on_monday(self):
+        start = partitions.period_start(datetime(2026, 10, 18, 12, tzinfo=dt_timezone.utc))
+        self.assertEqual(start, datetime(2026, 10, 12, tzinfo=dt_timezone.utc))
+        self.assertEqual(partitions.get_interval(), timedelta(weeks=1))
+
+    def test_noop_when_table_is_not_partitioned(self):
+        self.assertFalse(partitions.is_partitioned())
+        self.assertEqual(partitions.create_partitions(), [])
+        self.assertEqual(partitions.drop_expired_partitions(datetime.now(dt_timezone.utc)), [])
+
+
+class PartitionConversionTests(TransactionTestCase):
+    # 在 im_message 的副本上转换，不影响其它测试使用的表；ORM 缓存了列所属的表名，副本只用原生 SQL 读写
+    table = "im_message_conversion"
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE TABLE {self.table} (LIKE im_message INCLUDING ALL)")
+        self.addCleanup(self.drop_table)
+        patcher = mock.patch.object(Message._meta, "db_table", self.table)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.conversation = Conversation.objects.create(name="chat")
+
+    def drop_table(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {self.table} CASCADE")
+
+    def create_messages(self, *timestamps):
+        with connection.cursor() as cursor:
+            for timestamp in timestamps:
+                cursor.execute(
+                    f"INSERT INTO {self.table} (conversation_id, sender_id, content, timestamp, created_at, updated_at) "
+                    "VALUES (%s, %s, 'hi', %s, now(), now())",
+                    [self.conversation.id, self.user.id, timestamp],
+                )
+
+    def count_messages(self):
+        """:return: (消息数, 不同 ID 数)"""
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*), COUNT(DISTINCT id) FROM {self.table}")
+            return cursor.fetchone()
+
+    @override_settings(MESSAGE_PARTITION_PREMAKE=1)
+    def test_convert_then_create_and_drop_partitions(self):
+        now = datetime(2026, 10, 18, 12, tzinfo=dt_timezone.utc)
+        self.create_messages(now - timedelta(days=2), now - timedelta(days=1), now)
+
+        boundary = partitions.convert_table(now=now)
+        self.assertEqual(boundary, datetime(2026, 10, 20, tzinfo=dt_timezone.utc))
+        self.assertTrue(partitions.is_partitioned())
+        # 转换时提前创建的分区止于边界（当前周期之后 1 个周期均在历史分区内）
+        self.assertEqual(partitions.create_partitions(ahead=2, now=now), ["im_message_conversion_p20261020"])
+
+        self.assertEqual(
+            partitions.list_partitions(),
+            [
+                ("im_message_conversion_legacy", boundary, False),
+                ("im_message_conversion_p20261020", boundary + timedelta(days=1), False),
+            ],
+        )
+        # 主键序列接续原表，新消息写入对应的分区
+        self.create_messages(boundary + timedelta(hours=1))
+        self.assertEqual(self.count_messages(), (4, 4))
+
+        self.assertEqual(partitions.drop_expired_partitions(boundary, dry_run=True), ["im_message_conversion_legacy"])
+        self.assertEqual(self.count_messages(), (4, 4))
+
+        self.assertEqual(
+            partitions.drop_expired_partitions(boundary + timedelta(days=1)),
+            ["im_message_conversion_legacy", "im_message_conversion_p20261020"],
+        )
+        self.assertEqual(partitions.list_partitions(), [])
+        self.assertEqual(self.count_messages(), (0, 0))
+
+
+class RetentionTests(TestCase):
+    def setUp(self):
+        archive_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_root)
+        overridden = override_settings(MESSAGE_ARCHIVE_ENABLED=True, MESSAGE_ARCHIVE_ROOT=archive_root)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+        user = User.objects.create_user(username="alice", mobile="13800000000")
+        self.conversations = [Conversation.objects.create(name=f"chat-{i}") for i in range(2)]
+        messages = Message.objects.bulk_create(
+            [
+                Message(conversation=conversation, sender=user, content=str(i), seq=i + 1)
+                for conversation in self.conversations
+                for i in range(5)
+            ]
+        )
+        self.expired = [message.id for message in messages if message.content in ("0", "1", "2")]
+        Message.objects.filter(id__in=self.expired).update(timestamp=datetime(2026, 1, 1, 8, tzinfo=dt_timezone.utc))
+
+    def test_dry_run_only_counts(self):
+        result = retention.purge_expired_messages(batch_size=2, dry_run=True)
+        self.assertEqual(result["deleted"], 6)
+        self.assertEqual(Message.objects.count(), 10)
+
+    def test_purge_in_keyset_batches(self):
+        result = retention.purge_expired_messages(batch_size=4, resume=False, archive=False)
+        self.assertEqual(result["deleted"], 6)
+        self.assertFalse(Message.objects.filter(id__in=self.expired).exists())
+        self.assertEqual(Message.objects.count(), 4)
+
+    @override_settings(MESSAGE_ARCHIVE_ROOT="")
+    def test_archive_requires_root(self):
+        with self.assertRaises(ImproperlyConfigured):
+            retention.purge_expired_messages(resume=False)
+        self.assertEqual(Message.objects.count(), 10)
+
+    def test_archive_before_purge(self):
+        retention.purge_expired_messages(resume=False)
+        self.assertFalse(Message.objects.filter(id__in=self.expired).exists())
+
+        for conversation in self.conversations:
+            archived = list(archive.read_conversation(datetime(2026, 1, 1), conversation.id))
+            self.assertEqual([message["content"] for message in archived], ["0", "1", "2"])
+            # 恢复归档的历史时可按 seq 与在线消息衔接
+            self.assertEqual([message["seq"] for message in archived], [1, 2, 3])
+            self.assertEqual({message["conversation_id"] for message in archived}, {str(conversation.id)})
+        self.assertEqual(list(archive.read_conversation(datetime(2026, 1, 2), self.conversations[0].id)), [])
@@ -0,0 +1,187 @@
+"""
+未读数计数器
+
+在 Redis 中为每个用户维护一个 hash：field 为对话 ID，value 为该对话的未读数。
+  - 新消息写入后为对话所有参与者 HINCRBY
+  - 标记已读后按数据库重新计算该对话的未读数
+  - 用户离开对话（ConversationMember 删除）后在事务提交后删除该对话的 field
+  - 查询总未读数只需一次 HGETALL
+计数器只在 hash 已存在时增量更新，避免缓存冷启动时生成不完整的 hash；
+hash 不存在时从数据库重建，并由定时任务 rebuild_unread_counters 定期校准
+（已没有任何对话的用户的 hash 直接删除；保留期清理删除消息后同样会校准）。
+重建的 hash 总是包含一个占位 field，没有任何对话的用户同样命中缓存，不会每次查询都重建。
+"""
+import logging
+
+from django.db import transaction
+from django.db.models import Q
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+
+from .models import ConversationMember
+
+logger = logging.getLogger(__name__)
+
+UNREAD_KEY = "im:unread:{user_id}"
+# hash 中的占位 field：区分“已缓存但没有对话”与“未缓存”
+_PLACEHOLDER = "-"
+
+# KEYS: 各用户的未读 hash；ARGV[1]: 对话 ID；ARGV[2]: 增量
+_INCR_IF_EXISTS = """
+for _, key in ipairs(KEYS) do
+    if redis.call("EXISTS", key) == 1 then
+        redis.call("HINCRBY", key, ARGV[1], ARGV[2])
+    end
+end
+return 0
+"""
+
+# KEYS[1]: 用户的未读 hash；ARGV[1]: 对话 ID；ARGV[2]: 未读数
+_SET_IF_EXISTS = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+end
+return 0
+"""
+
+
+def _key(user_id) -> str:
+    return UNREAD_KEY.format(user_id=user_id)
+
+
+def increment(conversation_id, amount: int = 1):
+    """
+    对话有新消息时，为所有参与者的未读数加 amount
+    :param conversation_id: 对话 ID
+    :param amount: 新消息条数
+    :return:
+    """
+    user_ids = ConversationMember.objects.filter(conversation_id=conversation_id).values_list("user_id", flat=True)
+    keys = [_key(user_id) for user_id in user_ids]
+    if not keys:
+        return
+    try:
+        redis = get_redis_connection("default")
+        redis.register_script(_INCR_IF_EXISTS)(keys=keys, args=[str(conversation_id), amount])
+    except RedisError as e:
+        # 计数器失效不影响消息收发，由定时任务校准
+        logger.warning(f"Failed to increment unread counters of conversation {conversation_id}: {e}")
+
+
+def refresh(user_id, conversation_id):
+    """
+    已读游标变化后，按数据库重新计算用户在该对话中的未读数
+    :param user_id: 用户 ID
+    :param conversation_id: 对话 ID
+    :return:
+    """
+    refresh_many([(user_id, conversation_id)])
+
+
+def refresh_many(pairs):
+    """
+    批量刷新未读数：一次查询计算所有 (用户, 对话) 的未读数，一次 Redis 往返写入
+    :param pairs: [(用户 ID, 对话 ID)]
+    :return:
+    """
+    if not pairs:
+        return
+    condition = Q()
+    for user_id, conversation_id in pairs:
+        condition |= Q(user_id=user_id, conversation_id=conversation_id)
+    counts = list(
+        ConversationMember.objects.filter(condition)
+        .with_unread_count()
+        .values_list("user_id", "conversation_id", "unread_count")
+    )
+    if not counts:
+        return
+    try:
+        redis = get_redis_connection("default")
+        script = redis.register_script(_SET_IF_EXISTS)
+        pipe = redis.pipeline(transaction=False)
+        for user_id, conversation_id, count in counts:
+            script(keys=[_key(user_id)], args=[str(conversation_id), count], client=pipe)
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Failed to refresh {len(counts)} unread counters: {e}")
+
+
+def remove(user_id, conversation_id):
+    """
+    用户离开对话后删除该对话的未读数
+    :param user_id: 用户 ID
+    :param conversation_id: 对话 ID
+    :return:
+    """
+    try:
+        get_redis_connection("default").hdel(_key(user_id), str(conversation_id))
+    except RedisError as e:
+        logger.warning(f"Failed to remove unread counter of user {user_id} in {conversation_id}: {e}")
+
+
+def on_member_deleted(sender, instance, **kwargs):
+    # 提交前删除的 field 可能被并发的刷新按旧的成员关系重新写入
+    user_id, conversation_id = instance.user_id, instance.conversation_id
+    transaction.on_commit(lambda: remove(user_id, conversation_id))
+
+
+def rebuild(user_id, counts=None) -> dict:
+    """
+    从数据库重建用户的未读 hash
+    :param user_id: 用户 ID
+    :param counts: 已计算好的 {对话 ID: 未读数}，为空时查询数据库
+    :return: {对话 ID: 未读数}
+    """
+    if counts is None:
+        members = ConversationMember.objects.filter(user_id=user_id).with_unread_count()
+        counts = {str(cid): count for cid, count in members.values_list("conversation_id", "unread_count")}
+
+    redis = get_redis_connection("default")
+    pipe = redis.pipeline(transaction=True)
+    pipe.delete(_key(user_id))
+    pipe.hset(_key(user_id), mapping={_PLACEHOLDER: 0, **counts})
+    pipe.execute()
+    return counts
+
+
+def discard_except(user_ids) -> int:
+    """
+    删除 user_ids 之外用户的未读 hash：校准时这些用户已没有任何对话，hash 中只剩过期的 field，下次查询时重建
+    :param user_ids: 已重建的用户 ID 集合
+    :return: 删除的 hash 数
+    """
+    redis = get_redis_connection("default")
+    prefix = _key("")
+    stale = [
+        key for key in redis.scan_iter(match=_key("*"), count=1000) if int(key.decode()[len(prefix) :]) not in user_ids
+    ]
+    for i in range(0, len(stale), 1000):
+        redis.delete(*stale[i : i + 1000])
+    return len(stale)
+
+
+def get_counts(user_id) -> dict:
+    """
+    获取用户各对话的未读数
+    :param user_id: 用户 ID
+    :return: {对话 ID: 未读数}
+    """
+    try:
+        counts = get_redis_connection("default").hgetall(_key(user_id))
+        if counts:
+            return {cid.decode(): int(count) for cid, count in counts.items() if cid != _PLACEHOLDER.encode()}
+        return rebuild(user_id)
+    except RedisError as e:
+        logger.warning(f"Failed to read unread counters of user {user_id}: {e}")
+        members = ConversationMember.objects.filter(user_id=user_id).with_unread_count()
+        return {str(cid): count for cid, count in members.values_list("conversation_id", "unread_count")}
+
+
+def get_total(user_id) -> int:
+    """
+    获取用户所有对话的未读总数
+    :param user_id: 用户 ID
+    :return:
+    """
+    return sum(get_counts(user_id).values())
@@ -7,12 +7,26 @@ urlpatterns = [
     path("conversation/", views.ConversationView.as_view(), name="conversation-create"),
     path("conversation/<uuid:conversation_id>/", views.ConversationDetailView.as_view(), name="conversation-detail"),
     path("conversation/<uuid:conversation_id>/messages/", views.MessageHistoryView.as_view(), name="message-history"),
-    path("messages/<uuid:message_id>/read/", views.MarkAsReadView.as_view(), name="mark-as-read"),
+    path(
+        "conversation/<uuid:conversation_id>/messages/export/",
+        views.MessageExportView.as_view(),
+        name="message-export",
+    ),
+    path("messages/<int:message_id>/read/", views.MarkAsReadView.as_view(), name="mark-as-read"),
     path(
         "conversations/<uuid:conversation_id>/read/",
         views.MarkConversationAsReadView.as_view(),
         name="mark-conversation-as-read",
     ),
+    path(
+        "conversations/<uuid:conversation_id>/read/bulk/",
+        views.BulkMarkAsReadView.as_view(),
+        name="bulk-mark-as-read",
+    ),
     path("unread/", views.UnreadCountView.as_view(), name="unread-count"),
     path("unread/<uuid:conversation_id>/", views.UnreadCountView.as_view(), name="unread-count-conversation"),
+    path("sync/", views.SyncView.as_view(), name="sync"),
+    path("presence/", views.PresenceView.as_view(), name="presence"),
+    path("flowcontrol/", views.FlowControlStatsView.as_view(), name="flowcontrol-stats"),
+    path("messages/search/", views.MessageSearchView.as_view(), name="message-search"),
 ]
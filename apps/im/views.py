@@ -1,12 +1,21 @@
+import uuid
+from collections import defaultdict
 from datetime import timedelta
 
 from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
+from django.utils.decorators import method_decorator
 from django.utils.translation import gettext_lazy as _
+from django.views.decorators.http import condition
 from drf_spectacular.utils import OpenApiParameter
 from drf_spectacular.utils import extend_schema
+from rest_framework import exceptions
 from rest_framework import status
+from rest_framework.permissions import IsAdminUser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -14,11 +23,22 @@ from rest_framework.views import APIView
 from core.response import StandardResponse
 from core.stat_code import StatCode
 
+from . import conditional
+from . import export
+from . import flowcontrol
+from . import presence
+from . import unread
 from .models import Conversation
+from .models import ConversationMember
 from .models import Message
+from .pagination import MessageCursorPagination
+from .pagination import MessageSearchPagination
 from .serializers import ConversationCreateSerializer
 from .serializers import ConversationSerializer
 from .serializers import MessageSerializer
+from .serializers import PresenceQuerySerializer
+from .serializers import ReadReceiptSerializer
+from .serializers import SyncSerializer
 
 
 class ConversationListView(APIView):
@@ -26,16 +46,17 @@ class ConversationListView(APIView):
 
     @extend_schema(
         summary="获取当前用户参与的所有对话列表",
-        description="查询参与的所有对话最近一条消息",
+        description="查询参与的所有对话最近一条消息。支持 If-None-Match 条件请求",
         tags=[_("IM")],
     )
+    @method_decorator(condition(etag_func=conditional.conversation_list_etag))
     def get(self, request):
         """
         获取当前用户参与的所有对话列表（查询参与的所有对话最近一条消息）
         :param request:
         :return:
         """
-        conversations = Conversation.objects.filter(participants=request.user)
+        conversations = Conversation.objects.filter(participants=request.user).with_summary(request.user)
         serializer = ConversationSerializer(conversations, many=True, context={"request": request})
         return StandardResponse(StatCode.SUCCESS, data=serializer.data)
 
@@ -88,9 +109,10 @@ class ConversationDetailView(APIView):
 
     @extend_schema(
         summary="获取特定对话信息",
-        description="查询最近一条对话消息",
+        description="查询最近一条对话消息。支持 If-None-Match 条件请求",
         tags=[_("IM")],
     )
+    @method_decorator(condition(etag_func=conditional.conversation_etag))
     def get(self, request, conversation_id):
         """
         获取特定对话信息（查询最近一条消息）
@@ -98,7 +120,9 @@ class ConversationDetailView(APIView):
         :param conversation_id:
         :return:
         """
-        conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
+        conversation = get_object_or_404(
+            Conversation.objects.with_summary(request.user), id=conversation_id, participants=request.user
+        )
 
         serializer = ConversationSerializer(conversation, context={"request": request})
         return StandardResponse(StatCode.SUCCESS, data=serializer.data)
@@ -106,27 +130,67 @@ class ConversationDetailView(APIView):
 
 class MessageHistoryView(APIView):
     permission_classes = [IsAuthenticated]
+    pagination_class = MessageCursorPagination
 
     @extend_schema(
+        parameters=[
+            OpenApiParameter(name="before", type=str, required=False, description="返回该游标之前（更早）的消息"),
+            OpenApiParameter(name="after", type=str, required=False, description="返回该游标之后（更新）的消息"),
+            OpenApiParameter(name="limit", type=int, required=False, description="每页条数"),
+        ],
         summary="获取特定对话的历史消息",
-        description="获取特定对话的指定时间区间内的历史消息",
+        description="按游标分页获取特定对话保留期限内的历史消息。支持 If-None-Match 条件请求",
         tags=[_("IM")],
     )
+    @method_decorator(condition(etag_func=conditional.message_history_etag))
     def get(self, request, conversation_id):
         """
-        获取特定对话的历史消息
+        获取特定对话的历史消息（游标分页）
         :param request:
         :param conversation_id:
-        :return:
+        :return: {"results": [...], "before": "cursor", "after": "cursor", "has_more": true}
         """
         conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
 
-        # 获取一周内的消息
-        one_week_ago = timezone.now() - timedelta(days=settings.MESSAGE_RETENTION_DAYS)
-        messages = conversation.messages.filter(timestamp__gte=one_week_ago)
+        # 只返回保留期限内的消息
+        retention_cutoff = timezone.now() - timedelta(days=settings.MESSAGE_RETENTION_DAYS)
+        messages = conversation.messages.filter(timestamp__gte=retention_cutoff).select_related("sender")
+
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(messages, request, view=self)
+        serializer = MessageSerializer(page, many=True, context={"request": request})
+        return StandardResponse(StatCode.SUCCESS, data=paginator.get_paginated_data(serializer.data))
 
-        serializer = MessageSerializer(messages, many=True, context={"request": request})
-        return StandardResponse(StatCode.SUCCESS, data=serializer.data)
+
+class MessageExportView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        summary="导出特定对话的历史消息",
+        description="以 NDJSON（每行一条 JSON 消息，按时间正序）流式导出对话保留期限内的全部消息，用于审计",
+        tags=[_("IM")],
+    )
+    def get(self, request, conversation_id):
+        """
+        流式导出对话历史，边读边输出，内存占用与消息数量无关
+        :param request:
+        :param conversation_id:
+        :return: application/x-ndjson
+        """
+        conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
+
+        retention_cutoff = timezone.now() - timedelta(days=settings.MESSAGE_RETENTION_DAYS)
+        messages = conversation.messages.filter(timestamp__gte=retention_cutoff)
+
+        # ASGI 下同步迭代器会被整体读入内存后再发送，需使用异步迭代器
+        if isinstance(request._request, ASGIRequest):
+            content = export.aiter_ndjson(messages)
+        else:
+            content = export.iter_ndjson(messages)
+
+        response = StreamingHttpResponse(content, content_type="application/x-ndjson")
+        response["Content-Disposition"] = f'attachment; filename="conversation-{conversation.id}.ndjson"'
+        return response
 
 
 class MarkAsReadView(APIView):
@@ -147,14 +211,15 @@ class MarkAsReadView(APIView):
         :param message_id:
         :return:
         """
-        message = get_object_or_404(Message, id=message_id)
+        message = get_object_or_404(Message.objects.only("id", "conversation_id"), id=message_id)
 
         # 验证用户是否有权限访问这条消息
-        if request.user not in message.conversation.participants.all():
+        if not ConversationMember.objects.filter(conversation_id=message.conversation_id, user=request.user).exists():
             return Response({"error": "Permission denied"}, status=status.HTTP_403_FORBIDDEN)
 
         marked = message.mark_as_read(request.user)
         if marked:
+            unread.refresh(request.user.id, message.conversation_id)
             return StandardResponse(StatCode.SUCCESS, _("marked as read"))
         else:
             return StandardResponse(StatCode.SUCCESS, _("already read"))
@@ -178,16 +243,49 @@ class MarkConversationAsReadView(APIView):
         :param conversation_id:
         :return:
         """
-        conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
-
-        # 标记所有未读消息为已读
-        unread_messages = conversation.messages.exclude(read_by=request.user)
-        for message in unread_messages:
-            message.mark_as_read(request.user)
+        if not ConversationMember.objects.mark_read(conversation_id, request.user.id):
+            raise Http404
+        unread.refresh(request.user.id, conversation_id)
 
         return StandardResponse(StatCode.SUCCESS, _("all messages marked as read"))
 
 
+class BulkMarkAsReadView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        request=ReadReceiptSerializer,
+        parameters=[
+            OpenApiParameter(name="conversation_id", type=str, location="path", required=True, description="对话ID")
+        ],
+        summary="批量标记消息为已读",
+        description="按消息 ID 列表或“已读到某条消息”批量标记已读，单条 SQL 完成权限校验与写入",
+        tags=[_("IM")],
+    )
+    def post(self, request, conversation_id):
+        """
+        批量标记消息为已读。请求体示例：
+        {"message_ids": [101, 102, 108]} 或 {"up_to": 108}
+        :param request:
+        :param conversation_id:
+        :return:
+        """
+        serializer = ReadReceiptSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        marked = ConversationMember.objects.mark_read(
+            conversation_id,
+            request.user.id,
+            message_ids=serializer.validated_data.get("message_ids"),
+            up_to=serializer.validated_data.get("up_to"),
+        )
+        if not marked:
+            raise Http404
+        unread.refresh(request.user.id, conversation_id)
+
+        return StandardResponse(StatCode.SUCCESS, _("marked as read"))
+
+
 class UnreadCountView(APIView):
     permission_classes = [IsAuthenticated]
 
@@ -206,14 +304,203 @@ class UnreadCountView(APIView):
         :param conversation_id:
         :return:
         """
+        # 未读数由 Redis 计数器维护，见 im.unread
         if conversation_id:
-            conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
-            count = conversation.messages.exclude(read_by=request.user).count()
+            get_object_or_404(ConversationMember, conversation_id=conversation_id, user=request.user)
+            count = unread.get_counts(request.user.id).get(str(conversation_id), 0)
         else:
             # 所有对话的未读消息总数
-            conversations = Conversation.objects.filter(participants=request.user)
-            count = 0
-            for conversation in conversations:
-                count += conversation.messages.exclude(read_by=request.user).count()
+            count = unread.get_total(request.user.id)
 
         return StandardResponse(StatCode.SUCCESS, data={"unread_count": count})
+
+
+class PresenceView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        request=PresenceQuerySerializer,
+        summary="批量查询在线状态",
+        description="返回给定用户中当前在线的用户 ID，只包括与当前用户有共同对话的用户，一次 Redis MGET 完成",
+        tags=[_("IM")],
+    )
+    def post(self, request):
+        """
+        批量查询在线状态。请求体示例：
+        {"user_ids": [1, 2, 3]}
+        与当前用户没有共同对话的用户总是视为离线，不能借此探测任意用户的在线状态
+        :param request:
+        :return: {"online": [1, 3]}
+        """
+        serializer = PresenceQuerySerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user_ids = serializer.validated_data["user_ids"]
+
+        visible = set(
+            ConversationMember.objects.filter(user_id__in=user_ids, conversation__members__user=request.user)
+            .values_list("user_id", flat=True)
+            .distinct()
+        )
+        visible.add(request.user.id)
+        online = presence.online([user_id for user_id in user_ids if user_id in visible])
+        return StandardResponse(
+            StatCode.SUCCESS, data={"online": [user_id for user_id in dict.fromkeys(user_ids) if user_id in online]}
+        )
+
+
+class FlowControlStatsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    @extend_schema(
+        summary="WebSocket 流量控制计数",
+        description="累计因限流丢弃的客户端帧数（throttled_frames）与因读取过慢被关闭的连接数（slow_consumers），仅限 staff",
+        tags=[_("IM")],
+    )
+    def get(self, request):
+        return StandardResponse(StatCode.SUCCESS, data=flowcontrol.get_counters())
+
+
+class SyncView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    @extend_schema(
+        request=SyncSerializer,
+        summary="增量同步",
+        description="断线重连后按各对话的游标一次性拉取所有对话的新消息与已读状态变化",
+        tags=[_("IM")],
+    )
+    def post(self, request):
+        """
+        增量同步。请求体示例：
+        {
+          "cursors": {"<conversation_id>": 1024},   # 各对话已收到的最大消息 ID
+          "since": "2025-01-01T00:00:00+08:00",    # 上次同步返回的 server_time
+          "limit": 50
+        }
+        只返回有变化的对话；客户端不认识的对话返回最新的 limit 条消息。
+        has_more 为 true 表示游标与返回的消息之间仍有缺口，可用历史消息接口的 before 游标补齐。
+        写后模式（IM_WRITE_BEHIND）下较小的消息 ID 可能晚于较大的 ID 写入，返回的 cursor 只推进到
+        到达时间早于 IM_WRITE_BEHIND_SETTLE_MS 的消息，更新的消息可能在下次同步中再次返回，客户端按消息 ID 去重
+        :param request:
+        :return: {
+          "server_time": "...",
+          "conversations": [{"conversation_id", "messages", "has_more", "cursor",
+                             "last_read_message_id", "unread_count", "read_cursors"}],
+          "removed": ["<conversation_id>"]
+        }
+        """
+        serializer = SyncSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        cursors = serializer.validated_data["cursors"]
+        since = serializer.validated_data.get("since")
+        limit = serializer.validated_data["limit"]
+
+        # 先记录服务端时间，同步期间发生的变化留给下一次同步
+        server_time = timezone.now()
+
+        read_cursors = dict(
+            ConversationMember.objects.filter(user=request.user).values_list("conversation_id", "last_read_message_id")
+        )
+
+        retention_cutoff = server_time - timedelta(days=settings.MESSAGE_RETENTION_DAYS)
+        messages = list(
+            Message.objects.filter(timestamp__gte=retention_cutoff)
+            .after_cursors({cid: cursors.get(cid) for cid in read_cursors}, limit + 1)
+            .select_related("sender")
+            .order_by("conversation_id", "id")
+        )
+        context = {"request": request, "read_cursors": dict(read_cursors)}
+        message_data = MessageSerializer(messages, many=True, context=context).data
+
+        grouped = defaultdict(list)
+        for message, data in zip(messages, message_data):
+            grouped[message.conversation_id].append((message, data))
+
+        # 写后模式下，到达时间晚于 settled_before 的消息之前可能还有未写入的消息，游标不越过它们
+        settled_before = None
+        if settings.IM_WRITE_BEHIND:
+            settled_before = server_time - timedelta(milliseconds=settings.IM_WRITE_BEHIND_SETTLE_MS)
+
+        # 其他参与者（以及自己在其他设备上）的已读游标变化
+        read_changes = defaultdict(dict)
+        if since:
+            changed = ConversationMember.objects.filter(
+                conversation_id__in=read_cursors.keys(), last_read_at__gt=since
+            ).values_list("conversation_id", "user_id", "last_read_message_id")
+            for conversation_id, user_id, last_read_message_id in changed:
+                read_changes[conversation_id][user_id] = last_read_message_id
+
+        unread_counts = unread.get_counts(request.user.id)
+
+        conversations = []
+        for conversation_id, last_read_message_id in read_cursors.items():
+            items = grouped.get(conversation_id, [])
+            known = conversation_id in cursors
+            if known and not items and conversation_id not in read_changes:
+                continue
+
+            # 每个对话多取了一条，超出 limit 说明存在缺口
+            has_more = len(items) > limit
+            items = items[-limit:]
+            settled = [m.id for m, _ in items if settled_before is None or m.timestamp <= settled_before]
+            cursor = max(settled, default=cursors.get(conversation_id))
+            conversations.append(
+                {
+                    "conversation_id": str(conversation_id),
+                    "messages": [data for _, data in items],
+                    "has_more": has_more,
+                    "cursor": cursor,
+                    "last_read_message_id": last_read_message_id,
+                    "unread_count": unread_counts.get(str(conversation_id), 0),
+                    "read_cursors": read_changes.get(conversation_id, {}),
+                }
+            )
+
+        removed = [str(conversation_id) for conversation_id in cursors if conversation_id not in read_cursors]
+
+        return StandardResponse(
+            StatCode.SUCCESS,
+            data={"server_time": server_time.isoformat(), "conversations": conversations, "removed": removed},
+        )
+
+
+class MessageSearchView(APIView):
+    permission_classes = [IsAuthenticated]
+    pagination_class = MessageSearchPagination
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(name="q", type=str, required=True, description="检索词，支持 websearch 语法"),
+            OpenApiParameter(name="conversation_id", type=str, required=False, description="只检索该对话"),
+            OpenApiParameter(name="cursor", type=str, required=False, description="上一页返回的 next 游标"),
+            OpenApiParameter(name="limit", type=int, required=False, description="每页条数"),
+        ],
+        summary="检索消息",
+        description="在当前用户参与的对话中全文检索消息，按相关度排序并游标分页",
+        tags=[_("IM")],
+    )
+    def get(self, request):
+        """
+        检索消息
+        :param request:
+        :return: {"results": [...], "next": "cursor"}
+        """
+        text = request.query_params.get("q", "").strip()
+        if not text:
+            raise exceptions.ValidationError({"q": _("This field is required.")})
+
+        messages = Message.objects.search(text).filter(conversation__members__user=request.user)
+        conversation_id = request.query_params.get("conversation_id")
+        if conversation_id:
+            try:
+                conversation_id = uuid.UUID(conversation_id)
+            except ValueError:
+                raise exceptions.ValidationError(
+                    {"conversation_id": _("“%(value)s” is not a valid UUID.") % {"value": conversation_id}}
+                )
+            messages = messages.filter(conversation_id=conversation_id)
+
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(messages.select_related("sender"), request, view=self)
+        serializer = MessageSerializer(page, many=True, context={"request": request})
+        return StandardResponse(StatCode.SUCCESS, data=paginator.get_paginated_data(serializer.data))
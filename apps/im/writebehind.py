@@ -0,0 +1,220 @@
+"""
+ChatConsumer 的写后（write-behind）消息持久化，由 IM_WRITE_BEHIND 开启
+
+收到消息时只从消息主键序列预留 ID 并分配对话内序号（同一时刻到达的多条消息共用一次预留），随即广播；
+消息在内存中缓冲，每隔 IM_WRITE_BEHIND_INTERVAL_MS 毫秒或缓冲满 IM_WRITE_BEHIND_MAX_BATCH 条时用一次 bulk_create 写入，
+同时刷新对话版本与未读计数。
+  - 写入失败会重试，最终失败时向发送者的 channel 发送 chat.error 事件，告知未保存的消息 ID
+  - worker 关闭时（ASGI lifespan.shutdown）写入剩余的缓冲
+
+ID 与序号在消息到达时分配，但各 worker 的缓冲独立写入：较小的 ID（序号）可能晚于较大的 ID 写入、变得可见。
+按 id > 游标 查询的增量同步因此不能把游标推进到刚到达的消息之后，否则会永久跳过晚写入的消息：
+开启写后模式时 SyncView 返回的游标只推进到到达时间早于 IM_WRITE_BEHIND_SETTLE_MS 的消息，
+更新的消息仍然返回，下次同步会再次返回（客户端按 ID 去重）。写入超过该时间仍未完成（如数据库长时间不可用）时仍可能遗漏。
+消息在写入前通过 REST 接口不可见，最终写入失败的消息在对话序号中留下空洞。
+"""
+import asyncio
+import logging
+import weakref
+from collections import Counter
+from collections import defaultdict
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+from django.utils import timezone
+
+from core import lifespan
+from core.db import database_sync_to_async
+
+from . import unread
+from .models import Conversation
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+# 写入失败时的尝试次数与重试间隔（秒）
+FLUSH_ATTEMPTS = 3
+RETRY_DELAY = 0.2
+
+
+def _reserve_ids(count):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+            [Message._meta.db_table, count],
+        )
+        return sorted(row[0] for row in cursor.fetchall())
+
+
+def _reserve(conversation_ids):
+    """
+    为依次到达的消息预留 ID 与对话内序号，同一对话中 ID 与序号的顺序一致
+    :param conversation_ids: 每条消息所属的对话 ID
+    :return: 与 conversation_ids 一一对应的 (ID, 序号)
+    """
+    counts = Counter(str(conversation_id) for conversation_id in conversation_ids)
+    with transaction.atomic():
+        ids = _reserve_ids(len(conversation_ids))
+        # 按对话 ID 顺序加锁，避免并发预留之间死锁
+        next_seq = {
+            conversation_id: Conversation.objects.allocate_seq(conversation_id, count) - count + 1
+            for conversation_id, count in sorted(counts.items())
+        }
+
+    reserved = []
+    for message_id, conversation_id in zip(ids, conversation_ids):
+        conversation_id = str(conversation_id)
+        reserved.append((message_id, next_seq[conversation_id]))
+        next_seq[conversation_id] += 1
+    return reserved
+
+
+def _persist(messages):
+    latest = {}
+    counts = defaultdict(int)
+    for message in messages:
+        latest[message.conversation_id] = max(
+            latest.get(message.conversation_id, message.timestamp), message.timestamp
+        )
+        counts[message.conversation_id] += 1
+
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+        # 刷新对话版本，供 REST 读接口的条件请求判断
+        for conversation_id, timestamp in latest.items():
+            Conversation.objects.filter(id=conversation_id).update(updated_at=timestamp)
+
+    for conversation_id, count in counts.items():
+        unread.increment(conversation_id, count)
+
+
+class _IdAllocator:
+    """合并并发的 ID 与序号预留请求：等待中的请求由同一次预留批量分配"""
+
+    def __init__(self):
+        self.waiters = []
+        self.task = None
+
+    async def reserve(self, conversation_id):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((future, conversation_id))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        while self.waiters:
+            waiters, self.waiters = self.waiters, []
+            try:
+                reserved = await database_sync_to_async(_reserve)([conversation_id for _, conversation_id in waiters])
+            except Exception as e:
+                for waiter, _ in waiters:
+                    waiter.set_exception(e)
+                continue
+            for (waiter, _), result in zip(waiters, reserved):
+                waiter.set_result(result)
+
+
+class MessageBuffer:
+    def __init__(self):
+        self.ids = _IdAllocator()
+        self.pending = []
+        self.lock = asyncio.Lock()
+        self.timer = None
+        self.tasks = set()
+
+    async def add(self, conversation_id, sender_id, content, reply_channel):
+        """
+        分配 ID、对话内序号并缓冲消息
+        :param conversation_id: 对话 ID
+        :param sender_id: 发送者 ID
+        :param content: 消息内容
+        :param reply_channel: 发送者的 channel 名称，写入失败时通知
+        :return: 未保存的 Message 实例（已有 ID、序号与时间戳）
+        """
+        message_id, seq = await self.ids.reserve(conversation_id)
+        message = Message(
+            id=message_id,
+            seq=seq,
+            conversation_id=conversation_id,
+            sender_id=sender_id,
+            content=content,
+            timestamp=timezone.now(),
+        )
+        self.pending.append((message, reply_channel))
+
+        if len(self.pending) >= settings.IM_WRITE_BEHIND_MAX_BATCH:
+            self._spawn(self.flush())
+        elif self.timer is None:
+            self.timer = self._spawn(self._flush_later())
+        return message
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        # 持有任务引用，避免执行中被回收
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _flush_later(self):
+        await asyncio.sleep(settings.IM_WRITE_BEHIND_INTERVAL_MS / 1000)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        # 串行写入，保证批次顺序
+        async with self.lock:
+            while self.pending:
+                batch = self.pending[: settings.IM_WRITE_BEHIND_MAX_BATCH]
+                del self.pending[: len(batch)]
+                await self._write(batch)
+
+    async def _write(self, batch):
+        messages = [message for message, _ in batch]
+        for attempt in range(1, FLUSH_ATTEMPTS + 1):
+            try:
+                await database_sync_to_async(_persist)(messages)
+                return
+            except Exception as e:
+                logger.warning(f"Failed to persist {len(messages)} buffered messages (attempt {attempt}): {e}")
+                error = e
+                if attempt < FLUSH_ATTEMPTS:
+                    await asyncio.sleep(RETRY_DELAY * attempt)
+
+        logger.error(f"Dropped {len(messages)} buffered messages: {error}")
+        failed = defaultdict(list)
+        for message, reply_channel in batch:
+            failed[reply_channel].append(message.id)
+        channel_layer = get_channel_layer()
+        for reply_channel, message_ids in failed.items():
+            try:
+                await channel_layer.send(
+                    reply_channel, {"type": "chat.error", "message_ids": message_ids, "error": "message_not_saved"}
+                )
+            except Exception:
+                logger.exception(f"Failed to notify {reply_channel} of unsaved messages")
+
+
+# 每个事件循环一个缓冲（asyncio 原语与事件循环绑定）
+_buffers = weakref.WeakKeyDictionary()
+
+
+def get_buffer() -> MessageBuffer:
+    loop = asyncio.get_running_loop()
+    if loop not in _buffers:
+        _buffers[loop] = MessageBuffer()
+    return _buffers[loop]
+
+
+@lifespan.on_shutdown
+async def flush_all():
+    """worker 关闭前写入当前事件循环中缓冲的全部消息"""
+    buffer = _buffers.get(asyncio.get_running_loop())
+    if buffer is None:
+        return
+    if buffer.timer:
+        buffer.timer.cancel()
+        buffer.timer = None
+    await buffer.flush()
@@ -48,6 +48,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "drf_spectacular_sidecar",
     "drf_spectacular",
     "channels",
@@ -121,12 +122,18 @@ DATABASES = {
         "HOST": env("DB_HOST", default="127.0.0.1"),
         "PORT": env("DB_PORT", default="5432"),
         "OPTIONS": {},
+        # 连接复用时间（秒），0 为每个请求 / 每次 database_sync_to_async 调用后关闭，None 为不限
+        "CONN_MAX_AGE": env.int("DB_CONN_MAX_AGE", default=0),
+        "CONN_HEALTH_CHECKS": env.bool("DB_CONN_HEALTH_CHECKS", default=False),
         "TEST": {
             "NAME": "test_django_scaffold",  # PostgreSQL 测试数据库名称
         },
     }
 }
 
+# 异步代码（WebSocket consumer、ASGI 中间件）执行同步数据库操作的线程池大小，每个线程占用一个数据库连接，见 core.db
+ASYNC_DB_THREADS = env.int("ASYNC_DB_THREADS", default=10)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -277,6 +284,11 @@ JWT_ALGORITHM = env("JWT_ALGORITHM", default="HS256")
 JWT_VERIFY_EXPIRATION = env("JWT_VERIFY_EXPIRATION", default=True)
 JWT_LEEWAY = env("JWT_LEEWAY", default=0)
 
+# WebSocket 握手的用户快照缓存：Redis 缓存过期时间（秒）/ 进程内 LRU 过期时间（秒，其它进程用户变化的最大延迟）/ 进程内 LRU 容量
+USER_SNAPSHOT_CACHE_TTL = env.int("USER_SNAPSHOT_CACHE_TTL", default=300)
+USER_SNAPSHOT_LOCAL_TTL = env.int("USER_SNAPSHOT_LOCAL_TTL", default=5)
+USER_SNAPSHOT_LOCAL_SIZE = env.int("USER_SNAPSHOT_LOCAL_SIZE", default=10000)
+
 # Swagger API文档
 SPECTACULAR_SETTINGS = {
     "TITLE": "Django scaffold API documentation",
@@ -320,8 +332,60 @@ EMAIL_HOST_USER = env("EMAIL_HOST_USER", default="email@163.com")
 EMAIL_HOST_PASSWORD = env("EMAIL_HOST_PASSWORD", default="authorization_code")
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
+# WebSocket 消息写后（write-behind）持久化：是否开启 / 批量写入间隔（毫秒）/ 单批最大条数
+IM_WRITE_BEHIND = env.bool("IM_WRITE_BEHIND", default=False)
+IM_WRITE_BEHIND_INTERVAL_MS = env.int("IM_WRITE_BEHIND_INTERVAL_MS", default=50)
+IM_WRITE_BEHIND_MAX_BATCH = env.int("IM_WRITE_BEHIND_MAX_BATCH", default=500)
+# 写后模式下消息从分配 ID 到写入数据库的最长时间（毫秒）：增量同步的游标不越过更晚到达的消息，
+# 各 worker 独立写入，较小的 ID 可能晚于较大的 ID 可见，需大于写入间隔加重试时间
+IM_WRITE_BEHIND_SETTLE_MS = env.int("IM_WRITE_BEHIND_SETTLE_MS", default=5000)
+
+# 对话成员缓存：Redis 缓存过期时间（秒）/ 进程内 LRU 过期时间（秒，其它进程成员变化的最大延迟）/ 进程内 LRU 容量
+IM_MEMBERSHIP_CACHE_TTL = env.int("IM_MEMBERSHIP_CACHE_TTL", default=86400)
+IM_MEMBERSHIP_LOCAL_TTL = env.int("IM_MEMBERSHIP_LOCAL_TTL", default=5)
+IM_MEMBERSHIP_LOCAL_SIZE = env.int("IM_MEMBERSHIP_LOCAL_SIZE", default=10000)
+
+# 多路复用 WebSocket（ws/chat/）单个连接最多订阅的对话数
+IM_MAX_SUBSCRIPTIONS = env.int("IM_MAX_SUBSCRIPTIONS", default=200)
+
+# WebSocket 重连时按序号补发的最大消息数，缺口更大时客户端改为通过 REST 接口拉取
+IM_RESUME_MAX_MESSAGES = env.int("IM_RESUME_MAX_MESSAGES", default=500)
+
+# 在线状态：过期时间（秒，客户端心跳间隔应小于该值）/ 上下线与输入事件的合并广播窗口（毫秒）/ 批量查询的最大用户数
+IM_PRESENCE_TTL = env.int("IM_PRESENCE_TTL", default=60)
+IM_PRESENCE_WINDOW_MS = env.int("IM_PRESENCE_WINDOW_MS", default=1000)
+IM_PRESENCE_QUERY_MAX_USERS = env.int("IM_PRESENCE_QUERY_MAX_USERS", default=500)
+
+# WebSocket 限流：每个连接 / 每个用户（进程内）每秒的客户端帧数与突发量，速率为 0 时不限流
+IM_RATE_LIMIT_RATE = env.int("IM_RATE_LIMIT_RATE", default=10)
+IM_RATE_LIMIT_BURST = env.int("IM_RATE_LIMIT_BURST", default=20)
+IM_USER_RATE_LIMIT_RATE = env.int("IM_USER_RATE_LIMIT_RATE", default=20)
+IM_USER_RATE_LIMIT_BURST = env.int("IM_USER_RATE_LIMIT_BURST", default=40)
+# WebSocket 发送队列的积压上限（帧），超过时关闭读取过慢的连接
+IM_OUTBOX_HIGH_WATER = env.int("IM_OUTBOX_HIGH_WATER", default=1000)
+
+# WebSocket 已读回执的合并写入间隔（毫秒）
+IM_READ_RECEIPT_INTERVAL_MS = env.int("IM_READ_RECEIPT_INTERVAL_MS", default=500)
+
 # 即时聊天消息保存一周（7天）
 MESSAGE_RETENTION_DAYS = 7
+# im_message 分区表（需先执行 manage.py message_partitions convert）：分区粒度 day / week，提前创建的分区个数
+MESSAGE_PARTITION_INTERVAL = env("MESSAGE_PARTITION_INTERVAL", default="day")
+MESSAGE_PARTITION_PREMAKE = env.int("MESSAGE_PARTITION_PREMAKE", default=7)
+# 过期消息逐批删除：每批条数 / 每秒最多删除条数（0 为不限速）
+MESSAGE_RETENTION_BATCH_SIZE = env.int("MESSAGE_RETENTION_BATCH_SIZE", default=5000)
+MESSAGE_RETENTION_ROWS_PER_SECOND = env.int("MESSAGE_RETENTION_ROWS_PER_SECOND", default=0)
+# 过期消息删除前写入本地冷归档：是否开启 / 归档目录（开启时必须配置，不要放在代码目录下）/ 每天按对话划分的分片文件数
+MESSAGE_ARCHIVE_ENABLED = env.bool("MESSAGE_ARCHIVE_ENABLED", default=False)
+MESSAGE_ARCHIVE_ROOT = env("MESSAGE_ARCHIVE_ROOT", default="")
+MESSAGE_ARCHIVE_SHARDS = env.int("MESSAGE_ARCHIVE_SHARDS", default=16)
+# 历史消息游标分页：默认每页条数 / 每页最大条数
+MESSAGE_HISTORY_PAGE_SIZE = env.int("MESSAGE_HISTORY_PAGE_SIZE", default=50)
+MESSAGE_HISTORY_MAX_PAGE_SIZE = env.int("MESSAGE_HISTORY_MAX_PAGE_SIZE", default=200)
+# 消息全文检索：每页条数
+MESSAGE_SEARCH_PAGE_SIZE = env.int("MESSAGE_SEARCH_PAGE_SIZE", default=20)
+# 对话历史流式导出：每次从数据库游标读取并输出的条数
+MESSAGE_EXPORT_CHUNK_SIZE = env.int("MESSAGE_EXPORT_CHUNK_SIZE", default=1000)
 
 # 设置django shell环境（默认为python shell），这里设置为ipython。需安装ipython
 SHELL_PLUS = "ipython"
@@ -0,0 +1,24 @@
+"""
+在异步代码（Channels consumer、ASGI 中间件）中执行同步的数据库操作
+
+channels.db.database_sync_to_async 与 Django 的异步 ORM（aget、acreate、aexists 等）都基于
+sync_to_async(thread_sensitive=True)：同一进程中所有调用排队在同一个线程中执行，连接数一多这个线程就成为瓶颈。
+这里的 database_sync_to_async 改为在独立的线程池中执行（ASYNC_DB_THREADS 个线程），
+每个线程使用自己的数据库连接，调用前后同样清理过期的连接。
+被包装的函数必须自行完成事务（transaction.atomic），不能依赖调用方线程上的连接状态。
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_DB_THREADS, thread_name_prefix="async-db")
+
+
+def database_sync_to_async(func):
+    """
+    将同步函数包装为协程函数，在数据库线程池中执行，可作为装饰器使用
+    :param func: 同步函数
+    :return:
+    """
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=_executor)
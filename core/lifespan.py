@@ -0,0 +1,36 @@
+"""
+ASGI lifespan 协议处理
+
+服务器（uvicorn）启动/关闭 worker 时发送 lifespan.startup / lifespan.shutdown 事件，
+各应用通过 on_shutdown 注册关闭前需要执行的协程（如将内存中缓冲的数据写入数据库）。
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+_shutdown_handlers = []
+
+
+def on_shutdown(handler):
+    """
+    注册 worker 关闭前执行的协程函数，可作为装饰器使用
+    :param handler: 无参数的协程函数
+    :return: handler
+    """
+    _shutdown_handlers.append(handler)
+    return handler
+
+
+async def application(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            for handler in _shutdown_handlers:
+                try:
+                    await handler()
+                except Exception:
+                    logger.exception(f"Error in shutdown handler {handler.__qualname__}")
+            await send({"type": "lifespan.shutdown.complete"})
+            return
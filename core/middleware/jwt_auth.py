@@ -1,8 +1,9 @@
 from urllib.parse import parse_qs
 
-from channels.db import database_sync_to_async
-from django.contrib.auth import get_user_model
+import jwt
+from account import snapshot
 from django.contrib.auth.models import AnonymousUser
+from im import protocol
 
 from utils.jwt_handler import jwt_decode_handler
 from utils.jwt_handler import jwt_get_user_id_from_payload_handler
@@ -13,7 +14,10 @@ class JWTAuthMiddleware:
     ASGI middleware for channels that authenticates users by JWT.
     It supports:
       - ?token=<access_token> in query string
-      - token sent in Sec-WebSocket-Protocol header (common when using browser WebSocket protocols param)
+      - token sent in Sec-WebSocket-Protocol header (common when using browser WebSocket protocols param),
+        optionally alongside an encoding subprotocol such as "im.msgpack"
+    scope["user"] is a slim account.snapshot.UserSnapshot (id, username) resolved from cache, or AnonymousUser
+    when the token is missing, expired or invalid, or the user no longer exists or is inactive.
     """
 
     def __init__(self, inner):
@@ -26,37 +30,36 @@ class JWTAuthMiddleware:
         # 先从 query_string 里找
         query_string = scope.get("query_string", b"").decode()
         qs = parse_qs(query_string)
-        token = None
-        if "token" in qs:
-            token = qs["token"][0]
+        candidates = qs.get("token", [])[:1]
 
         # 如果没有，再从 headers 的 sec-websocket-protocol 读取
-        if not token:
+        # 该头部可能同时携带编码子协议，如 "im.msgpack, <token>"：跳过已知的子协议，其余各项逐个尝试解码
+        if not candidates:
             headers = dict(scope.get("headers", []))
             proto = headers.get(b"sec-websocket-protocol")
             if proto:
-                token = proto.decode()
+                items = [item.strip() for item in proto.decode().split(",")]
+                candidates = [item for item in items if item and item not in protocol.SUBPROTOCOLS]
 
-        if token:
-            payload = jwt_decode_handler(token)
-            user_id = jwt_get_user_id_from_payload_handler(payload)
-
-            user = await self._get_user(user_id)
+        user_id = jwt_get_user_id_from_payload_handler(self._decode(candidates))
+        if user_id is not None:
+            user = await snapshot.aget(user_id)
             if user:
                 scope["user"] = user
 
         return await self.inner(scope, receive, send)
 
-    @database_sync_to_async
-    def _get_user(self, user_id):
+    @staticmethod
+    def _decode(candidates):
         """
-        根据user_id获取用户
-        :param user_id:
-        :return:
+        返回第一个能通过校验的 token 的 payload
+        :param candidates: 候选 token
+        :return: payload，没有有效的 token 时为空字典
         """
-        User = get_user_model()
-        try:
-            user = User.objects.get(pk=user_id)
-            return user
-        except User.DoesNotExist:
-            return None
+        for token in candidates:
+            try:
+                return jwt_decode_handler(token)
+            except jwt.InvalidTokenError:
+                # 过期或无效的 token（包括未知的子协议名）跳过，都无效时按匿名处理，由 consumer 拒绝连接
+                continue
+        return {}
@@ -19,11 +19,14 @@ asgi_application = get_asgi_application()
 
 from im import routing  # noqa: E402
 
+from core import lifespan  # noqa: E402
 from core.middleware.jwt_auth import JWTAuthMiddleware  # noqa: E402
 
 application = ProtocolTypeRouter(
     {
         "http": asgi_application,
         "websocket": JWTAuthMiddleware(URLRouter(routing.websocket_urlpatterns)),
+        # worker 关闭前执行各应用注册的清理（如写入缓冲中的消息）
+        "lifespan": lifespan.application,
     }
 )
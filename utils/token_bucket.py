@@ -0,0 +1,27 @@
+import time
+
+
+class TokenBucket:
+    """
+    令牌桶：以每秒 rate 个的速度补充令牌，最多积累 burst 个（非线程安全，供单个事件循环使用）
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def consume(self, tokens=1) -> bool:
+        """
+        取出 tokens 个令牌
+        :param tokens: 令牌数
+        :return: 令牌是否足够（不足时不扣减）
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True